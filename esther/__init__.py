@@ -1,16 +1,33 @@
-from flask import Flask, render_template
+import os
+
+from flask import Flask, current_app, render_template
 from flask.ext.bcrypt import Bcrypt
 from flask.ext.login import LoginManager
-from flask.ext.mail import Mail
 from flask.ext.sqlalchemy import SQLAlchemy
 import pytz
-from raven.contrib.flask import Sentry
+
+
+class LazyMail(object):
+    """ Flask-Mail, imported and set up for the current app when it is first
+    used. Only the contact form sends mail, so most processes never load it
+    along with the email and SMTP modules. """
+
+    def __init__(self):
+        self._mail = None
+
+    def __getattr__(self, name):
+        if self._mail is None:
+            from flask.ext.mail import Mail
+            self._mail = Mail()
+        if 'mail' not in current_app.extensions:
+            self._mail.init_app(current_app._get_current_object())
+        return getattr(self._mail, name)
+
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
-mail = Mail()
+mail = LazyMail()
 login_manager = LoginManager()
-sentry = Sentry()
 
 
 def create_app(config_objects=None):
@@ -27,25 +44,39 @@ def create_app(config_objects=None):
     # config. TODO: Is there a better way to do this?
     app.config['TIME_ZONE'] = pytz.timezone(app.config['TIME_ZONE_NAME'])
 
+    # Before anything creates the Jinja environment
+    from esther import template_cache
+    template_cache.init_app(app)
+
     bcrypt.init_app(app)
     db.init_app(app)
     # Initialize the inter-mapper relationships of all mappers
     # see: http://docs.sqlalchemy.org/en/rel_0_8/orm/mapper_config.html#sqlalchemy.orm.configure_mappers
     db.configure_mappers()
     login_manager.init_app(app)
-    mail.init_app(app)
-    sentry.init_app(app)
+
+    # Raven takes a while to import and does nothing without a DSN
+    if app.config.get('SENTRY_DSN') or os.environ.get('SENTRY_DSN'):
+        from raven.contrib.flask import Sentry
+        Sentry(app)
 
     # Import all modules needed to create an app
     # TODO: Find a decent alternative to the unused models import (?)
+    from esther.cache import query_cache
     from esther import models
     from esther import filters
+    from esther import related
+    from esther.related_tags import related_tags
+    from esther.search import post_search
     from esther.views import auth
     from esther.views import blog
     from esther.views import general
 
     # Flask-Login settings are stored on the ``LoginManager`` instance
     auth.configure(login_manager, app)
+    query_cache.init_app(app)
+    post_search.init_app(app)
+    related_tags.init_app(app)
     filters.register_all(app)
 
     app.register_blueprint(auth.blueprint)
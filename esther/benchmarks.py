@@ -0,0 +1,296 @@
+from __future__ import absolute_import
+
+import datetime
+from io import BytesIO
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import markdown
+import pytz
+
+from esther import create_app, db, markdown as esther_markdown
+from esther.export import iter_posts, write_records
+from esther.importer import (import_posts, iter_posts as iter_import,
+                             refresh_derived_data)
+from esther.models import Post, PostStatus, User
+from esther.related import count_terms, NUM_RELATED_POSTS
+from esther.search import InvertedIndex
+from esther.similarity import Corpus
+from esther.template_cache import compile_templates
+
+SAMPLE_POST = u'''# A sample post
+
+Some *introductory* text with a [link][1] and `inline code`.
+
+<!-- preview -->
+
+    :::python
+    def fib(n):
+        a, b = 0, 1
+        for _ in range(n):
+            a, b = b, a + b
+        return a
+
+* A list item
+* Another list item
+
+[1]: https://ryankaskel.com/
+'''
+
+
+def report(name, seconds, iterations):
+    print(u'{:<28} {:>9.2f} ms total {:>9.3f} ms/call'.format(
+        name, seconds * 1000, seconds * 1000 / iterations))
+
+
+def bench_markdown(iterations=200):
+    """ Compare building a ``Markdown`` instance per call, as the
+    ``markdown`` filter used to, against the pooled engines. """
+    def per_call():
+        extensions = (esther_markdown.EXTENSIONS +
+                      [esther_markdown.EstherExtension()])
+        markdown.markdown(SAMPLE_POST, extensions=extensions,
+                          output_format=esther_markdown.OUTPUT_FORMAT)
+
+    def pooled():
+        esther_markdown.render(SAMPLE_POST)
+
+    # Warm up both paths so imports and the first engine don't count
+    per_call()
+    pooled()
+
+    report('markdown: per-call engine',
+           timeit.timeit(per_call, number=iterations), iterations)
+    report('markdown: pooled engine',
+           timeit.timeit(pooled, number=iterations), iterations)
+
+
+def bench_highlight(iterations=200):
+    """ Render the same code heavy post with a cold and a warm highlight
+    cache. """
+    block = u'\n'.join(line for line in SAMPLE_POST.splitlines()
+                       if line.startswith(u'    '))
+    text = u'\n\n'.join([u'Paragraph {}\n\n{}'.format(i, block)
+                          for i in range(10)])
+
+    def cold():
+        esther_markdown.highlight_cache.clear()
+        esther_markdown.render(text)
+
+    def warm():
+        esther_markdown.render(text)
+
+    report('highlight: cold cache',
+           timeit.timeit(cold, number=iterations), iterations)
+    warm()
+    report('highlight: warm cache',
+           timeit.timeit(warm, number=iterations), iterations)
+
+
+def bench_incremental(iterations=20):
+    """ Re-render a long post after editing a single paragraph. """
+    paragraphs = [
+        u'Paragraph {} with some *emphasis* and a [link][1].'.format(i)
+        for i in range(300)]
+    text = u'\n\n'.join(paragraphs + [SAMPLE_POST])
+    esther_markdown.render_incremental(text)
+    edits = [text.replace(u'Paragraph 150 ', u'Edit {} '.format(i), 1)
+             for i in range(iterations)]
+
+    def full():
+        for edit in edits:
+            esther_markdown.render(edit)
+
+    def incremental():
+        for edit in edits:
+            esther_markdown.render_incremental(edit)
+
+    report('incremental: full render', timeit.timeit(full, number=1),
+           iterations)
+    report('incremental: block cache', timeit.timeit(incremental, number=1),
+           iterations)
+
+
+def bench_search(iterations=200):
+    """ Query an index of 5000 posts of 300 words drawn from a vocabulary
+    of 20000 words. """
+    rand = random.Random(0)
+    vocabulary = [u'word{}'.format(i) for i in range(20000)]
+    index = InvertedIndex()
+    for doc_id in range(5000):
+        body = u' '.join(rand.choice(vocabulary) for _ in range(300))
+        index.add(doc_id, [(body, 1)])
+    queries = [u' '.join(rand.sample(vocabulary, 3))
+               for _ in range(iterations)]
+    queries = iter(queries)
+
+    report('search: 3 term query',
+           timeit.timeit(lambda: index.search(next(queries)),
+                         number=iterations), iterations)
+
+
+def bench_related(iterations=20):
+    """ Vectorize 3000 posts of 300 words with 5 of 200 tags each, then find
+    the related posts of every post and of a single edited post. """
+    rand = random.Random(0)
+    vocabulary = [u'word{}'.format(i) for i in range(20000)]
+    ids = range(3000)
+    term_counts = [count_terms(u'', u' '.join(
+        vocabulary[int(rand.paretovariate(1)) % len(vocabulary)]
+        for _ in range(300))) for post_id in ids]
+    tag_ids = [(post_id, rand.randrange(200)) for post_id in ids
+               for _ in range(5)]
+
+    report('related: vectorize',
+           timeit.timeit(lambda: Corpus(ids, term_counts, tag_ids),
+                         number=iterations), iterations)
+    corpus = Corpus(ids, term_counts, tag_ids)
+    report('related: all posts',
+           timeit.timeit(
+               lambda: list(corpus.top_related(ids, NUM_RELATED_POSTS)),
+               number=1), 1)
+    report('related: one edited post',
+           timeit.timeit(lambda: corpus.best_scores([0]),
+                         number=iterations), iterations)
+
+
+FIRST_REQUEST_URLS = ('/', '/about', '/blog/tags', '/auth/login')
+
+
+def bench_templates(iterations=20):
+    """ Time the first requests of fresh apps, which compile every template
+    they render, with and without compiled templates. """
+    cache_dir = tempfile.mkdtemp()
+
+    class Config(object):
+        TEMPLATE_BYTECODE_CACHE_DIR = None
+
+    def first_requests():
+        app = create_app(config_objects=['esther.settings.test', Config])
+        with app.app_context():
+            db.create_all()
+            client = app.test_client()
+            start = time.time()
+            for url in FIRST_REQUEST_URLS:
+                client.get(url)
+            seconds = time.time() - start
+            db.session.remove()
+            db.drop_all()
+        return seconds
+
+    try:
+        report('templates: compiled on use',
+               sum(first_requests() for _ in range(iterations)), iterations)
+        Config.TEMPLATE_BYTECODE_CACHE_DIR = cache_dir
+        compile_templates(create_app(
+            config_objects=['esther.settings.test', Config]))
+        report('templates: bytecode cache',
+               sum(first_requests() for _ in range(iterations)), iterations)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_COMMANDS = (
+    ('startup: worker',
+     [sys.executable, '-c', 'from esther import create_app; create_app()']),
+    ('startup: run.py --help', [sys.executable, 'run.py', '--help']),
+)
+
+
+def bench_startup(iterations=10):
+    """ Time fresh interpreters creating the app, as a mod_wsgi worker
+    does, and running a short management command. """
+    with open(os.devnull, 'w') as devnull:
+        for name, command in STARTUP_COMMANDS:
+            def start():
+                subprocess.call(command, stdout=devnull, stderr=devnull,
+                                cwd=ROOT_DIR)
+            report(name, timeit.timeit(start, number=iterations), iterations)
+
+
+def bench_export(iterations=20000):
+    """ Export ``iterations`` posts to /dev/null as NDJSON and report how
+    much the peak memory use grew. """
+    app = create_app(config_objects=['esther.settings.test'])
+    with app.app_context():
+        db.create_all()
+        user = User(email=u'user@example.com', short_name=u'User')
+        db.session.add(user)
+        db.session.flush()
+        now = datetime.datetime.now(pytz.utc)
+        db.session.execute(Post.__table__.insert(), [{
+            'author_id': user.id, 'status': PostStatus.published,
+            'title': u'Post {}'.format(i), 'slug': u'post-{}'.format(i),
+            'body': SAMPLE_POST, 'body_html': SAMPLE_POST, 'pub_date': now,
+            'created': now, 'modified': now,
+        } for i in range(iterations)])
+        db.session.commit()
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Not timed with ``timeit``, which turns off the garbage collector
+        # that frees the loaded posts
+        start = time.time()
+        with open(os.devnull, 'wb') as devnull:
+            write_records(iter_posts(), devnull, 'ndjson')
+        report('export: ndjson', time.time() - start, iterations)
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+        print(u'{:<28} {:>9} KB'.format('export: peak memory growth',
+                                         growth))
+
+        db.session.remove()
+        db.drop_all()
+
+
+def bench_import(iterations=50000):
+    """ Import ``iterations`` posts with a few tags each from NDJSON, then
+    rebuild what the batched inserts bypassed. """
+    tags = [u'tag-{}'.format(i) for i in range(200)]
+    out = BytesIO()
+    write_records(({
+        'title': u'Post {}'.format(i), 'slug': u'post-{}'.format(i),
+        'body': SAMPLE_POST, 'status': 'published',
+        'pub_date': '2014-03-01T12:00:00+00:00',
+        'created': '2014-03-01T12:00:00+00:00',
+        'author': {'email': u'user@example.com', 'short_name': u'User'},
+        'tags': [{'name': name} for name in random.sample(tags, 3)],
+    } for i in range(iterations)), out, 'ndjson')
+    out.seek(0)
+
+    app = create_app(config_objects=['esther.settings.test'])
+    with app.app_context():
+        db.create_all()
+        # Leaves out the progress reports
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                seconds = timeit.timeit(
+                    lambda: import_posts(iter_import(out, 'ndjson')),
+                    number=1)
+            finally:
+                sys.stdout = stdout
+        report('import: ndjson', seconds, iterations)
+        report('import: derived data', timeit.timeit(
+            refresh_derived_data, number=1), iterations)
+        db.session.remove()
+        db.drop_all()
+
+
+BENCHMARKS = {
+    'export': bench_export,
+    'import': bench_import,
+    'incremental': bench_incremental,
+    'highlight': bench_highlight,
+    'markdown': bench_markdown,
+    'related': bench_related,
+    'search': bench_search,
+    'startup': bench_startup,
+    'templates': bench_templates,
+}
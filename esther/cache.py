@@ -0,0 +1,242 @@
+import datetime
+from hashlib import sha1
+import time
+import uuid
+
+from flask import abort, current_app, has_app_context
+from flask.ext.sqlalchemy import BaseQuery
+import pytz
+from sqlalchemy import event
+from sqlalchemy.orm import object_mapper, Session
+from werkzeug.utils import import_string
+
+from esther.utils import LRUCache
+
+# Tables the public pages read from. ``tag_stats`` and ``related_posts`` are
+# written with plain SQL whenever posts or their tags change, so they are
+# invalidated along with them.
+CONTENT_TABLES = ('posts', 'post_tags', 'tags', 'tag_stats', 'related_posts',
+                  'users')
+DERIVED_TABLES = {
+    'posts': ('tag_stats', 'related_posts'),
+    'post_tags': ('tag_stats', 'related_posts'),
+}
+INVALIDATED_TABLES_KEY = 'esther.invalidated_tables'
+CONTENT_CHANGED_KEY = 'content_changed'
+
+
+class CacheBackend(object):
+    """ Storage for the query cache. Keys are strings and values are pickled
+    by backends shared between processes (e.g. memcached or Redis), which
+    makes invalidation visible to every process using the backend. """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, timeout=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LRUBackend(CacheBackend):
+    """ An in-process backend. Each process invalidates its own entries, so
+    other processes can serve results for up to ``QUERY_CACHE_TIMEOUT``
+    seconds after a change. """
+
+    def __init__(self, size=1024):
+        self.cache = LRUCache(size)
+
+    def get(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires < time.time():
+            self.cache.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+        self.cache.set(key, (value, expires))
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class CacheState(object):
+    def __init__(self, backend, timeout):
+        self.backend = backend
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+
+class QueryCache(object):
+    """ Caches values computed from the database under keys tagged with the
+    tables they depend on. Every table has a generation stored in the
+    backend and entries are keyed by the generations of their tables, so
+    invalidating a table gives it a new generation and leaves the old
+    entries to be evicted. """
+
+    def init_app(self, app):
+        backend_class = import_string(app.config['QUERY_CACHE_BACKEND'])
+        backend = backend_class(**app.config['QUERY_CACHE_OPTIONS'])
+        app.extensions['query_cache'] = CacheState(
+            backend, app.config['QUERY_CACHE_TIMEOUT'])
+
+    @property
+    def state(self):
+        return current_app.extensions['query_cache']
+
+    def generation(self, table):
+        key = 'generation:{}'.format(table)
+        generation = self.state.backend.get(key)
+        if generation is None:
+            # A lost generation is replaced by one no entry has been stored
+            # under, so evicting it can't bring back stale entries
+            generation = uuid.uuid4().hex
+            self.state.backend.set(key, generation)
+        return generation
+
+    def make_key(self, key, depends_on=CONTENT_TABLES):
+        generations = [self.generation(table) for table in sorted(depends_on)]
+        return 'result:{}'.format(sha1(repr((key, generations))).hexdigest())
+
+    def get(self, full_key):
+        """ Return the value stored under a key from ``make_key`` or
+        ``None``. """
+        state = self.state
+        value = state.backend.get(full_key)
+        if value is None:
+            state.misses += 1
+        else:
+            state.hits += 1
+        return value
+
+    def set(self, full_key, value, timeout=None):
+        self.state.backend.set(full_key, value, timeout or self.state.timeout)
+
+    def get_or_create(self, key, creator, depends_on=CONTENT_TABLES,
+                      timeout=None):
+        # The key is made before calling ``creator`` so a result computed
+        # while its tables are invalidated is stored under the old
+        # generations
+        full_key = self.make_key(key, depends_on)
+        value = self.get(full_key)
+        if value is None:
+            value = creator()
+            self.set(full_key, value, timeout)
+        return value
+
+    def invalidate(self, tables):
+        for table in tables:
+            self.state.backend.set('generation:{}'.format(table),
+                                   uuid.uuid4().hex)
+        if set(tables) & set(CONTENT_TABLES):
+            now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+            self.state.backend.set(CONTENT_CHANGED_KEY,
+                                   max(now, self.content_changed()))
+
+    def content_changed(self):
+        """ Return when a content table was last invalidated. It never moves
+        back, unlike the latest ``modified`` of the remaining posts, and
+        covers changes to tags and users too. A lost time is replaced by the
+        current one, which at worst makes clients fetch pages again. """
+        changed = self.state.backend.get(CONTENT_CHANGED_KEY)
+        if changed is None:
+            changed = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+            self.state.backend.set(CONTENT_CHANGED_KEY, changed)
+        return changed
+
+    def clear(self):
+        self.state.backend.clear()
+        self.state.hits = self.state.misses = 0
+
+    def stats(self):
+        return {'hits': self.state.hits, 'misses': self.state.misses}
+
+
+query_cache = QueryCache()
+
+
+def snapshot(instances):
+    """ Copy ``instances`` and the relationships loaded on them into
+    detached objects that no session will modify. """
+    session = Session()
+    copies = [session.merge(instance, load=False) for instance in instances]
+    session.expunge_all()
+    return copies
+
+
+def restore(copies):
+    from esther import db
+    return [db.session.merge(copy, load=False) for copy in copies]
+
+
+class CachingQuery(BaseQuery):
+    """ A query that can be answered from the query cache. Results are keyed
+    by the query's SQL and parameters and handed out as copies attached to
+    the current session, so they behave like the results of ``all()``. """
+
+    def cache_key(self):
+        compiled = self.with_labels().statement.compile()
+        return unicode(compiled), sorted(compiled.params.items())
+
+    def cached(self, depends_on=CONTENT_TABLES):
+        results = query_cache.get_or_create(
+            self.cache_key(), lambda: snapshot(self.all()), depends_on)
+        return restore(results)
+
+    def cached_count(self, depends_on=CONTENT_TABLES):
+        query = self.order_by(None)
+        return query_cache.get_or_create(('count', query.cache_key()),
+                                         query.count, depends_on)
+
+    def cached_first_or_404(self, depends_on=CONTENT_TABLES):
+        results = self.limit(1).cached(depends_on)
+        if not results:
+            abort(404)
+        return results[0]
+
+
+def changed_tables(session):
+    tables = set()
+    for instance in session.new | session.dirty | session.deleted:
+        mapper = object_mapper(instance)
+        tables.update(table.name for table in mapper.tables)
+        # Any change to an object may have changed its collections
+        tables.update(prop.secondary.name for prop in mapper.relationships
+                      if prop.secondary is not None)
+    for table in list(tables):
+        tables.update(DERIVED_TABLES.get(table, ()))
+    return tables
+
+
+@event.listens_for(Session, 'after_flush')
+def invalidate_flushed_tables(session, flush_context):
+    if not has_app_context():
+        return
+    tables = changed_tables(session)
+    if tables:
+        # Invalidate now so this transaction sees its own changes and again
+        # on commit in case another request refilled the cache meanwhile
+        query_cache.invalidate(tables)
+        session.info.setdefault(INVALIDATED_TABLES_KEY, set()).update(tables)
+
+
+# Results cached after a flush may hold changes that are later rolled back
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def invalidate_transaction_tables(session):
+    tables = session.info.pop(INVALIDATED_TABLES_KEY, None)
+    if tables and has_app_context():
+        query_cache.invalidate(tables)
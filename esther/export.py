@@ -1,21 +1,253 @@
-from flask.json import dumps
-from sqlalchemy.orm import joinedload, subqueryload
+from __future__ import print_function
 
-from esther.models import obj_as_dict, Post, PostStatus
+from contextlib import contextmanager
+import datetime
+import errno
+import gzip
+from itertools import islice, izip
+from operator import attrgetter
+import os
+import sys
+import time
 
+from flask.json import JSONEncoder
+import pytz
+from sqlalchemy import types
+from sqlalchemy.orm import class_mapper, joinedload
 
-def export_posts():
-    data = []
-    opts = (joinedload(Post.author), subqueryload(Post.tags))
-    posts = Post.query.options(*opts).filter(
-        Post.status == PostStatus.published).order_by(Post.created)
+from esther import db
+from esther.decl_enum import DeclEnumType
+from esther.models import (Post, PostStatus, post_tags, Tag, Tombstone,
+                           User, utc_now)
 
-    for post in posts:
-        post_data = obj_as_dict(post)
-        post_data['status'] = post_data['status'].value
-        post_data['author'] = obj_as_dict(post.author)
-        del post_data['author']['password']
-        post_data['tags'] = [obj_as_dict(tag) for tag in post.tags]
-        data.append(post_data)
+CHUNK_SIZE = 1000
+CHECKPOINT_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+CHECKPOINT_OVERLAP = datetime.timedelta(minutes=5)
+FORMATS = ('json', 'ndjson')
 
-    print dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+
+def column_converter(column_type):
+    """ Return the function turning a column value into JSON or ``None`` if
+    it can be written as is. """
+    if isinstance(column_type, types.TypeDecorator):
+        if isinstance(column_type, DeclEnumType):
+            return attrgetter('value')
+        column_type = column_type.impl
+    if isinstance(column_type, (types.DateTime, types.Date)):
+        return lambda value: value.isoformat()
+    return None
+
+
+def make_serializer(model, exclude=()):
+    """ Return a function turning an instance of ``model`` into a dict of its
+    columns, like ``obj_as_dict``. The columns, their attributes and how each
+    value is converted are worked out once rather than for every object. """
+    mapper = class_mapper(model)
+    names, keys, conversions = [], [], []
+    for column in model.__table__.columns:
+        if column.name in exclude:
+            continue
+        names.append(column.name)
+        keys.append(mapper.get_property_by_column(column).key)
+        convert = column_converter(column.type)
+        if convert is not None:
+            conversions.append((column.name, convert))
+
+    get_values = attrgetter(*keys)
+    if len(keys) == 1:
+        get_values = lambda obj, get_value=get_values: (get_value(obj),)
+
+    def serialize(obj):
+        data = dict(izip(names, get_values(obj)))
+        for name, convert in conversions:
+            value = data[name]
+            if value is not None:
+                data[name] = convert(value)
+        return data
+
+    return serialize
+
+
+serialize_post = make_serializer(Post)
+serialize_user = make_serializer(User, exclude=('password',))
+serialize_tag = make_serializer(Tag)
+
+
+def load_tags(post_ids):
+    """ Return the serialized tags of each post in ``post_ids``. """
+    tags = {}
+    for post_id, tag in db.session.query(post_tags.c.post_id, Tag).join(
+            Tag, Tag.id == post_tags.c.tag_id).filter(
+            post_tags.c.post_id.in_(post_ids)).order_by(Tag.name):
+        tags.setdefault(post_id, []).append(serialize_tag(tag))
+    return tags
+
+
+def iter_posts(chunk_size=CHUNK_SIZE, posts=None):
+    """ Yield the published posts or those ``posts`` selects, oldest first,
+    as dicts holding their author and tags. Posts are fetched ``chunk_size``
+    at a time, along with the tags of the whole chunk, so memory doesn't grow
+    with the number of posts. """
+    if posts is None:
+        posts = Post.query.filter(Post.status == PostStatus.published)
+    # ``yield_per`` also asks for a server side cursor where there is one
+    posts = iter(posts.options(joinedload(Post.author)).order_by(
+        Post.created, Post.id).yield_per(chunk_size))
+
+    while True:
+        chunk = list(islice(posts, chunk_size))
+        if not chunk:
+            break
+        tags = load_tags([post.id for post in chunk])
+        for post in chunk:
+            data = serialize_post(post)
+            data['author'] = serialize_user(post.author)
+            data['tags'] = tags.get(post.id, [])
+            yield data
+
+
+def iter_changes(since=None, chunk_size=CHUNK_SIZE):
+    """ Yield the users, tags and posts, whatever their status, modified
+    after ``since`` and the tombstones of those deleted after it, or all of
+    them if ``since`` is ``None``. Each record names its table and either
+    holds the row as ``data`` or the ``id`` and ``deleted`` time of a
+    tombstone. Deletions come first so rows whose ids were reused since are
+    not removed. A post's tags change its ``modified`` time too. """
+    def changed(query, column):
+        if since is not None:
+            query = query.filter(column > since)
+        return query
+
+    tombstones = changed(Tombstone.query, Tombstone.deleted).order_by(
+        Tombstone.id)
+    for tombstone in tombstones.yield_per(chunk_size):
+        yield {'table': tombstone.table_name, 'id': tombstone.object_id,
+               'deleted': tombstone.deleted.isoformat()}
+
+    for model, serialize in ((User, serialize_user), (Tag, serialize_tag)):
+        objs = changed(model.query, model.modified).order_by(model.id)
+        for obj in objs.yield_per(chunk_size):
+            yield {'table': model.__tablename__, 'data': serialize(obj)}
+
+    for post in iter_posts(chunk_size, changed(Post.query, Post.modified)):
+        yield {'table': Post.__tablename__, 'data': post}
+
+
+def read_checkpoint(path):
+    """ Return the time stored at ``path`` or ``None`` if there is none. """
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    return datetime.datetime.strptime(value, CHECKPOINT_FORMAT).replace(
+        tzinfo=pytz.utc)
+
+
+def write_checkpoint(path, checkpoint):
+    """ Replace the time stored at ``path`` in one step, so it is never
+    left half written. """
+    temp_path = u'{}.tmp'.format(path)
+    with open(temp_path, 'w') as f:
+        f.write(checkpoint.strftime(CHECKPOINT_FORMAT))
+        f.write('\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+
+
+def write_records(records, out, format='json'):
+    """ Write ``records`` to ``out`` one at a time, either as lines of JSON
+    (``ndjson``) or as a JSON array. Returns the number of records. """
+    encode = JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+    num_records = 0
+
+    if format == 'ndjson':
+        for record in records:
+            out.write(encode(record).encode('utf-8'))
+            out.write('\n')
+            num_records += 1
+    else:
+        out.write('[')
+        for record in records:
+            out.write(',\n' if num_records else '\n')
+            out.write(encode(record).encode('utf-8'))
+            num_records += 1
+        out.write('\n]\n')
+
+    return num_records
+
+
+@contextmanager
+def open_output(path=None, compress=False):
+    """ Open ``path`` for writing or stdout if it is ``None`` or ``-``. Files
+    only replace ``path`` once they are complete. """
+    to_stdout = path is None or path == '-'
+    if to_stdout:
+        f = sys.stdout
+    else:
+        temp_path = u'{}.tmp'.format(path)
+        f = open(temp_path, 'wb')
+    out = gzip.GzipFile(fileobj=f, mode='wb') if compress else f
+
+    try:
+        yield out
+        if compress:
+            out.close()
+    except:
+        if not to_stdout:
+            f.close()
+            os.remove(temp_path)
+        raise
+
+    if to_stdout:
+        f.flush()
+    else:
+        f.close()
+        os.rename(temp_path, path)
+
+
+def export_posts(output=None, format='json', compress=False,
+                 chunk_size=CHUNK_SIZE):
+    """ Export the published posts to ``output``, a path or stdout by
+    default, in ``format``, optionally gzip compressed. """
+    if format not in FORMATS:
+        raise ValueError(u'Invalid format: "{}"'.format(format))
+
+    start = time.time()
+    with open_output(output, compress) as out:
+        num_posts = write_records(iter_posts(chunk_size), out, format)
+    report(u'posts', num_posts, time.time() - start)
+    return num_posts
+
+
+def export_changes(checkpoint_path, output=None, format='json',
+                   compress=False, chunk_size=CHUNK_SIZE):
+    """ Export what changed since the time stored at ``checkpoint_path``, or
+    everything if there is none, like ``export_posts`` does. The checkpoint
+    only moves once the export is complete and stops short of its start by
+    ``CHECKPOINT_OVERLAP`` so changes committed late, with an earlier
+    ``modified`` time, are still picked up next time. Changes may therefore
+    be exported twice but never skipped. """
+    if format not in FORMATS:
+        raise ValueError(u'Invalid format: "{}"'.format(format))
+
+    since = read_checkpoint(checkpoint_path)
+    start = time.time()
+    checkpoint = utc_now() - CHECKPOINT_OVERLAP
+    with open_output(output, compress) as out:
+        num_changes = write_records(iter_changes(since, chunk_size), out,
+                                    format)
+    if since is None or checkpoint > since:
+        write_checkpoint(checkpoint_path, checkpoint)
+    report(u'changes', num_changes, time.time() - start)
+    return num_changes
+
+
+def report(name, num_records, seconds):
+    # stdout may hold the export
+    print(u'Exported {} {} ({:.1f} {}/s)'.format(
+        num_records, name, num_records / seconds if seconds else 0, name),
+        file=sys.stderr)
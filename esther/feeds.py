@@ -0,0 +1,159 @@
+from io import BytesIO
+from urlparse import urljoin
+from xml.sax.saxutils import XMLGenerator
+
+from flask import current_app, request, url_for
+from PyRSS2Gen import RSS2, RSSItem, Guid
+
+from esther.page_cache import last_modified, make_page
+from esther.utils import LRUCache
+
+ATOM_NAMESPACE = u'http://www.w3.org/2005/Atom'
+FRAGMENT_CACHE_SIZE = 4096
+NUM_FEED_POSTS = 10
+
+# Serialized entries keyed by post and modification time, shared by every
+# feed that lists the post
+fragment_cache = LRUCache(FRAGMENT_CACHE_SIZE)
+
+
+class Fragment(object):
+    """ Serialized XML written into a document as is. """
+
+    def __init__(self, xml):
+        self.xml = xml
+
+    def publish(self, handler):
+        # The only ``XMLGenerator`` method that doesn't escape its content
+        handler.ignorableWhitespace(self.xml)
+
+
+def serialize(publish):
+    """ Return the unicode XML written by ``publish(handler)``. """
+    buf = BytesIO()
+    publish(XMLGenerator(buf, 'utf-8'))
+    return buf.getvalue().decode('utf-8')
+
+
+def element(handler, name, text=None, attrs=None):
+    handler.startElement(name, attrs or {})
+    if text is not None:
+        handler.characters(text)
+    handler.endElement(name)
+
+
+def post_description(post):
+    # TODO: Add a real description
+    return post.body.split('\r\n', 1)[0]
+
+
+def rss_item(post, base_url):
+    post_url = urljoin(base_url, post.url)
+    item = RSSItem(
+        title=post.title,
+        link=post_url,
+        description=post_description(post),
+        author=u'{} ({})'.format(post.author.email, post.author.full_name),
+        categories=[tag.name for tag in post.tags],
+        guid=Guid(post_url),
+        pubDate=post.pub_date
+    )
+    return serialize(item.publish)
+
+
+def atom_entry(post, base_url):
+    post_url = urljoin(base_url, post.url)
+
+    def publish(handler):
+        handler.startElement(u'entry', {})
+        element(handler, u'title', post.title)
+        element(handler, u'link', attrs={u'href': post_url})
+        element(handler, u'id', post_url)
+        element(handler, u'published', post.pub_date.isoformat())
+        element(handler, u'updated', post.modified.isoformat())
+        handler.startElement(u'author', {})
+        element(handler, u'name',
+                post.author.full_name or post.author.short_name)
+        element(handler, u'email', post.author.email)
+        handler.endElement(u'author')
+        for tag in post.tags:
+            element(handler, u'category', attrs={u'term': tag.name})
+        element(handler, u'summary', post_description(post))
+        handler.endElement(u'entry')
+
+    return serialize(publish)
+
+
+ENTRY_SERIALIZERS = {
+    'rss': rss_item,
+    'atom': atom_entry,
+}
+
+
+def entry_fragment(kind, post, base_url):
+    """ Return the ``kind`` feed entry of ``post``, serialized once per
+    version of the post. Tags and the author are part of the key since
+    retagging a post or editing its author doesn't change its modified
+    time. """
+    author = post.author
+    key = (kind, post.id, post.modified,
+           tuple(tag.name for tag in post.tags),
+           (author.email, author.full_name, author.short_name), base_url)
+    fragment = fragment_cache.get(key)
+    if fragment is None:
+        fragment = Fragment(ENTRY_SERIALIZERS[kind](post, base_url))
+        fragment_cache.set(key, fragment)
+    return fragment
+
+
+def rss_feed(posts, title, link, feed_url, base_url):
+    feed_config = current_app.config['BLOG_POSTS_FEED']
+    rss2_feed = RSS2(
+        title=title,
+        link=link,
+        description=feed_config['description'],
+        language='en-us',
+        webMaster=feed_config['webmaster'],
+        lastBuildDate=posts[0].pub_date if posts else None,
+        ttl=1440,
+        items=[entry_fragment('rss', post, base_url) for post in posts]
+    )
+    return rss2_feed.to_xml(encoding='utf-8')
+
+
+def atom_feed(posts, title, link, feed_url, base_url):
+    updated = max(post.modified for post in posts) if posts else None
+
+    def publish(handler):
+        handler.startDocument()
+        handler.startElement(u'feed', {u'xmlns': ATOM_NAMESPACE})
+        element(handler, u'title', title)
+        element(handler, u'id', link)
+        element(handler, u'link', attrs={u'href': link})
+        element(handler, u'link', attrs={u'rel': u'self', u'href': feed_url})
+        if updated is not None:
+            element(handler, u'updated', updated.isoformat())
+        for post in posts:
+            entry_fragment('atom', post, base_url).publish(handler)
+        handler.endElement(u'feed')
+        handler.endDocument()
+
+    return serialize(publish).encode('utf-8')
+
+
+FEED_FORMATS = {
+    'rss': (rss_feed, 'application/rss+xml'),
+    'atom': (atom_feed, 'application/atom+xml'),
+}
+
+
+def build_feed(kind, posts, title, link):
+    """ Return a cacheable page holding the ``kind`` feed of ``posts``,
+    assembled from their cached entries. Must be called in a request
+    context. """
+    base_url = url_for('general.index', _external=True)
+    serializer, mimetype = FEED_FORMATS[kind]
+    xml = serializer(posts, title, urljoin(base_url, link), request.base_url,
+                     base_url)
+    return make_page(xml, mimetype, last_modified=last_modified(),
+                     compress=True)
@@ -2,9 +2,8 @@ from __future__ import absolute_import
 
 from flask import current_app
 from jinja2 import Markup
-import markdown as md
 
-from esther.markdown import EstherExtension
+from esther.markdown import render
 
 
 def localize_datetime(value):
@@ -28,9 +27,7 @@ def format_date(value, format_string=None):
 
 
 def markdown(value):
-    extensions = ['codehilite', EstherExtension()]
-    return Markup(md.markdown(value, extensions=extensions,
-                              output_format='html5'))
+    return Markup(render(value))
 
 
 def register_all(app):
@@ -0,0 +1,288 @@
+from __future__ import print_function
+
+from hashlib import sha1
+from collections import defaultdict
+import json
+import math
+from multiprocessing import Pool
+import os
+import time
+
+from flask import current_app, url_for
+from sqlalchemy.orm import contains_eager
+
+from esther import db
+from esther.cache import query_cache
+from esther.feeds import FEED_FORMATS, NUM_FEED_POSTS
+from esther.models import Post, RelatedPost, Tag, TagStats
+from esther.related import apply_related_updates
+from esther.related_tags import related_tags
+
+# Frozen pages can't vary by query string, so pagination links use page
+# numbers, and the page cache would only hold pages about to be written
+FREEZE_CONFIG = {
+    'PAGE_CACHE_ENABLED': False,
+    'PAGINATION_CURSORS': False,
+}
+MANIFEST_NAME = 'manifest.json'
+EXTENSIONS = {
+    'text/html': 'html',
+    'application/rss+xml': 'rss',
+    'application/atom+xml': 'atom',
+}
+
+# The test client of a pool worker
+client = None
+
+
+class FreezeError(Exception):
+    pass
+
+
+def init_worker(app):
+    global client
+    app.app_context().push()
+    # Connections inherited from the command's process can't be shared
+    db.engine.dispose()
+    client = app.test_client()
+
+
+def num_pages(total, per_page):
+    return max(1, int(math.ceil(total / float(per_page))))
+
+
+def post_keys(posts):
+    return [u'post:{}'.format(post.id) for post in posts]
+
+
+def tag_keys(tags):
+    return [u'tag:{}'.format(tag.id) for tag in tags]
+
+
+def paged_pages(endpoint, items, per_page, keys, extra_keys=(), **values):
+    """ Yield the numbered pages listing ``items``. Each page depends on the
+    items it shows and on the number of pages, which decides whether it
+    links to an older page. """
+    total = num_pages(len(items), per_page)
+    for page in range(1, total + 1):
+        shown = items[(page - 1) * per_page:page * per_page]
+        depends_on = keys(shown) + list(extra_keys) + [
+            u'pages:{}'.format(total)]
+        if page == 1:
+            url = url_for(endpoint, **values)
+        else:
+            url = url_for(endpoint, page=page, **values)
+        yield url, depends_on
+
+
+def iter_pages():
+    """ Yield the URL of every public page along with the keys of the posts
+    and tags it shows, mirroring the queries of the public views. Must be
+    called in a request context. """
+    config = current_app.config
+    posts = Post.get_published(load='list').all()
+
+    for page in paged_pages('general.index', posts,
+                            config['NUM_POSTS_PER_INDEX_PAGE'], post_keys):
+        yield page
+
+    yield url_for('general.about'), []
+
+    # Permalinks also show the titles of related posts
+    related = defaultdict(list)
+    for link in RelatedPost.query.order_by(RelatedPost.post_id,
+                                           RelatedPost.score.desc()):
+        related[link.post_id].append(u'post:{}'.format(link.related_id))
+
+    archives = defaultdict(list)
+    for post in posts:
+        yield post.url, post_keys([post]) + related[post.id]
+        date = post.pub_date
+        for archive in [(date.year, None, None),
+                        (date.year, date.month, None),
+                        (date.year, date.month, date.day)]:
+            archives[archive].append(post)
+
+    for (year, month, day), archive_posts in sorted(archives.items()):
+        url = url_for('blog.post_archive', year=year, month=month, day=day)
+        yield url, sorted(post_keys(archive_posts))
+
+    tags = Tag.query.join(TagStats).options(
+        contains_eager(Tag.stats)).order_by(Tag.name).all()
+
+    for page in paged_pages('blog.tag_list', tags,
+                            config['NUM_TAGS_PER_LIST_PAGE'], tag_keys):
+        yield page
+
+    tag_posts = defaultdict(list)
+    for post in posts:
+        for tag in post.tags:
+            tag_posts[tag.id].append(post)
+
+    for tag in tags:
+        # Every page of a tag lists its related tags
+        extra_keys = tag_keys([tag]) + tag_keys(related_tags.related([tag]))
+        for page in paged_pages('blog.tag_posts', tag_posts[tag.id],
+                                config['NUM_POSTS_PER_TAG_PAGE'], post_keys,
+                                extra_keys=extra_keys, slug=tag.slug):
+            yield page
+        for kind in FEED_FORMATS:
+            url = url_for('blog.tag_feed', slug=tag.slug, kind=kind)
+            yield url, tag_keys([tag]) + post_keys(
+                tag_posts[tag.id][:NUM_FEED_POSTS])
+
+    for kind in FEED_FORMATS:
+        url = url_for('blog.posts_feed', kind=kind)
+        yield url, post_keys(posts[:NUM_FEED_POSTS])
+
+
+def content_versions():
+    """ Return the version of every post and tag key. A post changes
+    whenever it is modified or retagged, one of its tags renamed or its
+    author edited, since every page showing it shows those too, and a tag
+    when it is renamed or its number of posts changes. """
+    versions = {}
+    for post in Post.get_published(load='list'):
+        author = post.author
+        versions[u'post:{}'.format(post.id)] = u'{}|{}|{}'.format(
+            post.modified.isoformat(),
+            u','.join(u'{}:{}:{}'.format(tag.id, tag.name, tag.slug)
+                      for tag in post.tags),
+            u':'.join([author.email, author.full_name or u'',
+                       author.short_name]))
+    for tag in Tag.query.join(TagStats).options(contains_eager(Tag.stats)):
+        versions[u'tag:{}'.format(tag.id)] = u'{}|{}|{}'.format(
+            tag.name, tag.slug, tag.stats.num_published)
+    return versions
+
+
+def is_stale(output_dir, url, depends_on, previous, changed):
+    entry = previous['pages'].get(url)
+    return (entry is None or entry['depends_on'] != depends_on or
+            any(key in changed for key in depends_on) or
+            not os.path.exists(os.path.join(output_dir, entry['path'])))
+
+
+def render_page(url):
+    response = (client or current_app.test_client()).get(url)
+    if response.status_code != 200:
+        raise FreezeError(u'{} returned {}'.format(url, response.status))
+    return url, response.mimetype, response.data
+
+
+def page_path(url, mimetype):
+    """ Return where the page at ``url`` is written, relative to the output
+    directory. Every URL becomes a directory with an index file so Apache
+    can map URLs to files without knowing about extensions. """
+    filename = 'index.{}'.format(EXTENSIONS.get(mimetype, 'html'))
+    return os.path.join(url.strip('/'), filename)
+
+
+def write_atomically(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp_path = u'{}.tmp'.format(path)
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.rename(temp_path, path)
+
+
+def load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except IOError:
+        manifest = {}
+    manifest.setdefault('pages', {})
+    manifest.setdefault('versions', {})
+    return manifest
+
+
+def save_manifest(output_dir, manifest):
+    write_atomically(os.path.join(output_dir, MANIFEST_NAME),
+                     json.dumps(manifest, indent=2, sort_keys=True))
+
+
+def write_page(output_dir, entry, data, previous):
+    """ Write a rendered page unless the file already holds it, which keeps
+    the mtimes of unchanged pages. Returns whether the file was written. """
+    path = os.path.join(output_dir, entry['path'])
+    if (previous is not None and previous['path'] == entry['path'] and
+            previous['sha1'] == entry['sha1'] and os.path.exists(path)):
+        return False
+    write_atomically(path, data)
+    return True
+
+
+def freeze_site(output_dir, processes=None, full=False):
+    """ Render public pages into ``output_dir`` across a pool of
+    ``processes`` workers (one per CPU by default, no pool if 0).
+
+    The manifest records each page's path, checksum and the posts and tags
+    it depends on, along with the version of every post and tag. Later runs
+    only render pages that are new, list different posts or tags, or
+    depend on one that changed, unless ``full`` is set. Files whose content
+    is unchanged aren't rewritten and pages that no longer exist are
+    removed. Related posts queued by saving posts are updated first, since
+    posts list them. """
+    current_app.config.update(FREEZE_CONFIG)
+    if apply_related_updates(db.session.connection()):
+        db.session.commit()
+        query_cache.invalidate(['related_posts'])
+
+    with current_app.test_request_context():
+        pages = dict(iter_pages())
+        versions = content_versions()
+
+    previous = load_manifest(output_dir)
+    changed = set(key for key in set(versions) | set(previous['versions'])
+                  if versions.get(key) != previous['versions'].get(key))
+    manifest = {'pages': {}, 'versions': versions}
+    stale_urls = []
+
+    for url, depends_on in pages.items():
+        if full or is_stale(output_dir, url, depends_on, previous, changed):
+            stale_urls.append(url)
+        else:
+            manifest['pages'][url] = previous['pages'][url]
+
+    num_written = 0
+    start = time.time()
+
+    pool = None
+    if processes != 0 and stale_urls:
+        app = current_app._get_current_object()
+        pool = Pool(processes, initializer=init_worker, initargs=(app,))
+
+    try:
+        if pool is None:
+            rendered = map(render_page, stale_urls)
+        else:
+            rendered = pool.imap_unordered(render_page, stale_urls,
+                                           chunksize=16)
+
+        for url, mimetype, data in rendered:
+            entry = {
+                'path': page_path(url, mimetype),
+                'sha1': sha1(data).hexdigest(),
+            }
+            if write_page(output_dir, entry, data, previous['pages'].get(url)):
+                num_written += 1
+            entry['depends_on'] = pages[url]
+            manifest['pages'][url] = entry
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for url, entry in previous['pages'].items():
+        if url not in manifest['pages']:
+            path = os.path.join(output_dir, entry['path'])
+            if os.path.exists(path):
+                os.remove(path)
+
+    save_manifest(output_dir, manifest)
+    print(u'Rendered {} of {} pages, wrote {} ({:.1f}s)'.format(
+        len(stale_urls), len(pages), num_written, time.time() - start))
+    return manifest
@@ -0,0 +1,456 @@
+from __future__ import print_function
+
+from contextlib import contextmanager
+import datetime
+import gzip
+from itertools import islice
+import json
+import re
+import sys
+import time
+import urllib
+from xml.etree import cElementTree
+
+from dateutil import parser as date_parser
+import pytz
+from sqlalchemy import or_, select
+
+from esther import db
+from esther.cache import CONTENT_TABLES, query_cache
+from esther.models import (Post, PostStatus, post_tags, Tag, TagStats, User,
+                           utc_now)
+from esther.related import chunked, rebuild_related_posts
+from esther.search import post_search
+from esther.utils import slugify
+
+BATCH_SIZE = 1000
+COMMIT_EVERY = 10000
+FORMATS = ('json', 'ndjson', 'wxr')
+READ_SIZE = 64 * 1024
+# Stored HTML is kept since it is only used while its fingerprint matches
+EXPORTED_POST_FIELDS = ('title', 'slug', 'body', 'body_html', 'preview_html',
+                        'preview_offset', 'html_fingerprint')
+WXR_STATUSES = {
+    'publish': PostStatus.published,
+    'draft': PostStatus.draft,
+    'pending': PostStatus.draft,
+    'future': PostStatus.draft,
+    'private': PostStatus.draft,
+}
+WXR_TAG_DOMAINS = ('post_tag', 'category')
+POST_SLUG_LENGTH = Post.__table__.c.slug.type.length
+EXPORTED_DATE_RE = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?'
+    r'(?:\+00:00|Z)$')
+
+
+def parse_date(value):
+    """ Parse an ISO 8601 time. The UTC times exports write, such as
+    ``2014-03-01T12:00:00.123456+00:00``, are matched by a regular
+    expression since ``strptime`` is a large part of an import. """
+    if not value:
+        return None
+    match = EXPORTED_DATE_RE.match(value)
+    if match is not None:
+        fraction = match.group(7)
+        return datetime.datetime(
+            *map(int, match.group(1, 2, 3, 4, 5, 6)),
+            microsecond=int(fraction.ljust(6, '0')) if fraction else 0,
+            tzinfo=pytz.utc)
+    date = date_parser.parse(value)
+    if date.tzinfo is None:
+        return date.replace(tzinfo=pytz.utc)
+    return date.astimezone(pytz.utc)
+
+
+### Reading exports
+
+
+@contextmanager
+def open_input(path=None):
+    """ Open ``path`` for reading or stdin if it is ``None`` or ``-``. Files
+    ending in ``.gz`` are decompressed as they are read. """
+    if path is None or path == '-':
+        yield sys.stdin
+        return
+
+    f = open(path, 'rb')
+    try:
+        if path.endswith('.gz'):
+            f = gzip.GzipFile(fileobj=f, mode='rb')
+        yield f
+    finally:
+        f.close()
+
+
+def iter_json_lines(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_json_array(f, read_size=READ_SIZE):
+    """ Yield the items of the JSON array in ``f`` one at a time, reading
+    only as far as the next item. """
+    decoder = json.JSONDecoder()
+    buf = ''
+    started = False
+    eof = False
+
+    while True:
+        buf = buf.lstrip()
+        if not started and buf.startswith('['):
+            buf, started = buf[1:].lstrip(), True
+        if started:
+            if buf.startswith(','):
+                buf = buf[1:].lstrip()
+            if buf.startswith(']'):
+                return
+            try:
+                item, end = decoder.raw_decode(buf)
+            except ValueError:
+                # The item may go on past what was read so far
+                if eof:
+                    raise
+            else:
+                yield item
+                buf = buf[end:]
+                continue
+        elif buf:
+            raise ValueError(u'Expected a JSON array')
+        elif eof:
+            raise ValueError(u'No JSON array found')
+
+        data = f.read(read_size)
+        eof = not data
+        buf += data
+
+
+def post_from_record(record):
+    """ Turn a post written by ``esther.export`` into what ``Importer``
+    inserts. Ids aren't kept: authors are matched by email and tags by name
+    instead. """
+    if 'table' in record:
+        raise ValueError(u'Incremental exports can\'t be imported')
+
+    post = dict((name, record.get(name)) for name in EXPORTED_POST_FIELDS)
+    post['status'] = PostStatus.from_string(record['status'])
+    post['pub_date'] = parse_date(record.get('pub_date'))
+    post['created'] = parse_date(record.get('created'))
+    author = record.get('author')
+    if author:
+        author = dict((name, author.get(name))
+                      for name in ('email', 'short_name', 'full_name'))
+    post['author'] = author
+    post['tags'] = [tag['name'] for tag in record.get('tags', ())]
+    return post
+
+
+def iter_export(f, format='json'):
+    records = iter_json_lines(f) if format == 'ndjson' else \
+        iter_json_array(f)
+    for record in records:
+        yield post_from_record(record)
+
+
+### Reading WordPress exports
+
+
+def parse_wxr_date(value):
+    # Drafts have no date
+    if not value or value.startswith('0000'):
+        return None
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S').replace(
+        tzinfo=pytz.utc)
+
+
+def wxr_author(element, name):
+    fields = dict((name(child), unicode(child.text or u''))
+                  for child in element)
+    full_name = u' '.join(filter(None, (
+        fields.get('wp:author_first_name'),
+        fields.get('wp:author_last_name'))))
+    short_name = (fields.get('wp:author_display_name') or
+                  fields.get('wp:author_login') or u'')
+    return fields.get('wp:author_login'), {
+        'email': fields.get('wp:author_email') or None,
+        'short_name': short_name[:30],
+        'full_name': full_name or None,
+    }
+
+
+def wxr_post(element, name, authors):
+    """ Turn an ``item`` into what ``Importer`` inserts or return ``None`` if
+    it isn't a post worth keeping, such as a page, an attachment or trash.
+    Bodies are kept as WordPress' HTML, which Markdown leaves alone. """
+    fields = {}
+    tags = []
+    for child in element:
+        key = name(child)
+        if key == 'category':
+            if (child.get('domain') in WXR_TAG_DOMAINS and
+                    child.get('nicename') != 'uncategorized' and child.text):
+                tags.append(unicode(child.text.strip()))
+        else:
+            fields[key] = unicode(child.text or u'')
+
+    status = WXR_STATUSES.get(fields.get('wp:status'))
+    if fields.get('wp:post_type') != 'post' or status is None:
+        return None
+
+    title = fields.get('title', u'')
+    created = parse_wxr_date(fields.get('wp:post_date_gmt'))
+    # WordPress percent-encodes non-ASCII slugs and allows longer ones
+    post_name = urllib.unquote(fields.get('wp:post_name', u'').encode(
+        'utf-8')).decode('utf-8', 'ignore')
+    slug = (slugify(post_name) or slugify(title) or
+            u'post-{}'.format(fields.get('wp:post_id')))
+    slug = slug[:POST_SLUG_LENGTH].rstrip(u'-')
+    author = authors.get(fields.get('dc:creator'))
+    return {
+        'title': title,
+        'slug': slug,
+        'body': fields.get('content:encoded', u''),
+        'status': status,
+        'pub_date': created if status == PostStatus.published else None,
+        'created': created,
+        'author': author if author and author['email'] else None,
+        'tags': tags,
+    }
+
+
+def iter_wxr(f):
+    """ Yield the posts of a WordPress export (WXR) file. Elements are
+    dropped once read so memory doesn't grow with the file. """
+    prefixes = {}
+
+    def name(element):
+        # Names elements the way the file does, e.g. ``wp:status``, whatever
+        # version of the WXR namespace it uses
+        if not element.tag.startswith('{'):
+            return element.tag
+        uri, local = element.tag[1:].split('}', 1)
+        return u'{}:{}'.format(prefixes.get(uri, uri), local)
+
+    authors = {}
+    channel = None
+    for event, value in cElementTree.iterparse(
+            f, events=('start-ns', 'start', 'end')):
+        if event == 'start-ns':
+            prefix, uri = value
+            prefixes[uri] = prefix
+        elif event == 'start':
+            if value.tag == 'channel':
+                channel = value
+        elif name(value) == 'wp:author':
+            login, author = wxr_author(value, name)
+            authors[login] = author
+            channel.clear()
+        elif value.tag == 'item':
+            post = wxr_post(value, name, authors)
+            channel.clear()
+            if post is not None:
+                yield post
+
+
+def iter_posts(f, format='json'):
+    if format == 'wxr':
+        return iter_wxr(f)
+    return iter_export(f, format)
+
+
+### Inserting posts
+
+
+def lookup(column, values, *columns):
+    """ Return ``columns`` of the rows whose ``column`` is one of
+    ``values``, looked up ``MAX_IN_IDS`` at a time. """
+    rows = []
+    for chunk in chunked(list(values)):
+        rows.extend(db.session.execute(select(columns).where(
+            column.in_(chunk))))
+    return rows
+
+
+class Importer(object):
+    """ Inserts posts a batch at a time with one statement per table. The
+    authors and tags of a batch are looked up together, the missing ones
+    created together, and their ids remembered for later batches. Posts
+    whose slug is taken are skipped, so importing a file twice is safe. """
+
+    def __init__(self, default_author=None):
+        self.user_ids = {}
+        self.tag_ids = {}
+        self.default_author_id = None
+        self.num_imported = 0
+        self.num_skipped = 0
+
+        if default_author is not None:
+            user = User.query.filter_by(email=default_author).first()
+            if user is None:
+                raise ValueError(u'No user with the email "{}"'.format(
+                    default_author))
+            self.default_author_id = user.id
+
+    def resolve_users(self, authors):
+        users = User.__table__
+        missing = dict((author['email'], author) for author in authors
+                       if author['email'] not in self.user_ids)
+        if not missing:
+            return
+
+        self.user_ids.update(lookup(users.c.email, missing, users.c.email,
+                                    users.c.id))
+        # Authors can't log in until they are given a password
+        new = [author for email, author in missing.iteritems()
+               if email not in self.user_ids]
+        if new:
+            db.session.execute(users.insert(), new)
+            self.user_ids.update(lookup(
+                users.c.email, [author['email'] for author in new],
+                users.c.email, users.c.id))
+
+    def resolve_tags(self, names):
+        tags = Tag.__table__
+        missing = dict((name, slugify(name)) for name in names
+                       if name not in self.tag_ids)
+        if not missing:
+            return
+
+        # Names slugified the same way share a tag, as slugs are unique
+        by_slug = {}
+        for chunk in chunked(list(missing)):
+            slugs = [missing[name] for name in chunk]
+            for tag_id, name, slug in db.session.execute(select([
+                    tags.c.id, tags.c.name, tags.c.slug]).where(or_(
+                    tags.c.name.in_(chunk), tags.c.slug.in_(slugs)))):
+                if name in missing:
+                    self.tag_ids[name] = tag_id
+                by_slug[slug] = tag_id
+
+        new = {}
+        for name, slug in missing.iteritems():
+            if name not in self.tag_ids and slug not in by_slug:
+                new.setdefault(slug, name)
+        if new:
+            db.session.execute(tags.insert(), [
+                {'name': name, 'slug': slug}
+                for slug, name in new.iteritems()])
+            by_slug.update(lookup(tags.c.slug, new, tags.c.slug, tags.c.id))
+
+        for name, slug in missing.iteritems():
+            self.tag_ids.setdefault(name, by_slug[slug])
+
+    def author_id(self, post):
+        if post['author'] is not None:
+            return self.user_ids[post['author']['email']]
+        if self.default_author_id is None:
+            raise ValueError(u'Post "{}" has no author and no default author '
+                             u'was given'.format(post['slug']))
+        return self.default_author_id
+
+    def insert(self, batch):
+        posts = Post.__table__
+        self.resolve_users([post['author'] for post in batch
+                            if post['author'] is not None])
+        self.resolve_tags(set(name for post in batch for name in post['tags']))
+
+        taken = set(slug for slug, in lookup(
+            posts.c.slug, [post['slug'] for post in batch], posts.c.slug))
+
+        rows = []
+        new_posts = []
+        for post in batch:
+            if post['slug'] in taken:
+                self.num_skipped += 1
+                continue
+            taken.add(post['slug'])
+            new_posts.append(post)
+            rows.append({
+                'author_id': self.author_id(post),
+                'status': post['status'],
+                'title': post['title'],
+                'slug': post['slug'],
+                'body': post['body'],
+                'body_html': post.get('body_html'),
+                'preview_html': post.get('preview_html'),
+                'preview_offset': post.get('preview_offset'),
+                'html_fingerprint': post.get('html_fingerprint'),
+                'pub_date': post['pub_date'],
+                # ``modified`` is left to its default so incremental exports
+                # pick imported posts up
+                'created': post['created'] or utc_now(),
+            })
+        if not rows:
+            return
+
+        db.session.execute(posts.insert(), rows)
+        post_ids = dict(lookup(
+            posts.c.slug, [post['slug'] for post in new_posts],
+            posts.c.slug, posts.c.id))
+
+        associations = []
+        for post in new_posts:
+            post_id = post_ids[post['slug']]
+            for tag_id in set(self.tag_ids[name] for name in post['tags']):
+                associations.append({'post_id': post_id, 'tag_id': tag_id})
+        if associations:
+            db.session.execute(post_tags.insert(), associations)
+        self.num_imported += len(rows)
+
+
+def import_posts(posts, batch_size=BATCH_SIZE, commit_every=COMMIT_EVERY,
+                 default_author=None):
+    """ Insert ``posts`` ``batch_size`` at a time, committing whenever
+    ``commit_every`` posts were imported or only at the end if it is 0.
+    Posts without an author, which WordPress exports may have, are given
+    ``default_author``, an email. Returns the ``Importer``.
+
+    Batched inserts bypass the session events, so ``refresh_derived_data``
+    must run afterwards. It runs here if the import fails after some posts
+    were committed, since those are kept; importing the same posts again
+    skips them. Imported HTML rendered with other Markdown settings is stale
+    until ``run.py rerender`` runs. """
+    importer = Importer(default_author)
+    posts = iter(posts)
+    uncommitted = 0
+    committed = False
+    start = time.time()
+
+    try:
+        while True:
+            batch = list(islice(posts, batch_size))
+            if not batch:
+                break
+            importer.insert(batch)
+            uncommitted += len(batch)
+            if commit_every and uncommitted >= commit_every:
+                db.session.commit()
+                uncommitted = 0
+                committed = True
+
+            elapsed = time.time() - start
+            print(u'Imported {} posts ({:.1f} posts/s)'.format(
+                importer.num_imported,
+                importer.num_imported / elapsed if elapsed else 0))
+        db.session.commit()
+    except:
+        db.session.rollback()
+        if committed:
+            refresh_derived_data()
+        raise
+
+    return importer
+
+
+def refresh_derived_data():
+    """ Rebuild what session events keep current when posts are changed
+    through the ORM. The related tags of other processes catch up once
+    their matrix expires. """
+    connection = db.session.connection()
+    TagStats.refresh(connection)
+    rebuild_related_posts(connection)
+    db.session.commit()
+    post_search.rebuild()
+    query_cache.invalidate(CONTENT_TABLES)
@@ -1,8 +1,109 @@
 from __future__ import absolute_import
 
+import hashlib
+import re
+import threading
+
 from flask import current_app
+import markdown
 from markdown.extensions import Extension
+from markdown.extensions.codehilite import CodeHilite, HiliteTreeprocessor
 from markdown.postprocessors import Postprocessor
+from markdown.preprocessors import ReferencePreprocessor
+import pygments
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name, guess_lexer, TextLexer
+from pygments.util import ClassNotFound
+
+from esther.utils import LRUCache
+
+# Bump this whenever a change to the rendering code itself should invalidate
+# HTML that has already been stored
+RENDERER_REVISION = 3
+EXTENSIONS = ['codehilite']
+OUTPUT_FORMAT = 'html5'
+HIGHLIGHT_CACHE_SIZE = 1024
+BLOCK_CACHE_SIZE = 4096
+
+# Highlighted HTML keyed by (lexer, formatter options, code hash). It is
+# shared by every engine in the process so a code block is only highlighted
+# once, even when it appears in more than one post.
+highlight_cache = LRUCache(HIGHLIGHT_CACHE_SIZE)
+_lexers = {}
+
+
+def get_lexer(name):
+    """ Resolve an explicit language name to a lexer, or ``None`` if
+    Pygments doesn't know it. ``get_lexer_by_name`` walks the aliases of every
+    lexer so results are cached by name. """
+    try:
+        return _lexers[name]
+    except KeyError:
+        try:
+            lexer = get_lexer_by_name(name)
+        except ClassNotFound:
+            lexer = None
+        _lexers[name] = lexer
+        return lexer
+
+
+class CachedCodeHilite(CodeHilite):
+    def hilite(self):
+        self.src = self.src.strip('\n')
+
+        if self.lang is None:
+            self._parseHeader()
+
+        lexer = get_lexer(self.lang) if self.lang else None
+        options = (self.linenums, self.guess_lang, self.css_class, self.style,
+                   self.noclasses, tuple(self.hl_lines))
+        code_hash = hashlib.sha1(self.src.encode('utf-8')).hexdigest()
+        # Blocks without a known language are keyed without a lexer so a
+        # cache hit skips ``guess_lexer``, which tries every lexer
+        key = (lexer.name if lexer else None, options, code_hash)
+
+        html = highlight_cache.get(key)
+        if html is None:
+            if lexer is None:
+                lexer = self.guess_lexer()
+            formatter = HtmlFormatter(linenos=self.linenums,
+                                      cssclass=self.css_class,
+                                      style=self.style,
+                                      noclasses=self.noclasses,
+                                      hl_lines=self.hl_lines)
+            html = highlight(self.src, lexer, formatter)
+            highlight_cache.set(key, html)
+        return html
+
+    def guess_lexer(self):
+        if self.guess_lang:
+            try:
+                return guess_lexer(self.src)
+            except ClassNotFound:
+                pass
+        return TextLexer()
+
+
+class CachedHiliteTreeprocessor(HiliteTreeprocessor):
+    """ ``HiliteTreeprocessor`` that highlights with ``CachedCodeHilite``. """
+
+    def run(self, root):
+        for block in root.getiterator('pre'):
+            children = block.getchildren()
+            if len(children) == 1 and children[0].tag == 'code':
+                code = CachedCodeHilite(children[0].text,
+                                        linenums=self.config['linenums'],
+                                        guess_lang=self.config['guess_lang'],
+                                        css_class=self.config['css_class'],
+                                        style=self.config['pygments_style'],
+                                        noclasses=self.config['noclasses'],
+                                        tab_length=self.markdown.tab_length)
+                placeholder = self.markdown.htmlStash.store(code.hilite(),
+                                                            safe=True)
+                block.clear()
+                block.tag = 'p'
+                block.text = placeholder
 
 
 class PreviewPostprocessor(Postprocessor):
@@ -15,3 +116,154 @@ class PreviewPostprocessor(Postprocessor):
 class EstherExtension(Extension):
     def extendMarkdown(self, md, md_globals):
         md.postprocessors.add('previewpp', PreviewPostprocessor(md), '_end')
+
+        # Take over highlighting from the codehilite extension, keeping its
+        # configuration, so highlighted blocks go through ``highlight_cache``
+        if 'hilite' in md.treeprocessors:
+            hiliter = CachedHiliteTreeprocessor(md)
+            hiliter.config = md.treeprocessors['hilite'].config
+            md.treeprocessors['hilite'] = hiliter
+
+
+class EnginePool(threading.local):
+    """ Hand out one ``Markdown`` instance per thread.
+
+    Building an instance loads every extension and registers its processors,
+    so engines are built once and reset between documents instead. Each
+    thread gets its own engine which makes the pool safe to use under
+    mod_wsgi with ``threads`` > 1. Processes never share engines because they
+    are only built on first use, after mod_wsgi has forked.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.engine = None
+
+    def get(self):
+        if self.engine is None:
+            self.engine = self.factory()
+        return self.engine.reset()
+
+
+def build_engine():
+    extensions = EXTENSIONS + [EstherExtension()]
+    return markdown.Markdown(extensions=extensions,
+                             output_format=OUTPUT_FORMAT)
+
+
+engines = EnginePool(build_engine)
+
+
+def render(text):
+    return engines.get().convert(text)
+
+
+def fingerprint():
+    """ Identify the output of ``render``. HTML stored with a different
+    fingerprint was produced by another configuration and must be
+    re-rendered. """
+    config = current_app.config
+    parts = [RENDERER_REVISION, markdown.version, pygments.__version__,
+             OUTPUT_FORMAT, config['POST_BODY_PREVIEW_SEPARATOR'],
+             config['POST_CONTINUE_LINK_FRAGMENT']] + EXTENSIONS
+    key = u'\0'.join(unicode(part) for part in parts)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+### Incremental rendering
+
+# Rendered top level blocks keyed by renderer fingerprint and a hash of the
+# block's source (and the document's reference definitions)
+block_cache = LRUCache(BLOCK_CACHE_SIZE)
+
+BLANK_LINES_RE = re.compile(r'(\n\n+)')
+LIST_ITEM_RE = re.compile(r'^[ ]{0,3}(?:[*+-]|\d+\.)[ ]+')
+HTML_BLOCK_RE = re.compile(r'^<([a-zA-Z][a-zA-Z0-9]*)[^>]*>')
+HTML_VOID_TAGS = frozenset(['hr', 'br', 'img', 'input'])
+
+
+def _is_list(block):
+    return LIST_ITEM_RE.match(block) is not None
+
+
+def _is_open_html(block):
+    if block.startswith('<!--'):
+        return '-->' not in block
+    match = HTML_BLOCK_RE.match(block)
+    if match is None:
+        return False
+    tag = match.group(1).lower()
+    return tag not in HTML_VOID_TAGS and '</{}>'.format(tag) not in block
+
+
+def _continues(block, chunk):
+    """ Whether ``chunk`` belongs to ``block`` even though a blank line
+    separates them. """
+    if _is_open_html(block):
+        return True
+    if chunk.startswith('    '):
+        # Code blocks and list items span blank lines if indented
+        return block.startswith('    ') or _is_list(block)
+    if _is_list(chunk):
+        # Markdown merges sibling lists of either type
+        return _is_list(block)
+    return chunk.startswith('>') and block.startswith('>')
+
+
+def split_blocks(text):
+    """ Split Markdown source into top level blocks that render the same on
+    their own as they do as part of the whole document. Returns the blocks
+    and the document's reference definitions, which any block can use. """
+    text = text.replace('\r\n', '\n').replace('\r', '\n').expandtabs(4)
+    references = []
+    lines = []
+    source = text.split('\n')
+    while source:
+        line = source.pop(0)
+        match = ReferencePreprocessor.RE.match(line)
+        if match:
+            references.append(line)
+            # Like Markdown, take a title from the next line if it has none
+            if (not (match.group(5) or match.group(6) or match.group(7)) and
+                    source and ReferencePreprocessor.TITLE_RE.match(
+                        source[0])):
+                references.append(source.pop(0))
+        else:
+            lines.append(line if line.strip() else u'')
+
+    parts = BLANK_LINES_RE.split(u'\n'.join(lines).strip('\n'))
+    blocks = []
+    # ``parts`` alternates between chunks of text and the blank lines that
+    # separated them, which are kept since they matter inside code blocks
+    for i in range(0, len(parts), 2):
+        chunk = parts[i]
+        if blocks and _continues(blocks[-1], chunk):
+            blocks[-1] = u'{}{}{}'.format(blocks[-1], parts[i - 1], chunk)
+        elif chunk.strip():
+            blocks.append(chunk)
+
+    return blocks, u'\n'.join(references)
+
+
+def render_incremental(text):
+    """ Render ``text`` block by block, only rendering blocks that aren't in
+    ``block_cache``. Editing one paragraph of a long post therefore costs
+    about as much as rendering that paragraph.
+
+    Reference definitions are appended to every block so links resolve. A
+    change to them invalidates every block in the document, which is fine
+    since they are rarely edited. """
+    blocks, references = split_blocks(text)
+    prefix = u'{}\0{}\0'.format(fingerprint(), references)
+    html = []
+
+    for block in blocks:
+        key = hashlib.sha1((prefix + block).encode('utf-8')).hexdigest()
+        block_html = block_cache.get(key)
+        if block_html is None:
+            block_html = render(u'{}\n\n{}'.format(block, references))
+            block_cache.set(key, block_html)
+        if block_html:
+            html.append(block_html)
+
+    return u'\n'.join(html)
@@ -2,12 +2,16 @@ import datetime
 
 from flask import url_for, current_app
 from flask.ext.login import UserMixin
+from jinja2 import Markup
 import pytz
-from sqlalchemy import types
-from sqlalchemy.orm import subqueryload
+from sqlalchemy import event, func, select, types
+from sqlalchemy.orm import defer, joinedload, subqueryload, Session
+from sqlalchemy.orm.attributes import get_history
 
-from esther import db, bcrypt
+from esther import db, bcrypt, markdown
+from esther.cache import CachingQuery
 from esther.decl_enum import DeclEnum
+from esther.pagination import paginate
 from esther.utils import slugify
 
 
@@ -15,6 +19,25 @@ def utc_now():
     return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
 
 
+def date_range(year, month=None, day=None):
+    """ Return the half-open UTC range ``[start, end)`` covering a year,
+    month or day. Archive and permalink dates are UTC dates since that is
+    what ``Post.url`` builds them from. Raises ``ValueError`` for dates that
+    don't exist. """
+    # A month or day of 0 is invalid rather than left out
+    start = datetime.datetime(year, 1 if month is None else month,
+                              1 if day is None else day, tzinfo=pytz.utc)
+
+    if day is not None:
+        end = start + datetime.timedelta(days=1)
+    elif month is not None:
+        end = (start + datetime.timedelta(days=31)).replace(day=1)
+    else:
+        end = start.replace(year=year + 1)
+
+    return start, end
+
+
 def obj_as_dict(obj, exclude=None):
     if exclude is None:
         exclude = []
@@ -60,6 +83,8 @@ class User(db.Model, UserMixin):
     password = db.Column(db.String(128))
     is_active_user = db.Column(db.Boolean, default=True, nullable=False)
     is_admin = db.Column(db.Boolean, default=False, nullable=False)
+    modified = db.Column(UTCDateTime, default=utc_now, onupdate=utc_now,
+                         index=True)
 
     def __init__(self, **columns):
         password = columns.pop('password', None)
@@ -82,10 +107,20 @@ class User(db.Model, UserMixin):
 post_tags = db.Table('post_tags',
     db.Column('post_id', db.Integer, db.ForeignKey('posts.id')),
     db.Column('tag_id', db.Integer, db.ForeignKey('tags.id')),
-    db.UniqueConstraint('post_id', 'tag_id')
+    db.UniqueConstraint('post_id', 'tag_id'),
+    db.Index('ix_post_tags_tag_id', 'tag_id')
 )
 
 
+# Columns left out of queries for each kind of page. Listings only show
+# titles, dates and tags and the index only shows stored previews.
+POST_DEFERRED_COLUMNS = {
+    'full': (),
+    'preview': ('body', 'body_html'),
+    'list': ('body', 'body_html', 'preview_html'),
+}
+
+
 class PostStatus(DeclEnum):
     draft = 'draft', 'Draft'
     published = 'published', 'Published'
@@ -94,6 +129,12 @@ class PostStatus(DeclEnum):
 
 class Post(db.Model):
     __tablename__ = 'posts'
+    query_class = CachingQuery
+    __table_args__ = (
+        db.Index('ix_posts_status_pub_date', 'status', 'pub_date'),
+        db.Index('ix_posts_status_slug', 'status', 'slug'),
+        db.Index('ix_posts_modified', 'modified'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'),
                           nullable=False)
@@ -102,6 +143,12 @@ class Post(db.Model):
     title = db.Column(db.String(255), nullable=False)
     slug = db.Column(db.String(80), unique=True, nullable=False)
     body = db.Column(db.Text)
+    body_html = db.Column(db.Text)
+    preview_html = db.Column(db.Text)
+    # Position of the preview separator in ``body`` or ``None`` if the post
+    # has no preview
+    preview_offset = db.Column(db.Integer)
+    html_fingerprint = db.Column(db.String(40))
     pub_date = db.Column(UTCDateTime)
     created = db.Column(UTCDateTime, default=utc_now)
     modified = db.Column(UTCDateTime, default=utc_now, onupdate=utc_now)
@@ -143,35 +190,144 @@ class Post(db.Model):
 
     @property
     def preview(self):
-        separator = current_app.config['POST_BODY_PREVIEW_SEPARATOR']
-        parts = self.body.split(separator, 1)
-        preview_part = parts[0].rstrip()
+        # The stored offset is only trusted while the stored HTML is, which
+        # stops being the case as soon as the body changes
+        if self.html_is_stale:
+            offset = self.find_preview_offset()
+        else:
+            offset = self.preview_offset
+
+        body = self.body or u''
 
-        if len(parts) == 2:
-            return u'{}...'.format(preview_part)
+        if offset is None:
+            return body.rstrip()
         else:
-            return preview_part
+            return u'{}...'.format(body[:offset].rstrip())
+
+    def find_preview_offset(self):
+        separator = current_app.config['POST_BODY_PREVIEW_SEPARATOR']
+        offset = (self.body or u'').find(separator)
+        return offset if offset != -1 else None
+
+    def render_html(self):
+        self.preview_offset = self.find_preview_offset()
+        self.body_html = markdown.render_incremental(self.body or u'')
+        self.preview_html = markdown.render_incremental(self.preview)
+        self.html_fingerprint = markdown.fingerprint()
+
+    @property
+    def html_is_stale(self):
+        return self.html_fingerprint != markdown.fingerprint()
+
+    # Stale HTML is rendered for display but not stored, which would turn
+    # a page view into an UPDATE. Saving the post or ``rerender`` stores it.
+    @property
+    def rendered_body(self):
+        if self.html_is_stale:
+            return Markup(markdown.render_incremental(self.body or u''))
+        return Markup(self.body_html)
+
+    @property
+    def rendered_preview(self):
+        if self.html_is_stale:
+            return Markup(markdown.render_incremental(self.preview))
+        return Markup(self.preview_html)
 
     @classmethod
-    def get_published(cls, num=None):
-        pub_date = Post.pub_date.desc()
-        posts = cls.query.options(subqueryload(Post.tags)).filter_by(
-            status=PostStatus.published).order_by(pub_date)
+    def load_options(cls, load='full'):
+        """ Query options for loading posts to display. Authors and tags are
+        always loaded eagerly so pages need the same number of queries no
+        matter how many posts they show. ``load`` is one of the keys of
+        ``POST_DEFERRED_COLUMNS`` and leaves out the columns a page doesn't
+        need. """
+        options = [joinedload(cls.author), subqueryload(cls.tags)]
+        options.extend(defer(getattr(cls, column))
+                       for column in POST_DEFERRED_COLUMNS[load])
+        return options
+
+    @classmethod
+    def get_published(cls, num=None, load='full'):
+        posts = cls.query.options(*cls.load_options(load)).filter_by(
+            status=PostStatus.published).order_by(*cls.newest_first())
         return posts.limit(num) if num else posts
 
     @classmethod
-    def get_recent(cls, page, num=None):
+    def get_published_between(cls, start, end, load='full'):
+        # Plain range predicates on ``pub_date`` can use the
+        # ``(status, pub_date)`` index, unlike extracting date components
+        return cls.query.options(*cls.load_options(load)).filter(
+            cls.status == PostStatus.published, cls.pub_date >= start,
+            cls.pub_date < end)
+
+    @classmethod
+    def get_archive(cls, year, month=None, day=None, load='list'):
+        start, end = date_range(year, month, day)
+        posts = cls.get_published_between(start, end, load=load)
+        return posts.order_by(cls.pub_date)
+
+    @classmethod
+    def get_by_permalink(cls, year, month, day, slug):
+        start, end = date_range(year, month, day)
+        return cls.get_published_between(start, end).filter(cls.slug == slug)
+
+    @classmethod
+    def get_tagged(cls, tag, load='list'):
+        posts = cls.query.options(*cls.load_options(load)).join(
+            post_tags).filter(post_tags.c.tag_id == tag.id,
+                              cls.status == PostStatus.published)
+        return posts.order_by(*cls.newest_first())
+
+    def get_related(self):
+        """ The posts listed below this one, most related first. They are
+        picked ahead of time by ``esther.related``. Only their titles and
+        links are shown, so nothing else is loaded. """
+        posts = Post.query.options(*[
+            defer(getattr(Post, column))
+            for column in POST_DEFERRED_COLUMNS['list']]).join(
+            RelatedPost, RelatedPost.related_id == Post.id).filter(
+            RelatedPost.post_id == self.id,
+            Post.status == PostStatus.published)
+        return posts.order_by(RelatedPost.score.desc(), Post.id)
+
+    @classmethod
+    def get_recent(cls, page=1, num=None, load='preview', before=None,
+                   after=None):
         if num is None:
             num = current_app.config['NUM_POSTS_PER_INDEX_PAGE']
-        posts = cls.get_published()
-        return posts.paginate(page, per_page=num)
+        posts = cls.get_published(load=load)
+        return paginate(posts, page, num, columns=(cls.pub_date, cls.id),
+                        before=before, after=after)
+
+    @classmethod
+    def newest_first(cls, date_column=None):
+        """ Ordering for post listings. ``id`` breaks ties between posts
+        published at the same time so keyset pagination can seek on
+        ``(date, id)``. """
+        if date_column is None:
+            date_column = cls.pub_date
+        return date_column.desc(), cls.id.desc()
+
+
+@event.listens_for(Post.body, 'set')
+def expire_post_html(post, value, oldvalue, initiator):
+    post.html_fingerprint = None
+
+
+@event.listens_for(Post, 'before_insert')
+@event.listens_for(Post, 'before_update')
+def render_post_html(mapper, connection, post):
+    if post.html_is_stale:
+        post.render_html()
 
 
 class Tag(db.Model):
     __tablename__ = 'tags'
+    query_class = CachingQuery
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
     slug = db.Column(db.String(100), unique=True, nullable=False)
+    modified = db.Column(UTCDateTime, default=utc_now, onupdate=utc_now,
+                         index=True)
 
     def __init__(self, name):
         self.name = name
@@ -184,3 +340,145 @@ class Tag(db.Model):
     @property
     def url(self):
         return url_for('blog.tag_posts', slug=self.slug)
+
+
+class TagStats(db.Model):
+    """ The number of published posts and the latest ``pub_date`` of each
+    tag. Only tags with published posts have a row. Rows are kept current by
+    the session events below and can be rebuilt with ``refresh``. """
+    __tablename__ = 'tag_stats'
+    __table_args__ = (
+        db.Index('ix_tag_stats_num_published', 'num_published'),
+    )
+    tag_id = db.Column(db.Integer, db.ForeignKey('tags.id'), primary_key=True)
+    num_published = db.Column(db.Integer, default=0, nullable=False)
+    latest_pub_date = db.Column(UTCDateTime)
+
+    tag = db.relationship(Tag, backref=db.backref(
+        'stats', uselist=False, cascade='all, delete-orphan'))
+
+    def __repr__(self):
+        return u'<TagStats: {} {}>'.format(
+            self.tag_id, self.num_published).encode('utf-8')
+
+    @classmethod
+    def refresh(cls, connection, tag_ids=None):
+        """ Recompute the stats of ``tag_ids`` or of every tag if ``None``. """
+        stats = cls.__table__
+        posts = Post.__table__
+        aggregate = select([
+            post_tags.c.tag_id,
+            func.count(posts.c.id),
+            func.max(posts.c.pub_date)
+        ]).select_from(post_tags.join(posts)).where(
+            posts.c.status == PostStatus.published).group_by(
+            post_tags.c.tag_id)
+        delete = stats.delete()
+
+        if tag_ids is not None:
+            if not tag_ids:
+                return
+            aggregate = aggregate.where(post_tags.c.tag_id.in_(tag_ids))
+            delete = delete.where(stats.c.tag_id.in_(tag_ids))
+
+        connection.execute(delete)
+        connection.execute(stats.insert().from_select(
+            ['tag_id', 'num_published', 'latest_pub_date'], aggregate))
+
+
+class RelatedPost(db.Model):
+    """ A published post listed below another one along with its similarity
+    score. Rows are computed by ``esther.related``. """
+    __tablename__ = 'related_posts'
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'),
+                        primary_key=True)
+    related_id = db.Column(db.Integer, db.ForeignKey('posts.id'),
+                           primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return u'<RelatedPost: {} {}>'.format(
+            self.post_id, self.related_id).encode('utf-8')
+
+
+class RelatedPostUpdate(db.Model):
+    """ A post whose related posts, and those of the posts that may list it,
+    must be recomputed. Saving a post only queues it since recomputing
+    scores the whole corpus; ``run.py related_posts update`` does the rest.
+    Deleted posts stay queued, so there is no foreign key. """
+    __tablename__ = 'related_post_updates'
+    id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return u'<RelatedPostUpdate: {}>'.format(self.post_id).encode('utf-8')
+
+
+class Tombstone(db.Model):
+    """ A deleted post, tag or user. Incremental exports pass deletions on
+    from these since the rows themselves are gone. """
+    __tablename__ = 'tombstones'
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(30), nullable=False)
+    object_id = db.Column(db.Integer, nullable=False)
+    deleted = db.Column(UTCDateTime, default=utc_now, nullable=False,
+                        index=True)
+
+    def __repr__(self):
+        return u'<Tombstone: {} {}>'.format(
+            self.table_name, self.object_id).encode('utf-8')
+
+
+TAG_STATS_SESSION_KEY = 'esther.tag_stats_tags'
+TAG_STATS_POST_ATTRIBUTES = ('status', 'pub_date', 'tags')
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_tag_stats_changes(session, flush_context, instances):
+    """ Remember the tags whose stats the flush is about to change: every
+    tag a post had or has if it is added, deleted, (un)published, redated
+    or retagged. """
+    tags = session.info.setdefault(TAG_STATS_SESSION_KEY, set())
+
+    for post in session.new | session.dirty | session.deleted:
+        if not isinstance(post, Post):
+            continue
+        if post in session.dirty and not any(
+                get_history(post, attribute).has_changes()
+                for attribute in TAG_STATS_POST_ATTRIBUTES):
+            continue
+        tags.update(get_history(post, 'tags').sum())
+
+
+@event.listens_for(Session, 'after_flush')
+def update_tag_stats(session, flush_context):
+    tags = session.info.pop(TAG_STATS_SESSION_KEY, None)
+    if tags:
+        tag_ids = [tag.id for tag in tags if tag.id is not None]
+        TagStats.refresh(session.connection(), tag_ids)
+
+
+TOMBSTONE_MODELS = (Post, Tag, User)
+
+
+@event.listens_for(Session, 'before_flush')
+def track_modifications(session, flush_context, instances):
+    """ Keep ``modified`` and the tombstones current for incremental
+    exports. Retagging a post only changes ``post_tags`` so it doesn't
+    trigger the post's ``onupdate``, and neither does deleting one of its
+    tags. """
+    for obj in session.dirty:
+        if isinstance(obj, Post) and get_history(obj, 'tags').has_changes():
+            obj.modified = utc_now()
+
+    for obj in session.deleted:
+        if isinstance(obj, TOMBSTONE_MODELS):
+            session.add(Tombstone(table_name=obj.__tablename__,
+                                  object_id=obj.id))
+        if isinstance(obj, Tag):
+            # Before the flush removes its ``post_tags`` rows
+            posts = Post.__table__
+            tagged = select([post_tags.c.post_id]).where(
+                post_tags.c.tag_id == obj.id)
+            session.execute(posts.update().where(
+                posts.c.id.in_(tagged)).values(modified=utc_now()))
@@ -0,0 +1,102 @@
+from functools import wraps
+import gzip
+from hashlib import sha1
+from io import BytesIO
+
+from flask import current_app, request, session
+from flask.ext.login import current_user
+
+from esther.cache import query_cache
+
+
+def last_modified():
+    """ Return when the content of public pages last changed. """
+    return query_cache.content_changed()
+
+
+def is_cacheable_request():
+    # Logged-in users see admin links and flashed messages are shown once,
+    # so only plain anonymous GETs share pages
+    return (current_app.config['PAGE_CACHE_ENABLED'] and
+            request.method in ('GET', 'HEAD') and
+            not current_user.is_authenticated() and
+            '_flashes' not in session)
+
+
+def gzip_compress(data):
+    buf = BytesIO()
+    # A fixed mtime keeps the output the same for the same data
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def make_page(body, mimetype, last_modified=None, compress=False):
+    """ Return a cacheable page. With ``compress`` a gzipped copy of the
+    body is kept for clients that accept it. """
+    page = {
+        'body': body,
+        'mimetype': mimetype,
+        'etag': sha1(body).hexdigest(),
+        'last_modified': last_modified,
+    }
+    if compress:
+        page['gzip_body'] = gzip_compress(body)
+    return page
+
+
+def make_page_response(page):
+    """ Return a response for a page from ``make_page``, or a 304 if the
+    request's conditional headers match it. """
+    if 'gzip_body' in page:
+        gzipped = request.accept_encodings['gzip'] > 0
+    else:
+        gzipped = False
+
+    body = page['gzip_body'] if gzipped else page['body']
+    response = current_app.response_class(body, mimetype=page['mimetype'])
+
+    if gzipped:
+        response.content_encoding = 'gzip'
+        # Strong ETags must differ between encodings
+        response.set_etag(page['etag'] + '-gzip')
+    else:
+        response.set_etag(page['etag'])
+    if 'gzip_body' in page:
+        response.vary.add('Accept-Encoding')
+
+    if page['last_modified'] is not None:
+        response.last_modified = page['last_modified']
+    return response.make_conditional(request)
+
+
+def cached_page(view):
+    """ Serve anonymous requests for ``view`` from the query cache, keyed by
+    URL and invalidated along with the content tables. Responses carry a
+    strong ETag and ``Last-Modified`` so conditional requests for cached
+    pages are answered with 304 without running the view. """
+
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        if not is_cacheable_request():
+            return view(*args, **kwargs)
+
+        key = query_cache.make_key(('page', request.full_path))
+        page = query_cache.get(key)
+
+        if page is None:
+            modified = last_modified()
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.direct_passthrough:
+                return response
+            page = make_page(response.get_data(), response.mimetype,
+                             last_modified=modified)
+            query_cache.set(key, page)
+
+        response = make_page_response(page)
+        # Pages for logged-in users differ, so don't let shared caches mix
+        # them
+        response.vary.add('Cookie')
+        return response
+
+    return decorated
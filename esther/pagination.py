@@ -0,0 +1,158 @@
+import datetime
+
+from flask import abort, current_app, url_for
+from flask.ext.sqlalchemy import Pagination
+import pytz
+from sqlalchemy import and_, or_
+
+from esther.cache import CachingQuery
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def fetch(query):
+    """ Return the results of ``query``, from the query cache if it is a
+    ``CachingQuery``. """
+    if isinstance(query, CachingQuery):
+        return query.cached()
+    return query.all()
+
+
+def count(query):
+    if isinstance(query, CachingQuery):
+        return query.cached_count()
+    return query.order_by(None).count()
+
+
+def encode_cursor(date, id):
+    return u'{}-{}'.format(date.strftime(CURSOR_DATE_FORMAT), id)
+
+
+def decode_cursor(cursor):
+    """ Return the ``(date, id)`` encoded in ``cursor``. Raises
+    ``ValueError`` if the cursor is malformed. """
+    date, id = cursor.split(u'-')
+    date = datetime.datetime.strptime(date, CURSOR_DATE_FORMAT)
+    return date.replace(tzinfo=pytz.utc), int(id)
+
+
+class PagePagination(Pagination):
+    """ Numbered pages that link to the next (older) page with a cursor so
+    visitors move on to keyset pages after the first one they land on,
+    unless ``PAGINATION_CURSORS`` is off. """
+    is_keyset = False
+
+    def __init__(self, query, page, per_page, total, items, columns=None):
+        super(PagePagination, self).__init__(query, page, per_page, total,
+                                             items)
+        self.columns = columns
+
+    def newer_url(self, endpoint, **values):
+        if self.has_prev:
+            return url_for(endpoint, page=self.prev_num, **values)
+
+    def older_url(self, endpoint, **values):
+        if not self.has_next:
+            return None
+        if (self.columns is None or
+                not current_app.config['PAGINATION_CURSORS']):
+            return url_for(endpoint, page=self.next_num, **values)
+        date_column, id_column = self.columns
+        last = self.items[-1]
+        cursor = encode_cursor(getattr(last, date_column.key),
+                               getattr(last, id_column.key))
+        return url_for(endpoint, before=cursor, **values)
+
+
+class KeysetPagination(object):
+    """ A page of items found by seeking past a ``(date, id)`` cursor rather
+    than skipping rows with OFFSET, so every page costs the same no matter
+    how far back it is. Cursors are taken from the first and last items
+    shown, which keeps "newer" and "older" links stable as items are added.
+    """
+    is_keyset = True
+
+    def __init__(self, items, columns, has_newer, has_older):
+        self.items = items
+        self.columns = columns
+        self.has_prev = has_newer
+        self.has_next = has_older
+
+    def cursor(self, item):
+        date_column, id_column = self.columns
+        return encode_cursor(getattr(item, date_column.key),
+                             getattr(item, id_column.key))
+
+    def newer_url(self, endpoint, **values):
+        if self.has_prev:
+            return url_for(endpoint, after=self.cursor(self.items[0]),
+                           **values)
+
+    def older_url(self, endpoint, **values):
+        if self.has_next:
+            return url_for(endpoint, before=self.cursor(self.items[-1]),
+                           **values)
+
+
+def keyset_paginate(query, columns, per_page, before=None, after=None):
+    """ Return the ``per_page`` items of ``query`` that come right before
+    (are older than) or right after (are newer than) a cursor. Items are
+    ordered newest first by ``columns``, a ``(date, id)`` pair. Aborts with
+    404 for malformed cursors or when a page is empty. """
+    date_column, id_column = columns
+
+    try:
+        cursor = decode_cursor(after or before)
+    except ValueError:
+        abort(404)
+
+    date, id = cursor
+    query = query.order_by(None)
+
+    if after is not None:
+        items = fetch(query.filter(or_(
+            date_column > date,
+            and_(date_column == date, id_column > id))).order_by(
+            date_column, id_column).limit(per_page + 1))
+        has_newer = len(items) > per_page
+        items = items[:per_page][::-1]
+        has_older = True
+    else:
+        items = fetch(query.filter(or_(
+            date_column < date,
+            and_(date_column == date, id_column < id))).order_by(
+            date_column.desc(), id_column.desc()).limit(per_page + 1))
+        has_older = len(items) > per_page
+        items = items[:per_page]
+        has_newer = True
+
+    if not items:
+        abort(404)
+
+    return KeysetPagination(items, columns, has_newer, has_older)
+
+
+def paginate(query, page, per_page, total=None, columns=None, before=None,
+             after=None):
+    """ Paginate ``query`` by cursor if ``before`` or ``after`` is given and
+    by page number otherwise. Numbered pages take their ``total`` from the
+    caller or count it, and both pages and totals come from the query cache
+    when ``query`` supports it. """
+    if before is not None or after is not None:
+        return keyset_paginate(query, columns, per_page, before, after)
+
+    if page < 1:
+        abort(404)
+
+    items = fetch(query.limit(per_page).offset((page - 1) * per_page))
+
+    if not items and page != 1:
+        abort(404)
+
+    if total is None:
+        if page == 1 and len(items) < per_page:
+            total = len(items)
+        else:
+            total = count(query)
+
+    return PagePagination(query, page, per_page, total, items, columns)
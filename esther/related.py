@@ -0,0 +1,185 @@
+from collections import Counter, defaultdict
+from itertools import izip
+
+from sqlalchemy import event, or_, select
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from esther.models import (Post, PostStatus, RelatedPost, RelatedPostUpdate,
+                           post_tags)
+from esther.search import tokenize
+from esther.utils import LRUCache
+
+NUM_RELATED_POSTS = 5
+# Keeps ``IN`` clauses under SQLite's limit on bound parameters
+MAX_IN_IDS = 500
+TERM_CACHE_SIZE = 8192
+CHANGED_POSTS_KEY = 'esther.related_changes'
+STALE_POSTS_KEY = 'esther.related_stale'
+RELATED_POST_ATTRIBUTES = ('status', 'title', 'body', 'tags')
+
+# Term counts keyed by post id and modification time, so incremental updates
+# only tokenize the posts that changed
+term_cache = LRUCache(TERM_CACHE_SIZE)
+
+
+def chunked(items, size=MAX_IN_IDS):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def count_terms(title, body):
+    return Counter(tokenize(title) + tokenize(body))
+
+
+def load_corpus(connection):
+    """ Build the corpus of published posts. Only posts that aren't in
+    ``term_cache`` are read in full. """
+    # Imports NumPy, which web processes only need once a post changes
+    from esther.similarity import Corpus
+
+    posts = Post.__table__
+    published = posts.c.status == PostStatus.published
+    versions = connection.execute(select([
+        posts.c.id, posts.c.modified
+    ]).where(published).order_by(posts.c.id)).fetchall()
+
+    term_counts = dict((post_id, term_cache.get((post_id, modified)))
+                       for post_id, modified in versions)
+    missing = [post_id for post_id, counts in term_counts.iteritems()
+               if counts is None]
+    for ids in chunked(missing):
+        for post_id, modified, title, body in connection.execute(select([
+                posts.c.id, posts.c.modified, posts.c.title, posts.c.body
+        ]).where(posts.c.id.in_(ids))):
+            counts = count_terms(title, body)
+            term_cache.set((post_id, modified), counts)
+            term_counts[post_id] = counts
+
+    tag_ids = connection.execute(select([
+        post_tags.c.post_id, post_tags.c.tag_id
+    ]).select_from(post_tags.join(posts)).where(published)).fetchall()
+
+    ids = [post_id for post_id, modified in versions]
+    return Corpus(ids, [term_counts[post_id] for post_id in ids], tag_ids)
+
+
+def save_related_posts(connection, corpus, post_ids):
+    """ Replace the related posts of ``post_ids``. Posts that aren't
+    published are left without any. """
+    table = RelatedPost.__table__
+    for ids in chunked(post_ids):
+        connection.execute(table.delete().where(table.c.post_id.in_(ids)))
+
+    rows = [corpus.positions[post_id] for post_id in post_ids
+            if post_id in corpus.positions]
+    top_related = corpus.top_related(rows, NUM_RELATED_POSTS)
+    values = [{'post_id': post_id, 'related_id': related_id, 'score': score}
+              for post_id, related in top_related
+              for related_id, score in related]
+    if values:
+        connection.execute(table.insert(), values)
+
+
+def rebuild_related_posts(connection):
+    """ Recompute the related posts of every post, which also covers the
+    queued updates. Returns the number of published posts. """
+    corpus = load_corpus(connection)
+    connection.execute(RelatedPost.__table__.delete())
+    connection.execute(RelatedPostUpdate.__table__.delete())
+    save_related_posts(connection, corpus, corpus.ids)
+    return len(corpus)
+
+
+def update_related_posts(connection, changed_ids, stale_ids=()):
+    """ Update the related posts once the posts in ``changed_ids`` were
+    added, edited or removed. Other posts are only recomputed if their list
+    could change: if they listed a changed post or if a changed post is now
+    more related to them than the last post they list. The scores of other
+    posts are kept even though document frequencies moved a little, until
+    the next rebuild. """
+    changed_ids = set(changed_ids)
+    stale = set(stale_ids) | changed_ids
+    corpus = load_corpus(connection)
+
+    table = RelatedPost.__table__
+    stored = defaultdict(list)
+    for post_id, related_id, score in connection.execute(select([
+            table.c.post_id, table.c.related_id, table.c.score])):
+        stored[post_id].append(score)
+        if related_id in changed_ids:
+            stale.add(post_id)
+
+    rows = [corpus.positions[post_id] for post_id in changed_ids
+            if post_id in corpus.positions]
+    if rows:
+        for post_id, best in izip(corpus.ids, corpus.best_scores(rows)):
+            scores = stored.get(post_id, [])
+            if best > 0 and (len(scores) < NUM_RELATED_POSTS or
+                             best > min(scores)):
+                stale.add(post_id)
+
+    save_related_posts(connection, corpus, stale)
+
+
+def queue_related_updates(connection, post_ids):
+    table = RelatedPostUpdate.__table__
+    connection.execute(table.insert(), [{'post_id': post_id}
+                                        for post_id in post_ids])
+
+
+def apply_related_updates(connection):
+    """ Update the related posts for the queued posts. Only the queue rows
+    read here are removed, so posts queued meanwhile wait for the next run.
+    Returns the number of posts that were queued. """
+    table = RelatedPostUpdate.__table__
+    rows = connection.execute(select([table.c.id,
+                                      table.c.post_id])).fetchall()
+    post_ids = set(post_id for row_id, post_id in rows)
+    if post_ids:
+        update_related_posts(connection, post_ids)
+    for ids in chunked(row_id for row_id, post_id in rows):
+        connection.execute(table.delete().where(table.c.id.in_(ids)))
+    return len(post_ids)
+
+
+### Keep related posts up to date
+
+
+def is_related_change(session, post):
+    return (post not in session.dirty or any(
+        get_history(post, attribute).has_changes()
+        for attribute in RELATED_POST_ATTRIBUTES))
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_related_changes(session, flush_context, instances):
+    changed = session.info.setdefault(CHANGED_POSTS_KEY, set())
+    for post in session.new | session.dirty | session.deleted:
+        if isinstance(post, Post) and is_related_change(session, post):
+            changed.add(post)
+
+    # Rows naming deleted posts have to go before the posts do
+    deleted_ids = [post.id for post in session.deleted
+                   if isinstance(post, Post)]
+    if deleted_ids:
+        table = RelatedPost.__table__
+        listed = or_(table.c.post_id.in_(deleted_ids),
+                     table.c.related_id.in_(deleted_ids))
+        stale = session.info.setdefault(STALE_POSTS_KEY, set())
+        stale.update(post_id for post_id, in session.execute(
+            select([table.c.post_id]).where(listed)))
+        session.execute(table.delete().where(listed))
+
+
+@event.listens_for(Session, 'after_flush')
+def queue_related_changes(session, flush_context):
+    """ Queue the changed posts, and those that listed a deleted post, in
+    the same transaction as the change so none is lost. Scoring them takes
+    the whole corpus, which doesn't belong in a request. """
+    changed = session.info.pop(CHANGED_POSTS_KEY, None) or ()
+    stale = session.info.pop(STALE_POSTS_KEY, ())
+    post_ids = set(post.id for post in changed) | set(stale)
+    if post_ids:
+        queue_related_updates(session.connection(), post_ids)
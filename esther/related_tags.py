@@ -0,0 +1,187 @@
+from collections import Counter, defaultdict
+import heapq
+from itertools import combinations
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from esther import db
+from esther.models import Post, PostStatus, Tag, post_tags
+
+PENDING_CHANGES_KEY = 'esther.related_tags_changes'
+REBUILD_KEY = 'esther.related_tags_rebuild'
+RELATED_TAG_POST_ATTRIBUTES = ('status', 'tags')
+
+
+class TagCooccurrence(object):
+    """ A sparse, symmetric matrix counting the published posts each pair of
+    tags share, stored as a ``Counter`` per tag. The tags of every post are
+    kept too so a post can be retagged or removed in place. """
+
+    def __init__(self):
+        self.rows = defaultdict(Counter)
+        self.post_tags = {}
+
+    def add(self, post_id, tag_ids):
+        """ Count the tags of ``post_id``, replacing the ones it had. """
+        self.remove(post_id)
+        tag_ids = frozenset(tag_ids)
+        for a, b in combinations(tag_ids, 2):
+            self.rows[a][b] += 1
+            self.rows[b][a] += 1
+        self.post_tags[post_id] = tag_ids
+
+    def remove(self, post_id):
+        tag_ids = self.post_tags.pop(post_id, None)
+        if tag_ids is None:
+            return
+        for a, b in combinations(tag_ids, 2):
+            for row, column in ((a, b), (b, a)):
+                self.rows[row][column] -= 1
+                if not self.rows[row][column]:
+                    del self.rows[row][column]
+                    if not self.rows[row]:
+                        del self.rows[row]
+
+    def related(self, tag_ids, num):
+        """ Return the ids of up to ``num`` tags most often used along with
+        ``tag_ids``, most common first. """
+        scores = Counter()
+        for tag_id in tag_ids:
+            scores.update(self.rows.get(tag_id, {}))
+        for tag_id in tag_ids:
+            scores.pop(tag_id, None)
+        best = heapq.nlargest(num, scores.iteritems(),
+                              key=lambda item: (item[1], -item[0]))
+        return [tag_id for tag_id, count in best]
+
+
+class RelatedTagsState(object):
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.matrix = None
+        self.built = None
+        self.lock = threading.Lock()
+
+
+class RelatedTags(object):
+    """ Tags commonly used together, served from a co-occurrence matrix kept
+    in memory. The process that commits a change applies it to its matrix.
+    Other processes rebuild theirs once it is older than
+    ``QUERY_CACHE_TIMEOUT``, the same delay the query cache allows. """
+
+    def init_app(self, app):
+        app.extensions['related_tags'] = RelatedTagsState(
+            app.config['QUERY_CACHE_TIMEOUT'])
+
+    @property
+    def state(self):
+        return current_app.extensions['related_tags']
+
+    def rebuild(self):
+        posts = Post.__table__
+        tags_by_post = defaultdict(list)
+        for post_id, tag_id in db.session.execute(select([
+                post_tags.c.post_id, post_tags.c.tag_id
+        ]).select_from(post_tags.join(posts)).where(
+                posts.c.status == PostStatus.published)):
+            tags_by_post[post_id].append(tag_id)
+
+        matrix = TagCooccurrence()
+        for post_id, tag_ids in tags_by_post.iteritems():
+            matrix.add(post_id, tag_ids)
+        with self.state.lock:
+            self.state.matrix, self.state.built = matrix, time.time()
+        return matrix
+
+    def get_matrix(self):
+        state = self.state
+        with state.lock:
+            matrix = state.matrix
+            if matrix is not None and (state.timeout is None or
+                                       time.time() - state.built <
+                                       state.timeout):
+                return matrix
+        return self.rebuild()
+
+    def related(self, tags, num=None):
+        """ Return up to ``num`` tags most often used along with ``tags``,
+        most common first. """
+        if num is None:
+            num = current_app.config['NUM_RELATED_TAGS']
+        matrix = self.get_matrix()
+        # Committed changes are applied to the matrix in place
+        with self.state.lock:
+            tag_ids = matrix.related([tag.id for tag in tags], num)
+        if not tag_ids:
+            return []
+        found = dict((tag.id, tag) for tag in
+                     Tag.query.filter(Tag.id.in_(tag_ids)).cached())
+        return [found[tag_id] for tag_id in tag_ids if tag_id in found]
+
+    def apply_changes(self, changes):
+        """ Apply ``changes``, a dict mapping post ids to their tag ids or
+        ``None`` for posts that are no longer published. If ``changes`` is
+        ``None`` the matrix is rebuilt when it is next used. """
+        with self.state.lock:
+            matrix = self.state.matrix
+            if matrix is None:
+                return
+            if changes is None:
+                self.state.matrix = None
+                return
+            for post_id, tag_ids in changes.iteritems():
+                if tag_ids is None:
+                    matrix.remove(post_id)
+                else:
+                    matrix.add(post_id, tag_ids)
+
+
+related_tags = RelatedTags()
+
+
+### Keep the matrix up to date
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_related_tags_changes(session, flush_context):
+    changes = session.info.setdefault(PENDING_CHANGES_KEY, {})
+    for instance in session.deleted:
+        if isinstance(instance, Post):
+            changes[instance.id] = None
+        elif isinstance(instance, Tag):
+            # Deleting a tag removes it from posts that aren't in the session
+            session.info[REBUILD_KEY] = True
+
+    for post in session.new | session.dirty:
+        if not isinstance(post, Post):
+            continue
+        if post in session.dirty and not any(
+                get_history(post, attribute).has_changes()
+                for attribute in RELATED_TAG_POST_ATTRIBUTES):
+            continue
+        if post.status == PostStatus.published:
+            changes[post.id] = [tag.id for tag in post.tags]
+        else:
+            changes[post.id] = None
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_related_tags_changes(session):
+    changes = session.info.pop(PENDING_CHANGES_KEY, None)
+    if session.info.pop(REBUILD_KEY, False):
+        changes = None
+    elif not changes:
+        return
+    if has_app_context():
+        related_tags.apply_changes(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_related_tags_changes(session):
+    session.info.pop(PENDING_CHANGES_KEY, None)
+    session.info.pop(REBUILD_KEY, None)
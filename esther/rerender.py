@@ -0,0 +1,100 @@
+from __future__ import print_function
+
+from multiprocessing import Pool
+import time
+
+from flask import current_app
+from sqlalchemy import bindparam, or_
+
+from esther import db, markdown
+from esther.models import Post
+
+
+def init_worker(app):
+    # Workers are forked from the command's process so they share its app
+    app.app_context().push()
+
+
+def render_post(row):
+    post_id, body = row
+    # A transient post is never added to the session
+    post = Post(body=body)
+    post.render_html()
+    return {
+        'post_id': post_id,
+        'body_html': post.body_html,
+        'preview_html': post.preview_html,
+        'preview_offset': post.preview_offset,
+        'html_fingerprint': post.html_fingerprint,
+    }
+
+
+def iter_stale_chunks(chunk_size):
+    """ Yield chunks of ``(id, body)`` rows whose stored HTML is stale. Rows
+    are read in ``id`` order so an interrupted run picks up where it left
+    off and never sees the same post twice. """
+    fingerprint = markdown.fingerprint()
+    stale = or_(Post.html_fingerprint == None,
+                Post.html_fingerprint != fingerprint)
+    last_id = 0
+
+    while True:
+        rows = db.session.query(Post.id, Post.body).filter(
+            stale, Post.id > last_id).order_by(Post.id).limit(chunk_size).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def save_chunk(results):
+    # ``modified`` moves too since the HTML is exported with the post
+    posts = Post.__table__
+    update = posts.update().where(
+        posts.c.id == bindparam('post_id')).values(
+        body_html=bindparam('body_html'),
+        preview_html=bindparam('preview_html'),
+        preview_offset=bindparam('preview_offset'),
+        html_fingerprint=bindparam('html_fingerprint'))
+    db.session.execute(update, results)
+    db.session.commit()
+
+
+def rerender_posts(processes=None, chunk_size=100):
+    """ Re-render every post with stale HTML across a pool of ``processes``
+    workers (one per CPU by default, no pool if 0). The next chunk is
+    rendered while the previous one is written, one batched UPDATE per
+    chunk, and each chunk is committed so the work survives interruption.
+    """
+    pool = None
+    if processes != 0:
+        app = current_app._get_current_object()
+        pool = Pool(processes, initializer=init_worker, initargs=(app,))
+
+    num_rendered = 0
+    start = time.time()
+    pending = None
+
+    try:
+        for rows in iter_stale_chunks(chunk_size):
+            if pool is None:
+                save_chunk(map(render_post, rows))
+            else:
+                result = pool.map_async(render_post, rows)
+                if pending is not None:
+                    save_chunk(pending.get())
+                pending = result
+
+            num_rendered += len(rows)
+            elapsed = time.time() - start
+            print(u'Rendered {} posts ({:.1f} posts/s)'.format(
+                num_rendered, num_rendered / elapsed if elapsed else 0))
+
+        if pending is not None:
+            save_chunk(pending.get())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return num_rendered
@@ -0,0 +1,320 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+import cPickle as pickle
+import heapq
+from itertools import izip
+import math
+from operator import itemgetter
+import os
+import re
+import threading
+
+from flask import current_app, has_app_context
+from jinja2 import Markup, escape
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from esther.models import Post, PostStatus
+
+INDEX_VERSION = 1
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+# Term frequencies are weighted by the field a term appears in
+TITLE_WEIGHT = 3
+TAG_WEIGHT = 2
+BODY_WEIGHT = 1
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+SNIPPET_WORDS = 30
+PENDING_CHANGES_KEY = 'esther.search_changes'
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or u'').lower())
+
+
+def post_fields(post):
+    return [(post.title, TITLE_WEIGHT), (post.body, BODY_WEIGHT),
+            (u' '.join(tag.name for tag in post.tags), TAG_WEIGHT)]
+
+
+class InvertedIndex(object):
+    """ Maps terms to posting lists of document ids and weighted term
+    frequencies, each kept in an ``array`` sorted by id. The terms of each
+    document are kept too, which is what makes removing a document cheap.
+    Posting lists are replaced rather than changed, so a ``copy`` can be
+    updated while other threads search the original. """
+
+    def __init__(self):
+        self.postings = {}
+        self.doc_terms = {}
+        self.doc_lengths = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def copy(self):
+        """ Return an index sharing the posting lists of this one. """
+        index = type(self)()
+        index.postings = self.postings.copy()
+        index.doc_terms = self.doc_terms.copy()
+        index.doc_lengths = self.doc_lengths.copy()
+        index.total_length = self.total_length
+        return index
+
+    def add(self, doc_id, fields):
+        """ Index ``fields``, a list of ``(text, weight)`` pairs, under
+        ``doc_id``, replacing the document if it is already indexed. """
+        self.remove(doc_id)
+        terms = Counter()
+        for text, weight in fields:
+            for token in tokenize(text):
+                terms[token] += weight
+
+        for term, frequency in terms.iteritems():
+            ids, frequencies = self.postings.get(
+                term, (array('I'), array('I')))
+            i = bisect_left(ids, doc_id)
+            self.postings[term] = (
+                ids[:i] + array('I', [doc_id]) + ids[i:],
+                frequencies[:i] + array('I', [frequency]) + frequencies[i:])
+
+        length = sum(terms.itervalues())
+        self.doc_terms[doc_id] = terms.keys()
+        self.doc_lengths[doc_id] = length
+        self.total_length += length
+
+    def remove(self, doc_id):
+        terms = self.doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            ids, frequencies = self.postings[term]
+            if len(ids) == 1:
+                del self.postings[term]
+                continue
+            i = bisect_left(ids, doc_id)
+            self.postings[term] = (ids[:i] + ids[i + 1:],
+                                   frequencies[:i] + frequencies[i + 1:])
+        self.total_length -= self.doc_lengths.pop(doc_id)
+
+    def search(self, query, limit=20):
+        """ Return up to ``limit`` ``(doc_id, score)`` pairs for the
+        documents matching any term of ``query``, best first by BM25. """
+        if not self.doc_lengths:
+            return []
+
+        num_docs = len(self.doc_lengths)
+        average_length = self.total_length / float(num_docs)
+        scores = defaultdict(float)
+
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            ids, frequencies = posting
+            idf = math.log(1 + (num_docs - len(ids) + 0.5) /
+                           (len(ids) + 0.5))
+            for doc_id, frequency in izip(ids, frequencies):
+                norm = K1 * (1 - B + B * self.doc_lengths[doc_id] /
+                             average_length)
+                scores[doc_id] += (idf * frequency * (K1 + 1) /
+                                   (frequency + norm))
+
+        return heapq.nlargest(limit, scores.iteritems(), key=itemgetter(1))
+
+    def save(self, path):
+        """ Write the index to ``path``. Posting lists are stored as raw
+        array bytes, so the file loads quickly but only on machines with the
+        same word size. """
+        data = {
+            'version': INDEX_VERSION,
+            'postings': dict(
+                (term, (ids.tostring(), frequencies.tostring()))
+                for term, (ids, frequencies) in self.postings.iteritems()),
+            'doc_lengths': self.doc_lengths,
+        }
+        temp_path = u'{}.tmp'.format(path)
+        with open(temp_path, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """ Return the index saved at ``path`` or ``None`` if it is missing
+        or was written by another version of the index. """
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        if data.get('version') != INDEX_VERSION:
+            return None
+
+        index = cls()
+        doc_terms = defaultdict(list)
+        for term, (ids_data, frequencies_data) in \
+                data['postings'].iteritems():
+            ids = array('I')
+            ids.fromstring(ids_data)
+            frequencies = array('I')
+            frequencies.fromstring(frequencies_data)
+            index.postings[term] = (ids, frequencies)
+            for doc_id in ids:
+                doc_terms[doc_id].append(term)
+        index.doc_terms = dict(doc_terms)
+        index.doc_lengths = data['doc_lengths']
+        index.total_length = sum(index.doc_lengths.itervalues())
+        return index
+
+
+class SearchState(object):
+    def __init__(self, path):
+        self.path = path
+        self.index = None
+        self.mtime = None
+        self.lock = threading.Lock()
+
+
+class PostSearch(object):
+    """ Full-text search over published posts. Every process keeps the
+    index in memory and the process that commits a change saves it to
+    ``SEARCH_INDEX_PATH``, where the others pick it up before their next
+    search. """
+
+    def init_app(self, app):
+        path = app.config['SEARCH_INDEX_PATH']
+        if path is not None:
+            path = os.path.join(app.instance_path, path)
+        app.extensions['search'] = SearchState(path)
+
+    @property
+    def state(self):
+        return current_app.extensions['search']
+
+    def saved_mtime(self):
+        try:
+            return os.path.getmtime(self.state.path)
+        except (OSError, TypeError):
+            return None
+
+    def load_saved(self):
+        """ Load the saved index if it is newer than the one in memory. """
+        state = self.state
+        mtime = self.saved_mtime()
+        if mtime is not None and mtime != state.mtime:
+            index = InvertedIndex.load(state.path)
+            if index is not None:
+                state.index, state.mtime = index, mtime
+
+    def save(self):
+        state = self.state
+        if state.path is not None:
+            state.index.save(state.path)
+            state.mtime = self.saved_mtime()
+
+    def rebuild(self):
+        index = InvertedIndex()
+        posts = Post.query.options(*Post.load_options('full')).filter_by(
+            status=PostStatus.published)
+        for post in posts:
+            index.add(post.id, post_fields(post))
+        with self.state.lock:
+            self.state.index = index
+            self.save()
+        return index
+
+    def get_index(self):
+        with self.state.lock:
+            self.load_saved()
+            index = self.state.index
+        return index if index is not None else self.rebuild()
+
+    def apply_changes(self, changes):
+        """ Apply ``changes``, a dict mapping post ids to their fields or
+        ``None`` for posts that are no longer published. Runs after commit
+        when the database can't be queried, so changes are only applied to
+        an index that is in memory or saved. An index built later includes
+        them anyway. Searches still running use the index as it was. """
+        with self.state.lock:
+            self.load_saved()
+            if self.state.index is None:
+                return
+            index = self.state.index.copy()
+            for post_id, fields in changes.iteritems():
+                if fields is None:
+                    index.remove(post_id)
+                else:
+                    index.add(post_id, fields)
+            self.state.index = index
+            self.save()
+
+    def search(self, query, limit=20):
+        """ Return up to ``limit`` ``(post, snippet)`` pairs for the
+        published posts best matching ``query``. """
+        hits = self.get_index().search(query, limit)
+        if not hits:
+            return []
+        posts = Post.query.options(*Post.load_options('full')).filter(
+            Post.id.in_([post_id for post_id, score in hits]),
+            Post.status == PostStatus.published)
+        posts = dict((post.id, post) for post in posts)
+        terms = set(tokenize(query))
+        return [(posts[post_id], make_snippet(posts[post_id].body, terms))
+                for post_id, score in hits if post_id in posts]
+
+
+post_search = PostSearch()
+
+
+def make_snippet(text, terms, num_words=SNIPPET_WORDS):
+    """ Return an escaped excerpt of ``text`` around the first word matching
+    one of ``terms``, with every matching word wrapped in ``<mark>``. """
+    words = (text or u'').split()
+
+    def matches(word):
+        return not terms.isdisjoint(tokenize(word))
+
+    first = next((i for i, word in enumerate(words) if matches(word)), 0)
+    start = max(0, first - num_words // 3)
+    end = start + num_words
+
+    parts = [Markup(u'<mark>{}</mark>').format(word) if matches(word)
+             else escape(word) for word in words[start:end]]
+    if start > 0:
+        parts.insert(0, Markup(u'&hellip;'))
+    if end < len(words):
+        parts.append(Markup(u'&hellip;'))
+    return Markup(u' ').join(parts)
+
+
+### Keep the index up to date
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_search_changes(session, flush_context):
+    # Posts are read now since they can't be loaded once the commit is over
+    changes = session.info.setdefault(PENDING_CHANGES_KEY, {})
+    for post in session.new | session.dirty:
+        if isinstance(post, Post) and session.is_modified(post):
+            if post.status == PostStatus.published:
+                changes[post.id] = post_fields(post)
+            else:
+                changes[post.id] = None
+    for post in session.deleted:
+        if isinstance(post, Post):
+            changes[post.id] = None
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_search_changes(session):
+    changes = session.info.pop(PENDING_CHANGES_KEY, None)
+    if changes and has_app_context():
+        post_search.apply_changes(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_search_changes(session):
+    session.info.pop(PENDING_CHANGES_KEY, None)
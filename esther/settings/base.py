@@ -6,5 +6,17 @@ NUM_POSTS_PER_LIST_PAGE = 10
 NUM_POSTS_PER_INDEX_PAGE = 6
 NUM_TAGS_PER_LIST_PAGE = 10
 NUM_POSTS_PER_TAG_PAGE = 10
+NUM_RELATED_TAGS = 8
 POST_BODY_PREVIEW_SEPARATOR = u'<!-- preview -->'
 POST_CONTINUE_LINK_FRAGMENT = u'continue'
+PAGINATION_CURSORS = True
+QUERY_CACHE_BACKEND = 'esther.cache.LRUBackend'
+QUERY_CACHE_OPTIONS = {'size': 1024}
+QUERY_CACHE_TIMEOUT = 300
+PAGE_CACHE_ENABLED = True
+FREEZE_OUTPUT_DIR = None
+# Relative to the instance folder. ``None`` keeps the index in memory only.
+SEARCH_INDEX_PATH = 'search-index.pickle'
+# Relative to the instance folder. Built by ``run.py compile_templates`` and
+# only used once it exists.
+TEMPLATE_BYTECODE_CACHE_DIR = 'template-cache'
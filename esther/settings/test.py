@@ -4,3 +4,5 @@ LOGIN_DISABLED = False
 BCRYPT_LOG_ROUNDS = 4
 SQLALCHEMY_DATABASE_URI = 'sqlite:///'
 WTF_CSRF_ENABLED = False
+SEARCH_INDEX_PATH = None
+TEMPLATE_BYTECODE_CACHE_DIR = None
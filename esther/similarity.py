@@ -0,0 +1,214 @@
+import numpy as np
+
+# Only the most common terms get a column of the TF-IDF matrix, which bounds
+# its size. Terms used by a single post can't make two posts similar, so they
+# only count towards the length of its vector.
+MAX_TERMS = 4096
+# The most common of them are kept in a dense matrix instead: they are in
+# so many posts that multiplying their columns through BLAS is faster than
+# multiplying only their nonzero entries
+DENSE_TERMS = 256
+# Share of the score given to tag overlap, the rest is text similarity
+TAG_WEIGHT = 0.3
+# Rows of the similarity matrix computed at once
+BLOCK_SIZE = 256
+# Products of nonzero entries, and cells of the similarity matrix, computed
+# at once. Blocks of rows are cut short to stay under it.
+MAX_PRODUCTS = 1 << 22
+
+
+def expand(starts, lengths):
+    """ Return the indexes of the slices of ``lengths`` items beginning at
+    ``starts``, one slice after the other. """
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1] if len(ends) else 0) - np.repeat(
+        ends - lengths - starts, lengths)
+
+
+class SparseRows(object):
+    """ A matrix of ``shape`` holding ``values`` at ``rows`` and ``columns``
+    and zero everywhere else. Only the nonzero entries are stored, as the
+    columns and values of each row one row after the other. """
+
+    def __init__(self, shape, rows, columns, values):
+        self.shape = shape
+        order = np.argsort(rows, kind='mergesort')
+        self.indptr = np.zeros(shape[0] + 1, dtype=np.intp)
+        np.cumsum(np.bincount(rows, minlength=shape[0]),
+                  out=self.indptr[1:])
+        self.columns = np.asarray(columns, dtype=np.intp)[order]
+        self.values = np.asarray(values, dtype=np.float32)[order]
+
+    def row_lengths(self):
+        return np.diff(self.indptr)
+
+    def row_indexes(self):
+        return np.repeat(np.arange(self.shape[0]), self.row_lengths())
+
+    def transpose(self):
+        return SparseRows(self.shape[::-1], self.columns, self.row_indexes(),
+                          self.values)
+
+    def toarray(self):
+        array = np.zeros(self.shape, dtype=np.float32)
+        array[self.row_indexes(), self.columns] = self.values
+        return array
+
+    def entries(self, rows):
+        """ Return the position in ``rows``, the column and the value of the
+        nonzero entries of ``rows``. """
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        index = expand(starts, lengths)
+        return (np.repeat(np.arange(len(rows)), lengths),
+                self.columns[index], self.values[index])
+
+    def dot_rows(self, rows, transposed):
+        """ Return the dense product of ``rows`` of this matrix with the
+        transpose of another, given as ``transposed``. Only products of
+        nonzero entries are computed. """
+        num_columns = transposed.shape[1]
+        positions, columns, values = self.entries(rows)
+        entries, others, other_values = transposed.entries(columns)
+        cells = positions[entries] * num_columns + others
+        products = np.bincount(cells, values[entries] * other_values,
+                               minlength=len(rows) * num_columns)
+        return products.reshape(len(rows), num_columns).astype(np.float32)
+
+
+class Corpus(object):
+    """ The TF-IDF vectors and tags of the published posts. Vectors are the
+    L2 normalized rows of ``common_vectors`` and ``vectors`` side by side,
+    so the cosine similarity of two posts is the dot product of their rows.
+    Apart from the common terms both are sparse, so memory grows with the
+    terms and tags posts use rather than with the size of the vocabulary.
+    """
+
+    def __init__(self, ids, term_counts, tag_ids):
+        self.ids = ids
+        self.positions = dict((post_id, i) for i, post_id in enumerate(ids))
+        self.common_vectors, self.vectors = self.vectorize(term_counts)
+        self.tags = self.tag_matrix(tag_ids)
+        self.vectors_by_term = self.vectors.transpose()
+        self.posts_by_tag = self.tags.transpose()
+        self.num_tags = self.tags.row_lengths().astype(np.float32)
+
+        # Products each post needs to be scored against every post
+        self.costs = len(ids) + np.bincount(
+            self.vectors.row_indexes(),
+            self.vectors_by_term.row_lengths()[self.vectors.columns],
+            minlength=len(ids)) + np.bincount(
+            self.tags.row_indexes(),
+            self.posts_by_tag.row_lengths()[self.tags.columns],
+            minlength=len(ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def vectorize(term_counts):
+        num_docs = len(term_counts)
+        vocabulary = {}
+        rows, terms, counts = [], [], []
+        for row, post_counts in enumerate(term_counts):
+            rows.extend([row] * len(post_counts))
+            terms.extend(vocabulary.setdefault(term, len(vocabulary))
+                         for term in post_counts)
+            counts.extend(post_counts.itervalues())
+
+        rows = np.array(rows, dtype=np.intp)
+        terms = np.array(terms, dtype=np.intp)
+        counts = np.array(counts, dtype=np.float32)
+
+        # Sublinear term frequencies and smoothed inverse document
+        # frequencies
+        frequencies = np.bincount(terms, minlength=len(vocabulary))
+        idf = np.log((1.0 + num_docs) / (1.0 + frequencies)) + 1
+        weights = (1 + np.log(counts)) * idf[terms]
+        norms = np.sqrt(np.bincount(rows, weights * weights,
+                                    minlength=num_docs))
+
+        shared = np.flatnonzero(frequencies > 1)
+        shared = shared[np.argsort(-frequencies[shared],
+                                   kind='mergesort')[:MAX_TERMS]]
+        columns = np.empty(len(vocabulary), dtype=np.intp)
+        columns.fill(-1)
+        columns[shared] = np.arange(len(shared))
+        columns = columns[terms]
+        weights /= norms[rows]
+
+        num_common = min(len(shared), DENSE_TERMS)
+        common = np.zeros((num_docs, num_common), dtype=np.float32)
+        dense = (columns >= 0) & (columns < num_common)
+        common[rows[dense], columns[dense]] = weights[dense]
+        sparse = columns >= num_common
+        return common, SparseRows(
+            (num_docs, len(shared) - num_common), rows[sparse],
+            columns[sparse] - num_common, weights[sparse])
+
+    def tag_matrix(self, tag_ids):
+        columns = {}
+        pairs = set((self.positions[post_id], columns.setdefault(
+            tag_id, len(columns))) for post_id, tag_id in tag_ids
+            if post_id in self.positions)
+        rows = [row for row, column in pairs]
+        return SparseRows((len(self.ids), len(columns)),
+                          np.array(rows, dtype=np.intp),
+                          [column for row, column in pairs],
+                          np.ones(len(pairs), dtype=np.float32))
+
+    def blocks(self, rows):
+        """ Split ``rows`` into blocks of up to ``BLOCK_SIZE`` rows whose
+        scores take up to ``MAX_PRODUCTS`` products, or a single row. """
+        rows = np.asarray(rows, dtype=np.intp)
+        start = 0
+        while start < len(rows):
+            end = start + 1
+            total = self.costs[rows[start]]
+            while (end < len(rows) and end - start < BLOCK_SIZE and
+                   total + self.costs[rows[end]] <= MAX_PRODUCTS):
+                total += self.costs[rows[end]]
+                end += 1
+            yield rows[start:end]
+            start = end
+
+    def similarities(self, rows):
+        """ Return the scores of the posts at ``rows`` against every post:
+        the cosine similarity of their text combined with the Jaccard index
+        of their tags. A post's score against itself is 0. """
+        rows = np.asarray(rows, dtype=np.intp)
+        text = self.common_vectors[rows].dot(self.common_vectors.T)
+        text += self.vectors.dot_rows(rows, self.vectors_by_term)
+        shared = self.tags.dot_rows(rows, self.posts_by_tag)
+        union = self.num_tags[rows][:, np.newaxis] + self.num_tags - shared
+        overlap = shared / np.maximum(union, 1)
+        scores = (1 - TAG_WEIGHT) * text + TAG_WEIGHT * overlap
+        scores[np.arange(len(rows)), rows] = 0
+        return scores
+
+    def best_scores(self, rows):
+        """ Return the best score of any post at ``rows`` against each
+        post. """
+        best = np.zeros(len(self.ids), dtype=np.float32)
+        for block in self.blocks(rows):
+            scores = self.similarities(block)
+            np.maximum(best, scores.max(axis=0), out=best)
+        return best
+
+    def top_related(self, rows, num):
+        """ Yield ``(post_id, [(related_id, score), ...])`` with the ``num``
+        most related posts of each post at ``rows``, a block of rows at a
+        time. """
+        num = min(num, len(self.ids) - 1)
+        for block in self.blocks(rows):
+            scores = self.similarities(block)
+            if num > 0:
+                best = np.argpartition(-scores, num - 1, axis=1)[:, :num]
+            for i, row in enumerate(block):
+                related = []
+                if num > 0:
+                    related = sorted(
+                        (-float(scores[i, col]), self.ids[col])
+                        for col in best[i] if scores[i, col] > 0)
+                yield self.ids[row], [(related_id, -score)
+                                      for score, related_id in related]
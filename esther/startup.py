@@ -0,0 +1,115 @@
+""" Reports what starting Esther costs, module by module. Run as a script
+(``run.py profile_startup`` does) so the timing hook is installed before
+anything is imported. """
+from __future__ import print_function
+
+from collections import defaultdict
+import imp
+import os
+import pkgutil
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TimedLoader(pkgutil.ImpLoader):
+    """ Answers questions about a module like the regular loader, which
+    Flask asks to find the instance folder, but loads it through the
+    timer. """
+
+    def __init__(self, timer, fullname, module_file, pathname, description):
+        pkgutil.ImpLoader.__init__(self, fullname, module_file, pathname,
+                                   description)
+        self.timer = timer
+
+    def load_module(self, fullname):
+        return self.timer.load_module(fullname)
+
+
+class ImportTimer(object):
+    """ A meta path hook timing every module imported after it is installed.
+    Modules are loaded by the regular import machinery, the hook only wraps
+    it to record each module's total time and its own time, which leaves out
+    the modules it imports. """
+
+    def __init__(self):
+        self.loading = set()
+        self.children = []
+        self.timings = []
+
+    def find_module(self, fullname, path=None):
+        if fullname in self.loading:
+            return None
+        try:
+            module_file, pathname, description = imp.find_module(
+                fullname.rpartition('.')[2], path)
+        except ImportError:
+            return None
+        if module_file is not None:
+            module_file.close()
+        return TimedLoader(self, fullname, module_file, pathname,
+                           description)
+
+    def load_module(self, fullname):
+        self.loading.add(fullname)
+        self.children.append(0)
+        start = time.time()
+        try:
+            __import__(fullname)
+        finally:
+            elapsed = time.time() - start
+            own = elapsed - self.children.pop()
+            if self.children:
+                self.children[-1] += elapsed
+            self.loading.discard(fullname)
+        self.timings.append((fullname, elapsed, own))
+        return sys.modules[fullname]
+
+
+def report(name, seconds):
+    print(u'{:<40} {:>9.1f} ms'.format(name, seconds * 1000))
+
+
+def profile(target, num_modules):
+    timer = ImportTimer()
+    sys.meta_path.insert(0, timer)
+    # Replaces this script's directory, whose modules would shadow others
+    sys.path[0] = ROOT_DIR
+    start = time.time()
+
+    if target == 'app':
+        from esther import create_app
+        imported = time.time()
+        create_app()
+        report('import esther', imported - start)
+        report('create_app()', time.time() - imported)
+    elif target == 'cli':
+        # Importing ``run`` creates the app and the manager
+        import run
+        report('import run', time.time() - start)
+    else:
+        print(u'Invalid target: "{}"'.format(target))
+        sys.exit(1)
+
+    sys.meta_path.remove(timer)
+    packages = defaultdict(float)
+    for name, elapsed, own in timer.timings:
+        packages[name.partition('.')[0]] += own
+    print()
+    print(u'{:<40} {:>12}'.format(u'package', u'own'))
+    for name, own in sorted(packages.items(),
+                            key=lambda package: -package[1])[:num_modules]:
+        report(name, own)
+
+    print()
+    print(u'{:<40} {:>12} {:>12}'.format(u'module', u'total', u'own'))
+    by_own_time = sorted(timer.timings, key=lambda timing: -timing[2])
+    for name, elapsed, own in by_own_time[:num_modules]:
+        print(u'{:<40} {:>9.1f} ms {:>9.1f} ms'.format(
+            name, elapsed * 1000, own * 1000))
+    print(u'{} modules imported'.format(len(timer.timings)))
+
+
+if __name__ == '__main__':
+    profile(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 25)
@@ -0,0 +1,59 @@
+/* global $ */
+(function() {
+  'use strict';
+
+  function tagNames(value) {
+    return $.map(value.split(','), function(name) {
+      name = $.trim(name);
+      return name ? name : null;
+    });
+  }
+
+  function tagSuggestions(field, container) {
+    var $field = $('#' + field);
+    var $container = $('#' + container);
+    var timeout;
+
+    function render(names) {
+      $container.empty();
+      if (!names.length) {
+        return;
+      }
+      $container.append('Often used with: ');
+      $.each(names, function(i, name) {
+        $('<a href="#"></a>').text(name).data('tag', name).appendTo($container);
+        if (i < names.length - 1) {
+          $container.append(', ');
+        }
+      });
+    }
+
+    function update() {
+      var names = tagNames($field.val());
+      if (!names.length) {
+        render([]);
+        return;
+      }
+      $.getJSON($container.data('url'), {tags: names.join(',')}, function(data) {
+        render(data.tags);
+      });
+    }
+
+    $container.on('click', 'a', function(event) {
+      var names = tagNames($field.val());
+      event.preventDefault();
+      names.push($(this).data('tag'));
+      $field.val(names.join(', '));
+      update();
+    });
+
+    $field.on('input', function() {
+      clearTimeout(timeout);
+      timeout = setTimeout(update, 300);
+    });
+
+    update();
+  }
+
+  tagSuggestions('tags', 'tag-suggestions');
+})();
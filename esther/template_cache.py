@@ -0,0 +1,42 @@
+import os
+
+from jinja2 import FileSystemBytecodeCache
+
+
+def bytecode_cache_dir(app):
+    """ Return the directory holding compiled templates or ``None`` if the
+    bytecode cache is disabled. """
+    directory = app.config['TEMPLATE_BYTECODE_CACHE_DIR']
+    if directory is not None:
+        return os.path.join(app.instance_path, directory)
+
+
+def init_app(app):
+    """ Load compiled templates from the bytecode cache if it was built.
+    Must run before ``app.jinja_env`` is first used. """
+    directory = bytecode_cache_dir(app)
+    if directory is not None and os.path.isdir(directory):
+        app.jinja_options = dict(app.jinja_options,
+                                 bytecode_cache=FileSystemBytecodeCache(
+                                     directory))
+
+
+def compile_templates(app):
+    """ Compile every template of ``app`` into its bytecode cache, replacing
+    what it held. Returns the number of templates. Templates edited later
+    are noticed by their checksum and compiled again when first used. """
+    directory = bytecode_cache_dir(app)
+    if directory is None:
+        raise ValueError(u'TEMPLATE_BYTECODE_CACHE_DIR is not set')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    cache = FileSystemBytecodeCache(directory)
+    cache.clear()
+    # Shares the app's loader and filters but not its in-memory cache, which
+    # would serve templates without compiling them
+    env = app.jinja_env.overlay(bytecode_cache=cache, cache_size=0)
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    return len(names)
@@ -1,3 +1,4 @@
+from flask.ext.sqlalchemy import get_debug_queries
 from flask.ext.testing import TestCase
 
 from esther import create_app, db
@@ -22,3 +23,10 @@ class PageMixin(object):
         response = self.client.get(url)
         self.assert_200(response)
         self.assert_template_used(template)
+
+
+class QueryCountMixin(object):
+    def count_queries(self, url):
+        num_queries = len(get_debug_queries())
+        self.assert_200(self.client.get(url))
+        return len(get_debug_queries()) - num_queries
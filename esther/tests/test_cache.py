@@ -0,0 +1,122 @@
+import datetime
+
+from flask.ext.sqlalchemy import get_debug_queries
+import pytz
+
+from esther import db
+from esther.cache import LRUBackend, query_cache
+from esther.models import Post, PostStatus, Tag, User
+from esther.tests.helpers import EstherDBTestCase, EstherTestCase
+
+
+class LRUBackendTests(EstherTestCase):
+    def test_get_and_set(self):
+        backend = LRUBackend(size=2)
+        backend.set('a', 1)
+        self.assertEqual(backend.get('a'), 1)
+        self.assertEqual(backend.get('b'), None)
+
+    def test_timeout(self):
+        backend = LRUBackend()
+        backend.set('a', 1, timeout=-1)
+        self.assertEqual(backend.get('a'), None)
+
+
+class QueryCacheTests(EstherTestCase):
+    def test_get_or_create(self):
+        calls = []
+        creator = lambda: calls.append(1) or len(calls)
+        self.assertEqual(query_cache.get_or_create('key', creator), 1)
+        self.assertEqual(query_cache.get_or_create('key', creator), 1)
+        self.assertEqual(query_cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_invalidate_dependent_tables_only(self):
+        query_cache.get_or_create('posts', lambda: 1, depends_on=['posts'])
+        query_cache.get_or_create('users', lambda: 1, depends_on=['users'])
+        query_cache.invalidate(['posts'])
+        self.assertEqual(
+            query_cache.get_or_create('posts', lambda: 2, ['posts']), 2)
+        self.assertEqual(
+            query_cache.get_or_create('users', lambda: 2, ['users']), 1)
+
+    def test_lost_generation(self):
+        query_cache.get_or_create('key', lambda: 1, depends_on=['posts'])
+        query_cache.state.backend.delete('generation:posts')
+        self.assertEqual(
+            query_cache.get_or_create('key', lambda: 2, ['posts']), 2)
+
+    def test_content_changed_moves_forward(self):
+        past = datetime.datetime(2000, 1, 1, tzinfo=pytz.utc)
+        future = datetime.datetime(2100, 1, 1, tzinfo=pytz.utc)
+        backend = query_cache.state.backend
+        backend.set('content_changed', past)
+        query_cache.invalidate(['sessions'])
+        self.assertEqual(query_cache.content_changed(), past)
+        query_cache.invalidate(['tags'])
+        self.assertTrue(query_cache.content_changed() > past)
+        backend.set('content_changed', future)
+        query_cache.invalidate(['posts'])
+        self.assertEqual(query_cache.content_changed(), future)
+
+
+class CachingQueryTests(EstherDBTestCase):
+    def setUp(self):
+        super(CachingQueryTests, self).setUp()
+        user = User(email='ryan@example.com', short_name='Ryan')
+        self.post = Post(author=user, title=u'Cached', slug=u'cached',
+                         body=u'Body', status=PostStatus.published,
+                         pub_date=datetime.datetime(2014, 1, 1,
+                                                    tzinfo=pytz.utc),
+                         tags=[Tag(u'Python')])
+        db.session.add(self.post)
+        db.session.commit()
+
+    def count_queries(self, func):
+        num_queries = len(get_debug_queries())
+        result = func()
+        return result, len(get_debug_queries()) - num_queries
+
+    def test_cached_results_skip_the_database(self):
+        Post.get_published().cached()
+        db.session.expunge_all()
+        posts, num_queries = self.count_queries(
+            lambda: Post.get_published().cached())
+        self.assertEqual(num_queries, 0)
+        self.assertEqual(posts[0].title, u'Cached')
+        self.assertEqual(posts[0].author.short_name, u'Ryan')
+        self.assertEqual([tag.name for tag in posts[0].tags], [u'Python'])
+
+    def test_results_are_attached_copies(self):
+        first = Post.get_published().cached()[0]
+        db.session.expunge_all()
+        second = Post.get_published().cached()[0]
+        self.assertTrue(second in db.session)
+        self.assertFalse(first is second)
+        second.title = u'Changed'
+        db.session.expunge_all()
+        self.assertEqual(Post.get_published().cached()[0].title, u'Cached')
+
+    def test_flush_invalidates(self):
+        Post.get_published().cached()
+        self.post.title = u'Changed'
+        db.session.flush()
+        self.assertEqual(Post.get_published().cached()[0].title, u'Changed')
+        db.session.rollback()
+        self.assertEqual(Post.get_published().cached()[0].title, u'Cached')
+
+    def test_changes_move_content_changed(self):
+        changed = query_cache.content_changed()
+        Tag.query.first().name = u'Renamed'
+        db.session.commit()
+        self.assertTrue(query_cache.content_changed() > changed)
+
+        changed = query_cache.content_changed()
+        db.session.delete(self.post)
+        db.session.commit()
+        self.assertTrue(query_cache.content_changed() > changed)
+
+    def test_tag_changes_invalidate(self):
+        self.assertEqual(len(Tag.query.cached()), 1)
+        self.post.tags.append(Tag(u'Flask'))
+        db.session.commit()
+        self.assertEqual(len(Tag.query.cached()), 2)
@@ -0,0 +1,143 @@
+import datetime
+import gzip
+from io import BytesIO
+import json
+import os
+import shutil
+import tempfile
+
+import pytz
+
+from esther import db
+from esther.export import (export_changes, export_posts, iter_changes,
+                           iter_posts, make_serializer, read_checkpoint,
+                           write_checkpoint, write_records)
+from esther.models import obj_as_dict, Post, PostStatus, Tag, User, utc_now
+from esther.tests.helpers import EstherDBTestCase
+from esther.tests.views.test_blog import BlogMixin
+
+
+class ExportTests(EstherDBTestCase, BlogMixin):
+    def setUp(self):
+        super(ExportTests, self).setUp()
+        self.user = self.create_user(commit=False)
+        self.pub_date = datetime.datetime(2014, 3, 1, tzinfo=pytz.utc)
+        for i in range(3):
+            self.create_post(self.user, title=u'Post {}'.format(i),
+                             slug=u'post-{}'.format(i), body=u'B\xf6dy',
+                             pub_date=self.pub_date,
+                             status=PostStatus.published,
+                             tags=[Tag(u'tag-{}'.format(i))])
+        self.create_post(self.user, slug=u'draft')
+
+    def test_serializer(self):
+        post = Post.query.first()
+        expected = obj_as_dict(post)
+        expected['status'] = post.status.value
+        for name in ('pub_date', 'created', 'modified'):
+            expected[name] = expected[name].isoformat()
+        self.assertEqual(make_serializer(Post)(post), expected)
+        serialize_user = make_serializer(User, exclude=('password',))
+        self.assertFalse('password' in serialize_user(self.user))
+
+    def test_iter_posts(self):
+        posts = list(iter_posts(chunk_size=2))
+        self.assertEqual([post['slug'] for post in posts],
+                         [u'post-0', u'post-1', u'post-2'])
+        self.assertEqual(posts[1]['tags'][0]['name'], u'tag-1')
+        self.assertEqual(posts[1]['author']['email'], self.user.email)
+        self.assertEqual(posts[1]['pub_date'], self.pub_date.isoformat())
+
+    def test_formats(self):
+        records = [{'a': u'\xf6'}, {'b': 2}]
+        out = BytesIO()
+        self.assertEqual(write_records(records, out, 'ndjson'), 2)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], records)
+
+        out = BytesIO()
+        write_records(iter(records), out, 'json')
+        self.assertEqual(json.loads(out.getvalue()), records)
+        out = BytesIO()
+        write_records([], out, 'json')
+        self.assertEqual(json.loads(out.getvalue()), [])
+
+    def test_export_to_gzip_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'posts.ndjson.gz')
+            self.assertEqual(export_posts(path, 'ndjson', compress=True), 3)
+            self.assertEqual(os.listdir(directory), ['posts.ndjson.gz'])
+            with gzip.open(path) as f:
+                posts = [json.loads(line) for line in f]
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(posts[0]['body'], u'B\xf6dy')
+
+
+class ChangesTests(EstherDBTestCase, BlogMixin):
+    def setUp(self):
+        super(ChangesTests, self).setUp()
+        self.user = self.create_user(commit=False)
+        self.tag = Tag(u'python')
+        self.post = self.create_post(self.user, tags=[self.tag])
+        self.draft = self.create_post(self.user, slug=u'draft')
+
+    def changes(self, since):
+        return [(change['table'], change.get('id') or change['data']['id'])
+                for change in iter_changes(since)]
+
+    def test_iter_changes(self):
+        self.assertEqual(self.changes(None), [
+            ('users', self.user.id), ('tags', self.tag.id),
+            ('posts', self.post.id), ('posts', self.draft.id)])
+
+        since = utc_now()
+        self.assertEqual(self.changes(since), [])
+        self.tag.name = u'Python'
+        db.session.commit()
+        self.assertEqual(self.changes(since), [('tags', self.tag.id)])
+
+        since = utc_now()
+        self.post.tags = []
+        db.session.commit()
+        self.assertEqual(self.changes(since), [('posts', self.post.id)])
+
+        self.post.tags = [self.tag]
+        db.session.commit()
+        since = utc_now()
+        tag_id = self.tag.id
+        db.session.delete(self.tag)
+        db.session.commit()
+        self.assertEqual(self.changes(since), [('tags', tag_id),
+                                               ('posts', self.post.id)])
+
+        since = utc_now()
+        draft_id = self.draft.id
+        db.session.delete(self.draft)
+        db.session.commit()
+        changes = list(iter_changes(since))
+        self.assertEqual(len(changes), 1)
+        self.assertEqual((changes[0]['table'], changes[0]['id']),
+                         ('posts', draft_id))
+
+    def test_export_changes(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'checkpoint')
+            output = os.path.join(directory, 'changes.ndjson')
+            self.assertEqual(export_changes(path, output, 'ndjson'), 4)
+            self.assertTrue(read_checkpoint(path) < utc_now())
+
+            write_checkpoint(path, utc_now())
+            checkpoint = read_checkpoint(path)
+            self.tag.name = u'Python'
+            db.session.commit()
+            self.assertEqual(export_changes(path, output, 'ndjson'), 1)
+            # Never moves back
+            self.assertEqual(read_checkpoint(path), checkpoint)
+            with open(output) as f:
+                self.assertEqual(json.loads(f.read())['data']['name'],
+                                 u'Python')
+        finally:
+            shutil.rmtree(directory)
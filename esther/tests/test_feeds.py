@@ -0,0 +1,38 @@
+from esther import db
+from esther.feeds import entry_fragment, fragment_cache
+from esther.models import PostStatus
+from esther.tests.helpers import EstherDBTestCase
+from esther.tests.views.test_blog import BlogMixin
+
+
+class EntryFragmentTests(EstherDBTestCase, BlogMixin):
+    def setUp(self):
+        super(EntryFragmentTests, self).setUp()
+        fragment_cache.clear()
+        self.post = self.create_post(self.create_user(commit=False),
+                                     status=PostStatus.published)
+
+    def test_fragment_reused(self):
+        with self.app.test_request_context():
+            first = entry_fragment('rss', self.post, 'http://localhost/')
+            second = entry_fragment('rss', self.post, 'http://localhost/')
+        self.assertTrue(first is second)
+        self.assertTrue(first.xml.startswith(u'<item>'))
+
+    def test_new_version_serialized_again(self):
+        with self.app.test_request_context():
+            first = entry_fragment('atom', self.post, 'http://localhost/')
+            self.post.title = u'Edited & escaped'
+            db.session.commit()
+            second = entry_fragment('atom', self.post, 'http://localhost/')
+        self.assertFalse(first is second)
+        self.assertTrue(u'Edited &amp; escaped' in second.xml)
+
+    def test_author_change_serialized_again(self):
+        with self.app.test_request_context():
+            first = entry_fragment('rss', self.post, 'http://localhost/')
+            self.post.author.full_name = u'Someone Else'
+            db.session.commit()
+            second = entry_fragment('rss', self.post, 'http://localhost/')
+        self.assertFalse(first is second)
+        self.assertTrue(u'Someone Else' in second.xml)
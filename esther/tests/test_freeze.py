@@ -0,0 +1,162 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+import pytz
+
+from esther import db
+from esther.freeze import freeze_site, MANIFEST_NAME
+from esther.models import Post, PostStatus, RelatedPostUpdate, Tag, User
+from esther.tests.helpers import EstherDBTestCase
+from esther.tests.views.test_blog import BlogMixin
+
+
+class FreezeTests(EstherDBTestCase, BlogMixin):
+    def setUp(self):
+        super(FreezeTests, self).setUp()
+        self.output_dir = tempfile.mkdtemp()
+        self.app.config['NUM_POSTS_PER_INDEX_PAGE'] = 1
+        user = self.create_user(commit=False)
+        for i in range(2):
+            pub_date = datetime.datetime(2014, 3, 1 + i, tzinfo=pytz.utc)
+            self.create_post(user, title=u'Post {}'.format(i),
+                             slug=u'post-{}'.format(i), pub_date=pub_date,
+                             status=PostStatus.published,
+                             tags=[Tag(u'tag-{}'.format(i))])
+
+    def tearDown(self):
+        super(FreezeTests, self).tearDown()
+        shutil.rmtree(self.output_dir)
+
+    def freeze(self):
+        return freeze_site(self.output_dir, processes=0)
+
+    def read(self, path):
+        with open(os.path.join(self.output_dir, path)) as f:
+            return f.read()
+
+    def touch_all(self):
+        for root, dirs, files in os.walk(self.output_dir):
+            for name in files:
+                os.utime(os.path.join(root, name), (0, 0))
+
+    def written(self):
+        written = set()
+        for root, dirs, files in os.walk(self.output_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.getmtime(path) != 0 and name != MANIFEST_NAME:
+                    written.add(os.path.relpath(path, self.output_dir))
+        return written
+
+    def test_freeze(self):
+        manifest = self.freeze()
+        paths = set(entry['path'] for entry in manifest['pages'].values())
+        self.assertEqual(paths, set([
+            'index.html', 'page/2/index.html', 'about/index.html',
+            'blog/2014/03/01/post-0/index.html',
+            'blog/2014/03/02/post-1/index.html',
+            'blog/2014/index.html', 'blog/2014/03/index.html',
+            'blog/2014/03/01/index.html', 'blog/2014/03/02/index.html',
+            'blog/tags/index.html', 'blog/tags/tag-0/index.html',
+            'blog/tags/tag-1/index.html', 'blog/posts/feed/index.rss',
+            'blog/posts/feed/atom/index.atom',
+            'blog/tags/tag-0/feed/index.rss',
+            'blog/tags/tag-0/feed/atom/index.atom',
+            'blog/tags/tag-1/feed/index.rss',
+            'blog/tags/tag-1/feed/atom/index.atom',
+        ]))
+        self.assertTrue('Post 0' in self.read(
+            'blog/2014/03/01/post-0/index.html'))
+        # Older pages are linked by number since the query string is lost
+        self.assertTrue('href="/page/2"' in self.read('index.html'))
+        with open(os.path.join(self.output_dir, MANIFEST_NAME)) as f:
+            self.assertEqual(json.load(f), manifest)
+
+    def test_unchanged_pages_not_rewritten(self):
+        self.freeze()
+        path = os.path.join(self.output_dir, 'about/index.html')
+        os.utime(path, (0, 0))
+        self.freeze()
+        self.assertEqual(os.path.getmtime(path), 0)
+
+    def test_removed_pages_deleted(self):
+        self.freeze()
+        db.session.delete(Tag.query.filter_by(name=u'tag-1').one())
+        db.session.commit()
+        manifest = self.freeze()
+        self.assertFalse('/blog/tags/tag-1' in manifest['pages'])
+        self.assertFalse(os.path.exists(os.path.join(
+            self.output_dir, 'blog/tags/tag-1/index.html')))
+
+    def test_edit_rebuilds_dependent_pages(self):
+        self.freeze()
+        # Related posts queued by the new posts were updated first
+        self.assertEqual(RelatedPostUpdate.query.count(), 0)
+        self.touch_all()
+        post = Post.query.filter_by(slug=u'post-0').one()
+        post.title = u'Edited'
+        db.session.commit()
+        manifest = self.freeze()
+        # Post 1 lists post 0 as a related post
+        self.assertEqual(self.written(), set([
+            'blog/2014/03/01/post-0/index.html',
+            'blog/2014/03/02/post-1/index.html', 'page/2/index.html',
+            'blog/2014/index.html', 'blog/2014/03/index.html',
+            'blog/2014/03/01/index.html', 'blog/tags/tag-0/index.html',
+            'blog/posts/feed/index.rss', 'blog/posts/feed/atom/index.atom',
+            'blog/tags/tag-0/feed/index.rss',
+            'blog/tags/tag-0/feed/atom/index.atom',
+        ]))
+        self.assertEqual(manifest['pages']['/blog/tags/tag-0']['depends_on'],
+                         [u'post:{}'.format(post.id),
+                          u'tag:{}'.format(post.tags[0].id), u'pages:1'])
+
+    def test_tag_and_author_changes_rebuild_pages_showing_them(self):
+        self.freeze()
+        self.touch_all()
+        Tag.query.filter_by(name=u'tag-0').one().name = u'Renamed'
+        db.session.commit()
+        self.freeze()
+        written = self.written()
+        self.assertTrue(set([
+            'blog/2014/03/01/post-0/index.html', 'page/2/index.html',
+        ]) <= written)
+        self.assertTrue('Renamed' in self.read(
+            'blog/2014/03/01/post-0/index.html'))
+        self.assertFalse('blog/2014/03/02/post-1/index.html' in written)
+
+        self.touch_all()
+        User.query.first().full_name = u'Someone Else'
+        db.session.commit()
+        self.freeze()
+        self.assertTrue('Someone Else' in self.read('index.html'))
+        self.assertTrue('blog/2014/03/02/post-1/index.html' in self.written())
+
+    def test_publish_shifts_index_pages(self):
+        self.freeze()
+        self.touch_all()
+        # Unrelated to the other posts, which don't list it
+        self.create_post(User.query.first(), title=u'Unrelated',
+                         body=u'Nothing in common', slug=u'post-2',
+                         status=PostStatus.published,
+                         pub_date=datetime.datetime(2014, 3, 3,
+                                                    tzinfo=pytz.utc))
+        self.freeze()
+        written = self.written()
+        self.assertTrue(set([
+            'index.html', 'page/2/index.html', 'page/3/index.html',
+            'blog/2014/03/03/post-2/index.html',
+            'blog/2014/03/03/index.html',
+        ]) <= written)
+        self.assertFalse('blog/2014/03/01/post-0/index.html' in written)
+        self.assertFalse('blog/tags/tag-0/index.html' in written)
+
+    def test_full_rebuild(self):
+        self.freeze()
+        self.touch_all()
+        freeze_site(self.output_dir, processes=0, full=True)
+        # Everything is rendered again but identical files are kept
+        self.assertEqual(self.written(), set())
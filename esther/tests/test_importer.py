@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+import json
+
+from esther import db
+from esther.export import iter_posts as export_posts, write_records
+from esther.importer import (import_posts, iter_json_array, iter_posts,
+                             refresh_derived_data)
+from esther.models import Post, PostStatus, Tag, TagStats, User
+from esther.tests.helpers import EstherDBTestCase
+from esther.tests.views.test_blog import BlogMixin
+
+WXR = b'''<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"
+  xmlns:content="http://purl.org/rss/1.0/modules/content/"
+  xmlns:dc="http://purl.org/dc/elements/1.1/"
+  xmlns:wp="http://wordpress.org/export/1.2/">
+<channel>
+  <title>A WordPress blog</title>
+  <wp:author>
+    <wp:author_login>jane</wp:author_login>
+    <wp:author_email>jane@example.com</wp:author_email>
+    <wp:author_display_name><![CDATA[Jane]]></wp:author_display_name>
+    <wp:author_first_name><![CDATA[Jane]]></wp:author_first_name>
+    <wp:author_last_name><![CDATA[Doe]]></wp:author_last_name>
+  </wp:author>
+  <item>
+    <title>Hello W\xc3\xb6rld</title>
+    <dc:creator>jane</dc:creator>
+    <content:encoded><![CDATA[<p>Welcome!</p>]]></content:encoded>
+    <wp:post_id>1</wp:post_id>
+    <wp:post_date_gmt>2014-03-01 12:30:00</wp:post_date_gmt>
+    <wp:post_name>hello-world</wp:post_name>
+    <wp:status>publish</wp:status>
+    <wp:post_type>post</wp:post_type>
+    <category domain="category"
+      nicename="uncategorized">Uncategorized</category>
+    <category domain="category" nicename="news">News</category>
+    <category domain="post_tag" nicename="python">Python</category>
+  </item>
+  <item>
+    <title>About</title>
+    <dc:creator>jane</dc:creator>
+    <wp:post_name>about</wp:post_name>
+    <wp:status>publish</wp:status>
+    <wp:post_type>page</wp:post_type>
+  </item>
+  <item>
+    <title>Caf\xc3\xa9</title>
+    <dc:creator>jane</dc:creator>
+    <wp:post_id>4</wp:post_id>
+    <wp:post_name>caf%c3%a9-au-lait</wp:post_name>
+    <wp:status>publish</wp:status>
+    <wp:post_type>post</wp:post_type>
+  </item>
+  <item>
+    <title>Long</title>
+    <dc:creator>jane</dc:creator>
+    <wp:post_id>5</wp:post_id>
+    <wp:post_name>LONG-SLUG</wp:post_name>
+    <wp:status>publish</wp:status>
+    <wp:post_type>post</wp:post_type>
+  </item>
+  <item>
+    <title>Unfinished</title>
+    <dc:creator>ghost</dc:creator>
+    <wp:post_id>3</wp:post_id>
+    <wp:post_date_gmt>0000-00-00 00:00:00</wp:post_date_gmt>
+    <wp:post_name></wp:post_name>
+    <wp:status>draft</wp:status>
+    <wp:post_type>post</wp:post_type>
+  </item>
+</channel>
+</rss>
+'''.replace(b'LONG-SLUG', b'word-' * 40)
+
+
+class ReaderTests(EstherDBTestCase):
+    def test_json_array(self):
+        records = [{'title': u'P\xf6st {}'.format(i), 'tags': [i, {}]}
+                   for i in range(5)]
+        for data in (json.dumps(records),
+                     json.dumps(records, indent=2, ensure_ascii=False).encode(
+                         'utf-8')):
+            for read_size in (1, 7, 1000):
+                self.assertEqual(
+                    list(iter_json_array(BytesIO(data), read_size)), records)
+
+        self.assertEqual(list(iter_json_array(BytesIO(b' [ ] '))), [])
+        with self.assertRaises(ValueError):
+            list(iter_json_array(BytesIO(b'{}')))
+        with self.assertRaises(ValueError):
+            list(iter_json_array(BytesIO(b'[{"a": 1}, {"b"')))
+
+    def test_wxr(self):
+        posts = list(iter_posts(BytesIO(WXR), 'wxr'))
+        # Slugs are decoded and fit the ``slug`` column
+        self.assertEqual([post['slug'] for post in posts],
+                         [u'hello-world', u'cafe-au-lait',
+                          u'-'.join([u'word'] * 16), u'unfinished'])
+        post, draft = posts[0], posts[-1]
+        self.assertEqual(post['title'], u'Hello W\xf6rld')
+        self.assertEqual(post['body'], u'<p>Welcome!</p>')
+        self.assertEqual(post['status'], PostStatus.published)
+        self.assertEqual(post['pub_date'].isoformat(),
+                         '2014-03-01T12:30:00+00:00')
+        self.assertEqual(post['tags'], [u'News', u'Python'])
+        self.assertEqual(post['author'], {'email': u'jane@example.com',
+                                          'short_name': u'Jane',
+                                          'full_name': u'Jane Doe'})
+        self.assertEqual(draft['status'], PostStatus.draft)
+        self.assertIsNone(draft['pub_date'])
+        self.assertIsNone(draft['author'])
+
+
+class ImportTests(EstherDBTestCase, BlogMixin):
+    def setUp(self):
+        super(ImportTests, self).setUp()
+        self.user = self.create_user(commit=False)
+        self.python = Tag(u'python')
+        self.create_post(self.user, slug=u'existing', tags=[self.python],
+                         status=PostStatus.published)
+
+    def test_import_export(self):
+        self.create_post(self.user, title=u'Exported', slug=u'exported',
+                         body=u'B\xf6dy', tags=[self.python, Tag(u'web')],
+                         status=PostStatus.published)
+        out = BytesIO()
+        write_records(export_posts(), out, 'ndjson')
+        exported = Post.query.filter_by(slug=u'exported').one()
+        exported_created = exported.created
+        db.session.delete(exported)
+        db.session.commit()
+
+        out.seek(0)
+        importer = import_posts(iter_posts(out, 'ndjson'), batch_size=1,
+                                commit_every=1)
+        self.assertEqual((importer.num_imported, importer.num_skipped),
+                         (1, 1))
+        post = Post.query.filter_by(slug=u'exported').one()
+        self.assertEqual(post.body, u'B\xf6dy')
+        self.assertEqual(post.author, self.user)
+        self.assertEqual(post.created, exported_created)
+        self.assertEqual([tag.name for tag in post.tags],
+                         [u'python', u'web'])
+
+    def test_import_wxr(self):
+        with self.assertRaises(ValueError):
+            import_posts(iter_posts(BytesIO(WXR), 'wxr'))
+        self.assertEqual(Post.query.count(), 1)
+
+        importer = import_posts(iter_posts(BytesIO(WXR), 'wxr'),
+                                default_author=self.user.email)
+        self.assertEqual(importer.num_imported, 4)
+        jane = User.query.filter_by(email=u'jane@example.com').one()
+        self.assertIsNone(jane.password)
+        post = Post.query.filter_by(slug=u'hello-world').one()
+        self.assertEqual(post.author, jane)
+        # ``Python`` shares the ``python`` slug so it is the same tag
+        self.assertEqual([tag.name for tag in post.tags],
+                         [u'News', u'python'])
+        self.assertEqual(post.rendered_body, u'<p>Welcome!</p>')
+        self.assertEqual(Post.query.filter_by(slug=u'unfinished').one().author,
+                         self.user)
+
+        refresh_derived_data()
+        stats = dict((stats.tag.name, stats.num_published)
+                     for stats in TagStats.query)
+        self.assertEqual(stats, {u'python': 2, u'News': 1})
+
+    def test_failed_import_refreshes_committed_posts(self):
+        with self.assertRaises(ValueError):
+            import_posts(iter_posts(BytesIO(WXR), 'wxr'), batch_size=1,
+                         commit_every=1)
+        # Posts before the one without an author were committed
+        self.assertEqual(Post.query.count(), 4)
+        stats = dict((stats.tag.name, stats.num_published)
+                     for stats in TagStats.query)
+        self.assertEqual(stats, {u'python': 2, u'News': 1})
@@ -0,0 +1,107 @@
+import re
+import threading
+
+import markdown as md
+
+from esther import markdown
+from esther.tests.helpers import EstherTestCase
+
+
+class FingerprintTests(EstherTestCase):
+    def test_fingerprint_is_stable(self):
+        self.assertEqual(markdown.fingerprint(), markdown.fingerprint())
+
+    def test_fingerprint_depends_on_extension_settings(self):
+        original = markdown.fingerprint()
+        self.app.config['POST_CONTINUE_LINK_FRAGMENT'] = u'more'
+        self.assertNotEqual(markdown.fingerprint(), original)
+
+
+class EnginePoolTests(EstherTestCase):
+    def test_engine_reused_within_thread(self):
+        pool = markdown.EnginePool(markdown.build_engine)
+        self.assertTrue(pool.get() is pool.get())
+
+    def test_engine_per_thread(self):
+        pool = markdown.EnginePool(markdown.build_engine)
+        engines = []
+        thread = threading.Thread(target=lambda: engines.append(pool.get()))
+        thread.start()
+        thread.join()
+        self.assertFalse(engines[0] is pool.get())
+
+    def test_state_reset_between_documents(self):
+        markdown.render(u'[link][1]\n\n[1]: http://example.com/')
+        self.assertEqual(markdown.render(u'[link][1]'), u'<p>[link][1]</p>')
+
+
+class HighlightCacheTests(EstherTestCase):
+    code = u'    :::python\n    print "hello"'
+
+    def setUp(self):
+        markdown.highlight_cache.clear()
+
+    def test_matches_codehilite_output(self):
+        expected = md.markdown(self.code, extensions=['codehilite'],
+                               output_format='html5')
+        self.assertEqual(markdown.render(self.code), expected)
+
+    def test_highlighted_blocks_cached(self):
+        html = markdown.render(self.code)
+        self.assertEqual(len(markdown.highlight_cache), 1)
+        self.assertEqual(markdown.render(self.code), html)
+        self.assertEqual(len(markdown.highlight_cache), 1)
+
+    def test_blocks_without_language_cached(self):
+        markdown.render(u'    x = 1')
+        self.assertEqual(len(markdown.highlight_cache), 1)
+
+    def test_get_lexer(self):
+        self.assertEqual(markdown.get_lexer('python').name, 'Python')
+        self.assertTrue(markdown.get_lexer('py') is markdown.get_lexer('py'))
+        self.assertEqual(markdown.get_lexer('not-a-language'), None)
+
+
+class IncrementalRenderingTests(EstherTestCase):
+    text = (u'Intro with a [link][1].\n\n<!-- preview -->\n\n'
+            u'* one\n\n* two\n\n    continued\n\n'
+            u'Code:\n\n    :::python\n    x = 1\n\n\n    y = 2\n\n'
+            u'> quote\n\n> more\n\n<div>\n\n*raw*\n\n</div>\n\n'
+            u'[1]: http://example.com/')
+
+    def setUp(self):
+        markdown.block_cache.clear()
+
+    def normalize(self, html):
+        return re.sub(r'\n+', '\n', html)
+
+    def test_split_blocks(self):
+        blocks, references = markdown.split_blocks(self.text)
+        self.assertEqual(references, u'[1]: http://example.com/')
+        self.assertEqual(len(blocks), 7)
+        self.assertEqual(blocks[2], u'* one\n\n* two\n\n    continued')
+
+    def test_matches_full_render(self):
+        self.assertEqual(
+            self.normalize(markdown.render_incremental(self.text)),
+            self.normalize(markdown.render(self.text)))
+
+    def test_reference_title_on_next_line(self):
+        text = (u'A [link][1].\n\n[1]: http://example.com/\n    "Title"\n\n'
+                u'After.')
+        blocks, references = markdown.split_blocks(text)
+        self.assertEqual(blocks, [u'A [link][1].', u'After.'])
+        self.assertEqual(references, u'[1]: http://example.com/\n    "Title"')
+        html = markdown.render_incremental(text)
+        self.assertTrue(u'title="Title"' in html)
+        self.assertEqual(self.normalize(html),
+                         self.normalize(markdown.render(text)))
+
+    def test_only_changed_blocks_rendered(self):
+        markdown.render_incremental(self.text)
+        num_blocks = len(markdown.block_cache)
+        edited = self.text.replace(u'Intro', u'Edited intro')
+        html = markdown.render_incremental(edited)
+        self.assertTrue(u'<p>Edited intro with a '
+                        u'<a href="http://example.com/">link</a>.</p>' in html)
+        self.assertEqual(len(markdown.block_cache), num_blocks + 1)
@@ -1,7 +1,10 @@
 import datetime
 
+import pytz
+from sqlalchemy import text
+
 from esther import db
-from esther.models import User, Post, PostStatus, Tag
+from esther.models import date_range, User, Post, PostStatus, Tag, TagStats
 from esther.tests.helpers import EstherTestCase, EstherDBTestCase
 
 
@@ -90,12 +93,116 @@ class PostTests(EstherDBTestCase):
         post = Post(body=u'test ')
         self.assertEqual(post.preview, u'test')
 
+    def test_preview_offset_stored(self):
+        post = self.create_post(body=u'Intro <!-- preview --> More')
+        self.assertEqual(post.preview_offset, 6)
+        self.assertEqual(post.preview, u'Intro...')
+
+        post.body = u'No preview'
+        self.assertEqual(post.preview, u'No preview')
+        db.session.commit()
+        self.assertEqual(post.preview_offset, None)
+
+    def test_get_published_load_strategies(self):
+        self.create_post().publish()
+        post = Post.get_published(load='list').first()
+        for column in ['body', 'body_html', 'preview_html']:
+            self.assertFalse(column in post.__dict__)
+        self.assertEqual(post.title, u'First Tiger on the Moon')
+
+        db.session.expire(post)
+        post = Post.get_published().first()
+        self.assertTrue('body' in post.__dict__)
+
+    def test_get_archive_defers_body(self):
+        post = self.create_post()
+        post.publish()
+        year = post.pub_date.year
+        db.session.expire(post)
+        post = Post.get_archive(year).first()
+        self.assertFalse('body' in post.__dict__)
+
+    def test_get_recent_defers_body(self):
+        self.create_post().publish()
+        post = Post.get_recent(1).items[0]
+        self.assertFalse('body' in post.__dict__)
+        self.assertEqual(post.rendered_preview, u'<p>The contents.</p>')
+
+    def test_html_rendered_on_save(self):
+        post = self.create_post(body=u'*Intro* <!-- preview --> More')
+        self.assertEqual(post.body_html, u'<p><em>Intro</em> <div id="{}">'
+                         u'</div> More</p>'.format(
+                             self.app.config['POST_CONTINUE_LINK_FRAGMENT']))
+        self.assertEqual(post.preview_html, u'<p><em>Intro</em>...</p>')
+        self.assertFalse(post.html_is_stale)
+
+        post.body = u'Changed'
+        db.session.commit()
+        self.assertEqual(post.body_html, u'<p>Changed</p>')
+
+    def test_stale_html_rerendered(self):
+        post = self.create_post()
+        post.html_fingerprint = 'outdated'
+        post.body_html = u'<p>Old</p>'
+        self.assertTrue(post.html_is_stale)
+        self.assertEqual(post.rendered_body, u'<p>The contents.</p>')
+        self.assertEqual(post.rendered_preview, u'<p>The contents.</p>')
+        # Reading doesn't store the new HTML
+        self.assertTrue(post.html_is_stale)
+        self.assertEqual(post.body_html, u'<p>Old</p>')
+
     def test_tags(self):
         post = self.create_post(tags=[Tag('boeing'), Tag('airbus')])
         self.assertEqual(len(post.tags), 2)
         self.assertEqual(Tag.query.count(), 2)
 
 
+class DateRangeTests(EstherTestCase):
+    def utc(self, *args):
+        return datetime.datetime(*args, tzinfo=pytz.utc)
+
+    def test_year(self):
+        self.assertEqual(date_range(2013),
+                         (self.utc(2013, 1, 1), self.utc(2014, 1, 1)))
+
+    def test_month(self):
+        self.assertEqual(date_range(2013, 12),
+                         (self.utc(2013, 12, 1), self.utc(2014, 1, 1)))
+        self.assertEqual(date_range(2012, 2),
+                         (self.utc(2012, 2, 1), self.utc(2012, 3, 1)))
+
+    def test_day(self):
+        self.assertEqual(date_range(2012, 2, 29),
+                         (self.utc(2012, 2, 29), self.utc(2012, 3, 1)))
+
+    def test_invalid_date(self):
+        self.assertRaises(ValueError, date_range, 2013, 2, 29)
+        self.assertRaises(ValueError, date_range, 2013, 0)
+        self.assertRaises(ValueError, date_range, 2013, 0, 0)
+        self.assertRaises(ValueError, date_range, 2013, 10, 0)
+
+
+class PostQueryPlanTests(EstherDBTestCase):
+    def query_plan(self, query):
+        statement = query.with_labels().statement
+        # The plan doesn't depend on the values that are bound
+        params = dict.fromkeys(statement.compile().params)
+        sql = text(u'EXPLAIN QUERY PLAN {}'.format(statement))
+        rows = db.session.execute(sql, params).fetchall()
+        return u'\n'.join(row['detail'] for row in rows)
+
+    def test_permalink_uses_index(self):
+        plan = self.query_plan(Post.get_by_permalink(2013, 4, 3, u'a-post'))
+        self.assertTrue(u'INDEX' in plan, plan)
+        self.assertFalse(u'SCAN TABLE posts' in plan, plan)
+
+    def test_archive_uses_status_pub_date_index(self):
+        for date in [(2013,), (2013, 4), (2013, 4, 3)]:
+            plan = self.query_plan(Post.get_archive(*date))
+            self.assertTrue(u'ix_posts_status_pub_date' in plan, plan)
+            self.assertFalse(u'TEMP B-TREE' in plan, plan)
+
+
 class TagTests(EstherTestCase):
     def test_slug_generated_from_name(self):
         tag = Tag('train spotting')
@@ -104,3 +211,66 @@ class TagTests(EstherTestCase):
     def test_url(self):
         tag = Tag('train spotting')
         self.assertEqual(tag.url, '/blog/tags/train-spotting')
+
+
+class TagStatsTests(EstherDBTestCase):
+    def setUp(self):
+        super(TagStatsTests, self).setUp()
+        self.user = User(email='ryan@example.com', short_name='Ryan')
+        self.green = Tag('green')
+        self.blue = Tag('blue')
+
+    def create_post(self, slug, tags, status=PostStatus.published):
+        post = Post(author=self.user, title=slug, slug=slug, body=u'Body',
+                    tags=tags, status=status)
+        if status == PostStatus.published:
+            post.pub_date = datetime.datetime(2013, 1, 1, tzinfo=pytz.utc)
+        db.session.add(post)
+        db.session.commit()
+        return post
+
+    def stats(self):
+        return dict((stats.tag.name, stats.num_published)
+                    for stats in TagStats.query)
+
+    def test_published_post_counted(self):
+        self.create_post(u'one', [self.green, self.blue])
+        self.create_post(u'two', [self.green])
+        self.assertEqual(self.stats(), {'green': 2, 'blue': 1})
+        self.assertEqual(self.green.stats.latest_pub_date,
+                         datetime.datetime(2013, 1, 1, tzinfo=pytz.utc))
+
+    def test_draft_not_counted_until_published(self):
+        post = self.create_post(u'one', [self.green],
+                                status=PostStatus.draft)
+        self.assertEqual(self.stats(), {})
+        post.publish()
+        self.assertEqual(self.stats(), {'green': 1})
+        self.assertEqual(self.green.stats.latest_pub_date, post.pub_date)
+
+    def test_retracted_post_uncounted(self):
+        post = self.create_post(u'one', [self.green])
+        post.status = PostStatus.retracted
+        db.session.commit()
+        self.assertEqual(self.stats(), {})
+
+    def test_retagged_post(self):
+        post = self.create_post(u'one', [self.green])
+        post.tags = [self.blue]
+        db.session.commit()
+        self.assertEqual(self.stats(), {'blue': 1})
+
+    def test_deleted_post_uncounted(self):
+        post = self.create_post(u'one', [self.green])
+        self.create_post(u'two', [self.green])
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(self.stats(), {'green': 1})
+
+    def test_refresh(self):
+        self.create_post(u'one', [self.green, self.blue])
+        TagStats.query.delete()
+        db.session.commit()
+        TagStats.refresh(db.session.connection())
+        db.session.commit()
+        self.assertEqual(self.stats(), {'green': 1, 'blue': 1})
@@ -0,0 +1,75 @@
+import datetime
+
+import pytz
+
+from esther import db
+from esther.models import Post, PostStatus, User
+from esther.cache import query_cache
+from esther.pagination import decode_cursor, encode_cursor, KeysetPagination
+from esther.tests.helpers import EstherDBTestCase, EstherTestCase
+
+
+class CursorTests(EstherTestCase):
+    def test_round_trip(self):
+        date = datetime.datetime(2014, 3, 2, 1, 4, 5, 123, tzinfo=pytz.utc)
+        cursor = encode_cursor(date, 42)
+        self.assertEqual(cursor, u'20140302010405000123-42')
+        self.assertEqual(decode_cursor(cursor), (date, 42))
+
+    def test_malformed_cursor(self):
+        self.assertRaises(ValueError, decode_cursor, u'2014-42')
+        self.assertRaises(ValueError, decode_cursor, u'nonsense')
+
+
+class PaginationTests(EstherDBTestCase):
+    def setUp(self):
+        super(PaginationTests, self).setUp()
+        user = User(email='ryan@example.com', short_name='Ryan')
+        # Two posts share each publication date so ids break the ties
+        for i in range(5):
+            pub_date = datetime.datetime(2014, 1, 1 + i // 2, tzinfo=pytz.utc)
+            db.session.add(Post(author=user, title=u'Post {}'.format(i),
+                                slug=u'post-{}'.format(i), body=u'Body',
+                                status=PostStatus.published,
+                                pub_date=pub_date))
+        db.session.commit()
+
+    def titles(self, pagination):
+        return [post.title for post in pagination.items]
+
+    def cursor(self, url):
+        return url.split('=', 1)[1]
+
+    def test_keyset_pages(self):
+        first = Post.get_recent(num=2)
+        self.assertEqual(self.titles(first), [u'Post 4', u'Post 3'])
+
+        older = Post.get_recent(
+            num=2, before=self.cursor(first.older_url('general.index')))
+        self.assertTrue(isinstance(older, KeysetPagination))
+        self.assertEqual(self.titles(older), [u'Post 2', u'Post 1'])
+        self.assertTrue(older.has_prev and older.has_next)
+
+        oldest = Post.get_recent(
+            num=2, before=self.cursor(older.older_url('general.index')))
+        self.assertEqual(self.titles(oldest), [u'Post 0'])
+        self.assertFalse(oldest.has_next)
+
+        newer = Post.get_recent(
+            num=2, after=self.cursor(oldest.newer_url('general.index')))
+        self.assertEqual(self.titles(newer), [u'Post 2', u'Post 1'])
+
+    def test_numbered_pages_still_work(self):
+        page = Post.get_recent(2, num=2)
+        self.assertEqual(self.titles(page), [u'Post 2', u'Post 1'])
+        self.assertEqual(page.total, 5)
+        self.assertEqual(page.newer_url('general.index'), '/')
+
+    def test_total_cached_until_posts_change(self):
+        self.assertEqual(Post.get_recent(2, num=2).total, 5)
+        hits = query_cache.stats()['hits']
+        self.assertEqual(Post.get_recent(2, num=2).total, 5)
+        self.assertEqual(query_cache.stats()['hits'], hits + 2)
+        Post.query.filter_by(slug=u'post-0').one().status = PostStatus.draft
+        db.session.commit()
+        self.assertEqual(Post.get_recent(2, num=2).total, 4)
@@ -0,0 +1,141 @@
+from collections import Counter
+
+from esther import db
+from esther.models import PostStatus, RelatedPost, RelatedPostUpdate, Tag
+from esther.related import apply_related_updates, rebuild_related_posts
+from esther import similarity
+from esther.similarity import Corpus
+from esther.tests.helpers import EstherDBTestCase, EstherTestCase
+from esther.tests.views.test_blog import BlogMixin
+
+
+class CorpusTests(EstherTestCase):
+    def setUp(self):
+        self.term_counts = [
+            Counter(u'python flask web python'.split()),
+            Counter(u'python flask templates'.split()),
+            Counter(u'cooking pasta'.split()),
+            Counter(u'cooking soup'.split()),
+        ]
+        self.tag_ids = [(1, 10), (2, 10), (3, 20), (4, 20), (4, 30)]
+        self.corpus = Corpus([1, 2, 3, 4], self.term_counts, self.tag_ids)
+
+    def test_vectors_normalized(self):
+        norms = ((self.corpus.common_vectors ** 2).sum(axis=1) +
+                 (self.corpus.vectors.toarray() ** 2).sum(axis=1))
+        # Words only used once still count towards the length
+        self.assertTrue(all(0 < norm < 1 for norm in norms))
+
+    def test_top_related(self):
+        related = dict(self.corpus.top_related(range(4), num=2))
+        self.assertEqual([post_id for post_id, score in related[1]], [2])
+        self.assertEqual([post_id for post_id, score in related[3]], [4])
+        self.assertTrue(related[3][0][1] > 0)
+
+    def test_sparse_terms_and_small_blocks(self):
+        dense_terms, max_products = (similarity.DENSE_TERMS,
+                                     similarity.MAX_PRODUCTS)
+        similarity.DENSE_TERMS, similarity.MAX_PRODUCTS = 1, 1
+        try:
+            corpus = Corpus([1, 2, 3, 4], self.term_counts, self.tag_ids)
+            self.assertEqual(corpus.common_vectors.shape, (4, 1))
+            self.assertEqual(len(list(corpus.blocks(range(4)))), 4)
+            related = list(corpus.top_related(range(4), num=3))
+        finally:
+            similarity.DENSE_TERMS = dense_terms
+            similarity.MAX_PRODUCTS = max_products
+
+        for (post_id, scores), (expected_id, expected) in zip(
+                related, self.corpus.top_related(range(4), num=3)):
+            self.assertEqual(post_id, expected_id)
+            self.assertEqual([related_id for related_id, score in scores],
+                             [related_id for related_id, score in expected])
+            for (_, score), (_, expected_score) in zip(scores, expected):
+                self.assertAlmostEqual(score, expected_score, places=6)
+
+    def test_tag_overlap(self):
+        corpus = Corpus([1, 2, 3], [Counter(), Counter(), Counter()],
+                        [(1, 10), (2, 10), (2, 20), (3, 30)])
+        related = dict(corpus.top_related(range(3), 5))
+        [(post_id, score)] = related[1]
+        self.assertEqual(post_id, 2)
+        self.assertAlmostEqual(score, 0.3 * 0.5)
+        self.assertEqual(related[3], [])
+
+
+class RelatedPostsTests(EstherDBTestCase, BlogMixin):
+    def setUp(self):
+        super(RelatedPostsTests, self).setUp()
+        self.user = self.create_user()
+        python = Tag(u'python')
+        self.flask = self.create_post(
+            self.user, title=u'Flask', slug=u'flask',
+            body=u'Writing web apps in python with flask',
+            status=PostStatus.published, tags=[python])
+        self.django = self.create_post(
+            self.user, title=u'Django', slug=u'django',
+            body=u'Writing web apps in python with django',
+            status=PostStatus.published, tags=[python])
+        self.soup = self.create_post(
+            self.user, title=u'Soup', slug=u'soup',
+            body=u'A recipe for tomato soup',
+            status=PostStatus.published)
+        self.update()
+
+    def update(self):
+        num_posts = apply_related_updates(db.session.connection())
+        db.session.commit()
+        return num_posts
+
+    def related(self, post):
+        return [related_post.title for related_post in post.get_related()]
+
+    def test_computed_on_change(self):
+        self.assertEqual(self.related(self.flask), [u'Django'])
+        self.assertEqual(self.related(self.soup), [])
+
+        self.soup.body = u'Soup for python programmers using flask'
+        db.session.commit()
+        # Saving only queues the post
+        self.assertEqual(self.related(self.soup), [])
+        self.assertEqual(self.update(), 1)
+        self.assertEqual(RelatedPostUpdate.query.count(), 0)
+        self.assertEqual(self.related(self.soup), [u'Flask', u'Django'])
+        self.assertEqual(self.related(self.flask), [u'Django', u'Soup'])
+
+    def test_unpublished_and_deleted(self):
+        self.django.status = PostStatus.retracted
+        db.session.commit()
+        self.update()
+        self.assertEqual(self.related(self.flask), [])
+        self.assertEqual(RelatedPost.query.filter_by(
+            post_id=self.django.id).count(), 0)
+
+        self.django.status = PostStatus.published
+        db.session.commit()
+        self.update()
+        self.assertEqual(self.related(self.flask), [u'Django'])
+
+        db.session.delete(self.django)
+        db.session.commit()
+        # Rows naming the deleted post go right away
+        self.assertEqual(self.related(self.flask), [])
+        self.assertEqual(RelatedPost.query.count(), 0)
+        self.update()
+        self.assertEqual(RelatedPost.query.count(), 0)
+
+    def test_rebuild(self):
+        expected = set(db.session.query(
+            RelatedPost.post_id, RelatedPost.related_id))
+        RelatedPost.query.delete()
+        self.soup.title = u'Tomato soup'
+        db.session.flush()
+        self.assertEqual(rebuild_related_posts(db.session.connection()), 3)
+        self.assertEqual(set(db.session.query(
+            RelatedPost.post_id, RelatedPost.related_id)), expected)
+        self.assertEqual(RelatedPostUpdate.query.count(), 0)
+
+    def test_post_page(self):
+        response = self.client.get(self.flask.url)
+        self.assert_200(response)
+        self.assertTrue('href="{}"'.format(self.django.url) in response.data)
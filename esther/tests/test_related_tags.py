@@ -0,0 +1,85 @@
+import json
+
+from esther import db
+from esther.models import PostStatus, Tag
+from esther.related_tags import related_tags, TagCooccurrence
+from esther.tests.helpers import EstherDBTestCase, EstherTestCase
+from esther.tests.views.test_blog import BlogMixin
+
+
+class TagCooccurrenceTests(EstherTestCase):
+    def setUp(self):
+        self.matrix = TagCooccurrence()
+        self.matrix.add(1, [1, 2, 3])
+        self.matrix.add(2, [1, 2])
+        self.matrix.add(3, [1, 4])
+
+    def test_related(self):
+        self.assertEqual(self.matrix.related([1], 10), [2, 3, 4])
+        self.assertEqual(self.matrix.related([1], 1), [2])
+        self.assertEqual(self.matrix.related([3, 4], 10), [1, 2])
+        self.assertEqual(self.matrix.related([5], 10), [])
+
+    def test_replace_and_remove(self):
+        self.matrix.add(2, [2, 4])
+        self.assertEqual(self.matrix.related([2], 10), [1, 3, 4])
+        self.matrix.remove(1)
+        self.matrix.remove(1)
+        self.assertEqual(self.matrix.related([2], 10), [4])
+        self.matrix.remove(2)
+        self.matrix.remove(3)
+        self.assertEqual(self.matrix.rows, {})
+
+
+class RelatedTagsTests(EstherDBTestCase, BlogMixin):
+    def setUp(self):
+        super(RelatedTagsTests, self).setUp()
+        self.user = self.create_user()
+        self.python = Tag(u'python')
+        self.flask = Tag(u'flask')
+        self.web = Tag(u'web')
+        self.post = self.create_post(
+            self.user, status=PostStatus.published,
+            tags=[self.python, self.flask, self.web])
+        self.create_post(self.user, slug=u'another', tags=[self.python],
+                         status=PostStatus.published)
+
+    def names(self, *tags):
+        return [tag.name for tag in related_tags.related(tags)]
+
+    def test_incremental_updates(self):
+        self.assertEqual(self.names(self.python), [u'flask', u'web'])
+
+        self.post.tags = [self.python, self.web]
+        db.session.commit()
+        self.assertEqual(self.names(self.python), [u'web'])
+
+        draft = self.create_post(self.user, slug=u'draft',
+                                 tags=[self.python, self.flask])
+        self.assertEqual(self.names(self.python), [u'web'])
+        draft.publish()
+        self.assertEqual(self.names(self.python), [u'flask', u'web'])
+
+        self.post.status = PostStatus.retracted
+        db.session.commit()
+        self.assertEqual(self.names(self.python), [u'flask'])
+
+        db.session.delete(self.flask)
+        db.session.commit()
+        self.assertEqual(self.names(self.python), [])
+
+    def test_tag_posts_page(self):
+        response = self.client.get('/blog/tags/flask')
+        self.assert_200(response)
+        self.assertEqual(self.get_context_variable('related_tags'),
+                         [self.python, self.web])
+
+    def test_tag_suggestions(self):
+        self.login(user=self.user)
+        response = self.client.get('/blog/posts/tag-suggestions',
+                                   query_string={'tags': u'flask, web'})
+        self.assert_200(response)
+        self.assertEqual(json.loads(response.data), {'tags': [u'python']})
+
+        response = self.client.get('/blog/posts/tag-suggestions')
+        self.assertEqual(json.loads(response.data), {'tags': []})
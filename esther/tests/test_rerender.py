@@ -0,0 +1,37 @@
+from esther import db
+from esther.models import Post
+from esther.rerender import rerender_posts
+from esther.tests.helpers import EstherDBTestCase
+from esther.tests.views.test_blog import BlogMixin
+
+
+class RerenderTests(EstherDBTestCase, BlogMixin):
+    def create_stale_posts(self):
+        user = self.create_user(commit=False)
+        posts = [self.create_post(user, slug=u'post-{}'.format(i),
+                                  body=u'*Post* {}'.format(i), commit=False)
+                 for i in range(5)]
+        db.session.commit()
+        Post.query.update({'html_fingerprint': None, 'body_html': None})
+        db.session.commit()
+        return posts, [post.modified for post in posts]
+
+    def assert_rerendered(self, processes):
+        posts, modified = self.create_stale_posts()
+        self.assertEqual(rerender_posts(processes=processes, chunk_size=2), 5)
+
+        for i, post in enumerate(posts):
+            self.assertFalse(post.html_is_stale)
+            self.assertEqual(post.body_html,
+                             u'<p><em>Post</em> {}</p>'.format(i))
+            # Incremental exports pick up the new HTML
+            self.assertTrue(post.modified > modified[i])
+
+        # Nothing is left to do on a second run
+        self.assertEqual(rerender_posts(processes=processes), 0)
+
+    def test_rerender_posts(self):
+        self.assert_rerendered(processes=0)
+
+    def test_rerender_posts_with_pool(self):
+        self.assert_rerendered(processes=2)
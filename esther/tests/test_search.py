@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+
+from esther import db
+from esther.models import PostStatus, Tag
+from esther.search import InvertedIndex, make_snippet, post_search
+from esther.tests.helpers import EstherDBTestCase, EstherTestCase
+from esther.tests.views.test_blog import BlogMixin
+
+
+class InvertedIndexTests(EstherTestCase):
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.add(1, [(u'Python tips', 3), (u'Some python code', 1)])
+        self.index.add(2, [(u'Flask', 3), (u'A post about python', 1)])
+        self.index.add(3, [(u'Cooking', 3), (u'Nothing related', 1)])
+
+    def ids(self, query):
+        return [doc_id for doc_id, score in self.index.search(query)]
+
+    def test_ranking(self):
+        self.assertEqual(self.ids(u'python'), [1, 2])
+        self.assertEqual(self.ids(u'FLASK python'), [2, 1])
+        self.assertEqual(self.ids(u'missing'), [])
+
+    def test_replace_and_remove(self):
+        self.index.add(1, [(u'Cooking', 1)])
+        self.assertEqual(self.ids(u'python'), [2])
+        self.index.remove(2)
+        self.index.remove(2)
+        self.assertEqual(self.ids(u'python'), [])
+        self.assertFalse(u'flask' in self.index.postings)
+        # "cooking" in post 1 and the weighted words of post 3
+        self.assertEqual(self.index.total_length, 6)
+
+    def test_copy(self):
+        copy = self.index.copy()
+        copy.add(3, [(u'Python', 1)])
+        copy.remove(1)
+        self.assertEqual([doc_id for doc_id, score in copy.search(u'python')],
+                         [3, 2])
+        # The original is left as it was
+        self.assertEqual(self.ids(u'python'), [1, 2])
+        self.assertEqual(self.ids(u'cooking'), [3])
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'index')
+            self.index.save(path)
+            loaded = InvertedIndex.load(path)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(loaded.search(u'python'),
+                         self.index.search(u'python'))
+        loaded.remove(1)
+        self.assertEqual([doc_id for doc_id, score in loaded.search(u'tips')],
+                         [])
+
+    def test_load_missing(self):
+        self.assertEqual(InvertedIndex.load('/nonexistent/index'), None)
+
+
+class SnippetTests(EstherTestCase):
+    def test_highlight(self):
+        snippet = make_snippet(u'<b>Python</b> is nice', set([u'python']))
+        self.assertEqual(snippet,
+                         u'<mark>&lt;b&gt;Python&lt;/b&gt;</mark> is nice')
+
+    def test_window(self):
+        text = u' '.join([u'word'] * 50 + [u'match'] + [u'word'] * 50)
+        snippet = make_snippet(text, set([u'match']), num_words=10)
+        self.assertTrue(snippet.startswith(u'&hellip; word'))
+        self.assertTrue(snippet.endswith(u'word &hellip;'))
+        self.assertTrue(u'<mark>match</mark>' in snippet)
+
+
+class PostSearchTests(EstherDBTestCase, BlogMixin):
+    def setUp(self):
+        super(PostSearchTests, self).setUp()
+        self.user = self.create_user()
+        self.post = self.create_post(self.user, body=u'All about python',
+                                     status=PostStatus.published,
+                                     tags=[Tag(u'flask')])
+
+    def titles(self, query):
+        return [post.title for post, snippet in post_search.search(query)]
+
+    def test_search(self):
+        self.assertEqual(self.titles(u'python'), [u'My First Post'])
+        self.assertEqual(self.titles(u'flask'), [u'My First Post'])
+        self.assertEqual(self.titles(u'django'), [])
+
+    def test_incremental_updates(self):
+        index = post_search.get_index()
+        self.create_post(self.user, title=u'Django', slug=u'django',
+                         status=PostStatus.published)
+        self.assertEqual(self.titles(u'django'), [u'Django'])
+        # Changes are applied to a copy, never to an index being searched
+        self.assertEqual(index.search(u'django'), [])
+
+        self.post.body = u'All about django'
+        db.session.commit()
+        self.assertEqual(self.titles(u'python'), [])
+
+        self.post.status = PostStatus.retracted
+        db.session.commit()
+        self.assertEqual(self.titles(u'django'), [u'Django'])
+
+    def test_saved_index_is_loaded(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.app.extensions['search'].path = os.path.join(directory, 'i')
+            post_search.rebuild()
+            # Another process saved a newer index
+            index = InvertedIndex()
+            index.add(self.post.id, [(u'replaced', 1)])
+            index.save(self.app.extensions['search'].path)
+            os.utime(self.app.extensions['search'].path, (0, 0))
+            self.assertEqual(self.titles(u'replaced'), [u'My First Post'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_search_page(self):
+        response = self.client.get('/blog/search?q=python')
+        self.assert_200(response)
+        self.assert_template_used('blog/search.html')
+        self.assertTrue('<mark>python</mark>' in response.data)
+        self.assert_200(self.client.get('/blog/search'))
@@ -0,0 +1,22 @@
+import sys
+
+from esther.startup import ImportTimer
+from esther.tests.helpers import EstherTestCase
+
+
+class StartupTests(EstherTestCase):
+    def test_import_timer(self):
+        sys.modules.pop('sndhdr', None)
+        timer = ImportTimer()
+        sys.meta_path.insert(0, timer)
+        try:
+            import sndhdr
+        finally:
+            sys.meta_path.remove(timer)
+        self.assertTrue(sndhdr.what)
+        [(name, elapsed, own)] = timer.timings
+        self.assertEqual(name, 'sndhdr')
+        self.assertTrue(0 <= own <= elapsed)
+
+    def test_sentry_needs_dsn(self):
+        self.assertFalse('sentry' in self.app.extensions)
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+
+from flask import render_template
+from jinja2 import FileSystemBytecodeCache
+
+from esther import create_app
+from esther.template_cache import compile_templates
+from esther.tests.helpers import EstherTestCase
+
+
+class TemplateCacheTests(EstherTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        shutil.rmtree(self.cache_dir)
+
+    def tearDown(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def make_app(self):
+        class Config(object):
+            TEMPLATE_BYTECODE_CACHE_DIR = self.cache_dir
+        return create_app(config_objects=['esther.settings.test', Config])
+
+    def test_cache_used_once_built(self):
+        app = self.make_app()
+        self.assertEqual(app.jinja_env.bytecode_cache, None)
+
+        num_templates = compile_templates(app)
+        self.assertEqual(num_templates, len(app.jinja_env.list_templates()))
+        self.assertEqual(len(os.listdir(self.cache_dir)), num_templates)
+
+        app = self.make_app()
+        self.assertTrue(isinstance(app.jinja_env.bytecode_cache,
+                                   FileSystemBytecodeCache))
+        with app.test_request_context():
+            self.assertTrue(u'does not exist' in render_template(
+                'errors/404.html'))
+
+    def test_compile_replaces_cache(self):
+        app = self.make_app()
+        compile_templates(app)
+        stale_path = os.path.join(self.cache_dir, '__jinja2_stale.cache')
+        open(stale_path, 'w').close()
+        compile_templates(app)
+        self.assertFalse(os.path.exists(stale_path))
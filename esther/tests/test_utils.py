@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+from esther.utils import LRUCache, slugify
+
+
+class SlugifyTests(TestCase):
+    def test_slugify(self):
+        self.assertEqual(slugify(u'Hello, World!'), u'hello-world')
+
+
+class LRUCacheTests(TestCase):
+    def test_get_and_set(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+
+    def test_least_recently_used_evicted(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_delete_and_clear(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+        self.assertFalse('a' in cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
@@ -1,4 +1,6 @@
 import datetime
+import gzip
+from io import BytesIO
 from xml.etree import cElementTree
 
 from flask import url_for
@@ -6,7 +8,8 @@ import pytz
 
 from esther import db
 from esther.models import PostStatus, Post, utc_now, Tag
-from esther.tests.helpers import EstherDBTestCase, PageMixin
+from esther.related_tags import related_tags
+from esther.tests.helpers import EstherDBTestCase, PageMixin, QueryCountMixin
 from esther.tests.views.test_auth import AuthMixin
 
 
@@ -168,6 +171,19 @@ class PublicTests(EstherDBTestCase, BlogMixin, PageMixin):
         post.publish()
         self.assert_page(url, 'blog/post_view.html')
 
+    def test_view_post_with_invalid_date_404s(self):
+        url = url_for('blog.view_post', year=2013, month=2, day=30, slug='a')
+        self.assert_404(self.client.get(url))
+
+    def test_view_post_only_matches_its_date(self):
+        post = self.create_post(self.create_user(),
+                                status=PostStatus.published)
+        day = post.pub_date + datetime.timedelta(days=1)
+        url = url_for('blog.view_post', year=day.year, month=day.month,
+                      day=day.day, slug=post.slug)
+        self.assert_404(self.client.get(url))
+        self.assert_page(post.url, 'blog/post_view.html')
+
     def assert_archive(self, posts, **date_components):
         url = url_for('blog.post_archive', **date_components)
         self.assert_page(url, 'blog/post_archive.html')
@@ -184,6 +200,13 @@ class PublicTests(EstherDBTestCase, BlogMixin, PageMixin):
         self.assert_archive(posts, year=now.year, month=now.month)
         self.assert_archive(posts, year=now.year, month=now.month, day=now.day)
 
+        self.assert_404(self.client.get('/blog/{}/00'.format(now.year)))
+        self.assert_404(self.client.get('/blog/{}/{:02}/00'.format(
+            now.year, now.month)))
+        for month, day in ((0, 0), (now.month, 0)):
+            self.assert_404(self.client.get('/blog/{}/{:02}/{:02}/{}'.format(
+                now.year, month, day, posts[0].slug)))
+
     def test_tag_list(self):
         """ Also tests that tags without published posts are not included. """
         tag = Tag('blue')
@@ -196,6 +219,21 @@ class PublicTests(EstherDBTestCase, BlogMixin, PageMixin):
         self.assertEqual(len(tags), 1)
         self.assertEqual(tags[0], tag)
 
+    def test_tag_list_sorted_by_popularity(self):
+        user = self.create_user()
+        blue, green = Tag('blue'), Tag('green')
+        self.create_post(user, tags=[blue, green],
+                         status=PostStatus.published)
+        self.create_post(user, slug=u'second-post', tags=[green],
+                         status=PostStatus.published)
+        url = url_for('blog.tag_list', sort='popular')
+        self.assert_page(url, 'blog/tag_list.html')
+        tags = self.get_context_variable('tags').items
+        self.assertEqual(tags, [green, blue])
+
+    def test_tag_list_with_invalid_sort_404s(self):
+        self.assert_404(self.client.get(url_for('blog.tag_list', sort='x')))
+
     def test_tag_posts(self):
         tag = Tag('blue')
         db.session.add(tag)
@@ -235,3 +273,121 @@ class PostsFeedTests(EstherDBTestCase, BlogMixin):
         self.assertEqual(channel.find('description').text,
                          feed_config['description'])
         self.assertEqual(len(channel.findall('item')), 2)
+
+    def test_atom_feed(self):
+        user = self.create_user(commit=False)
+        self.create_post(user, status=PostStatus.published,
+                         tags=[Tag(u'blue')])
+
+        response = self.client.get(url_for('blog.posts_feed', kind='atom'))
+        self.assert_200(response)
+        self.assertEqual(response.mimetype, 'application/atom+xml')
+
+        ns = '{http://www.w3.org/2005/Atom}'
+        feed = cElementTree.fromstring(response.data)
+        entries = feed.findall(ns + 'entry')
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0].find(ns + 'title').text, u'My First Post')
+        self.assertEqual(entries[0].find(ns + 'category').get('term'),
+                         u'blue')
+
+    def test_tag_feeds(self):
+        user = self.create_user(commit=False)
+        self.create_post(user, status=PostStatus.published,
+                         tags=[Tag(u'blue')], commit=False)
+        self.create_post(user, title=u'Untagged', slug=u'untagged',
+                         status=PostStatus.published)
+
+        response = self.client.get(url_for('blog.tag_feed', slug=u'blue'))
+        channel = cElementTree.fromstring(response.data)[0]
+        self.assertEqual([item.find('title').text
+                          for item in channel.findall('item')],
+                         [u'My First Post'])
+
+        response = self.client.get(url_for('blog.tag_feed', slug=u'blue',
+                                           kind='atom'))
+        self.assert_200(response)
+        self.assert_404(self.client.get(url_for('blog.tag_feed',
+                                                slug=u'missing')))
+
+    def test_cached_feed(self):
+        user = self.create_user(commit=False)
+        post = self.create_post(user, status=PostStatus.published)
+        url = url_for('blog.posts_feed')
+        response = self.client.get(url)
+        etag = response.headers['ETag']
+        self.assertTrue('Last-Modified' in response.headers)
+
+        response = self.client.get(url, headers={'If-None-Match': etag},
+                                   buffered=True)
+        self.assertEqual(response.status_code, 304)
+
+        post.title = u'Edited title'
+        db.session.commit()
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assert_200(response)
+        self.assertTrue('Edited title' in response.data)
+
+    def test_gzipped_feed(self):
+        self.create_post(self.create_user(commit=False),
+                         status=PostStatus.published)
+        url = url_for('blog.posts_feed')
+        plain = self.client.get(url)
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertTrue('Accept-Encoding' in response.headers['Vary'])
+        self.assertNotEqual(response.headers['ETag'], plain.headers['ETag'])
+        data = gzip.GzipFile(fileobj=BytesIO(response.data)).read()
+        self.assertEqual(data, plain.data)
+
+
+class QueryCountTests(EstherDBTestCase, BlogMixin, QueryCountMixin):
+    """ Public pages must not query once per post for authors or tags. """
+
+    def setUp(self):
+        super(QueryCountTests, self).setUp()
+        self.tag = Tag('blue')
+        self.num_posts = 0
+        self.pub_date = utc_now()
+        self.add_posts(1)
+
+    def add_posts(self, num):
+        for i in range(self.num_posts, self.num_posts + num):
+            user = self.create_user(email=u'user{}@example.com'.format(i),
+                                    full_name=u'User {}'.format(i),
+                                    commit=False)
+            self.create_post(user, slug=u'post-{}'.format(i),
+                             tags=[self.tag, Tag(u'tag {}'.format(i))],
+                             status=PostStatus.published,
+                             pub_date=self.pub_date, commit=False)
+        self.num_posts += num
+        db.session.commit()
+
+    def assert_constant_queries(self, url):
+        num_queries = self.count_queries(url)
+        self.add_posts(4)
+        self.assertEqual(self.count_queries(url), num_queries)
+
+    def test_index(self):
+        self.assert_constant_queries(url_for('general.index'))
+
+    def test_post_archive(self):
+        self.assert_constant_queries(url_for(
+            'blog.post_archive', year=self.pub_date.year,
+            month=self.pub_date.month, day=self.pub_date.day))
+
+    def test_tag_list(self):
+        self.assert_constant_queries(url_for('blog.tag_list'))
+
+    def test_tag_posts(self):
+        # Built once per process, then kept up to date in memory
+        related_tags.get_matrix()
+        self.assert_constant_queries(url_for('blog.tag_posts',
+                                             slug=self.tag.slug))
+
+    def test_posts_feed(self):
+        self.assert_constant_queries(url_for('blog.posts_feed'))
+
+    def test_view_post(self):
+        post = Post.query.first()
+        self.assert_constant_queries(post.url)
@@ -14,6 +14,9 @@ class GeneralTestsWithDB(EstherDBTestCase, PageMixin):
     def test_home(self):
         self.assert_page('/', 'general/index.html')
 
+    def test_home_with_invalid_cursor_404s(self):
+        self.assert_404(self.client.get('/?before=nonsense'))
+
     def test_contact_form_submission(self):
         form_data = {
             'name': 'John Smith',
@@ -0,0 +1,68 @@
+from flask import url_for
+
+from esther import db
+from esther.cache import query_cache
+from esther.models import PostStatus
+from esther.tests.helpers import EstherDBTestCase, QueryCountMixin
+from esther.tests.views.test_blog import BlogMixin
+
+
+class PageCacheTests(EstherDBTestCase, BlogMixin, QueryCountMixin):
+    def setUp(self):
+        super(PageCacheTests, self).setUp()
+        self.user = self.create_user()
+        self.post = self.create_post(self.user, status=PostStatus.published)
+
+    def test_cached_page(self):
+        first = self.client.get('/')
+        self.assertEqual(self.count_queries('/'), 0)
+        second = self.client.get('/')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+        self.assertFalse(first.headers['ETag'].startswith('W/'))
+        self.assertTrue('Last-Modified' in second.headers)
+        self.assertTrue('Cookie' in second.headers['Vary'])
+
+    def get(self, url, headers=None):
+        # Buffered so the test client copes with empty 304 responses
+        return self.client.get(url, headers=headers, buffered=True)
+
+    def test_conditional_requests(self):
+        response = self.get(self.post.url)
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+
+        response = self.get(self.post.url, {'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+
+        response = self.get(self.post.url,
+                            {'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        self.assert_200(self.get(self.post.url, {'If-None-Match': '"other"'}))
+
+    def test_changes_invalidate(self):
+        etag = self.client.get('/').headers['ETag']
+        self.post.title = u'Edited'
+        db.session.commit()
+        response = self.get('/', {'If-None-Match': etag})
+        self.assert_200(response)
+        self.assertTrue('Edited' in response.data)
+
+    def test_logged_in_users_bypass(self):
+        self.client.get('/')
+        self.login(user=self.user)
+        response = self.client.get('/')
+        self.assertFalse('ETag' in response.headers)
+        self.assertTrue(url_for('blog.view_posts') in response.data)
+
+    def test_not_found_not_cached(self):
+        self.assert_404(self.client.get('/blog/tags/missing'))
+        stats = query_cache.stats()
+        self.assert_404(self.client.get('/blog/tags/missing'))
+        # The page wasn't stored, so the view ran again and looked the tag
+        # up. The query cache answers the lookup, so count it there rather
+        # than in database queries.
+        self.assertEqual(query_cache.stats(), {
+            'misses': stats['misses'] + 1, 'hits': stats['hits'] + 1})
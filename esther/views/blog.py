@@ -1,28 +1,38 @@
-from urlparse import urljoin
-
 from flask import (Blueprint, request, flash, render_template, redirect,
-                   url_for, abort, current_app)
+                   url_for, abort, current_app, jsonify)
 from flask.ext.login import login_required, current_user
-from PyRSS2Gen import RSS2, RSSItem, Guid
-from sqlalchemy import and_, extract
-from sqlalchemy.orm import subqueryload
+from sqlalchemy.orm import contains_eager
 
 from esther import db
+from esther.cache import query_cache
+from esther.feeds import build_feed, NUM_FEED_POSTS
 from esther.forms import PostForm
-from esther.models import PostStatus, Post, utc_now, Tag
+from esther.models import PostStatus, Post, utc_now, Tag, TagStats
+from esther.page_cache import cached_page, make_page_response
+from esther.pagination import paginate
+from esther.related_tags import related_tags
+from esther.search import post_search
 
 blueprint = Blueprint('blog', __name__)
 
 
+def cursor_args():
+    return {
+        'before': request.args.get('before'),
+        'after': request.args.get('after'),
+    }
+
+
 @blueprint.route('/posts', defaults={'page': 1})
 @blueprint.route('/posts/page/<int:page>')
 @login_required
 def view_posts(page):
-    created = Post.created.desc()
-    posts = Post.query.options(subqueryload(Post.tags)).filter_by(
-        author=current_user).order_by(created)
+    posts = Post.query.options(*Post.load_options('list')).filter_by(
+        author=current_user).order_by(*Post.newest_first(Post.created))
     per_page = current_app.config['NUM_POSTS_PER_LIST_PAGE']
-    paginated_posts = posts.paginate(page, per_page)
+    paginated_posts = paginate(posts, page, per_page,
+                               columns=(Post.created, Post.id),
+                               **cursor_args())
     return render_template('blog/post_list.html', posts=paginated_posts)
 
 
@@ -78,33 +88,41 @@ def preview_post(post_id):
     return render_template('blog/post_preview.html', post=post)
 
 
+@blueprint.route('/posts/tag-suggestions')
+@login_required
+def tag_suggestions():
+    """ Tags often used along with the comma separated ``tags``, suggested
+    by the post editor. """
+    names = [name.strip() for name in request.args.get('tags', u'').split(',')
+             if name.strip()]
+    tags = Tag.query.filter(Tag.name.in_(names)).all() if names else []
+    return jsonify(tags=[tag.name for tag in related_tags.related(tags)])
+
+
 ### Public views
 
 
 @blueprint.route('/<int:year>/<int(fixed_digits=2):month>/<int(fixed_digits=2):day>/<slug>')
+@cached_page
 def view_post(year, month, day, slug):
-    post = Post.query.filter(
-        (extract('year', Post.pub_date) == year) &
-        (extract('month', Post.pub_date) == month) &
-        (extract('day', Post.pub_date) == day) &
-        (Post.status == PostStatus.published) &
-        (Post.slug == slug)).first_or_404()
-    return render_template('blog/post_view.html', post=post)
+    try:
+        posts = Post.get_by_permalink(year, month, day, slug)
+    except ValueError:
+        abort(404)
+    post = posts.cached_first_or_404()
+    return render_template('blog/post_view.html', post=post,
+                           related_posts=post.get_related().cached())
 
 
 @blueprint.route('/<int:year>')
 @blueprint.route('/<int:year>/<int(fixed_digits=2):month>')
 @blueprint.route('/<int:year>/<int(fixed_digits=2):month>/<int(fixed_digits=2):day>')
+@cached_page
 def post_archive(year, month=None, day=None):
-    filters = [Post.status == PostStatus.published,
-               extract('year', Post.pub_date) == year]
-
-    if month:
-        filters.append(extract('month', Post.pub_date) == month)
-    if day:
-        filters.append(extract('day', Post.pub_date) == day)
-
-    posts = Post.query.filter(and_(*filters)).order_by(Post.pub_date).all()
+    try:
+        posts = Post.get_archive(year, month, day).cached()
+    except ValueError:
+        posts = None
 
     if not posts:
         abort(404)
@@ -113,63 +131,82 @@ def post_archive(year, month=None, day=None):
                            month=month, day=day)
 
 
+TAG_LIST_ORDERINGS = {
+    'name': (Tag.name,),
+    'popular': (TagStats.num_published.desc(), Tag.name),
+}
+
+
 @blueprint.route('/tags', defaults={'page': 1})
 @blueprint.route('/tags/page/<int:page>')
+@cached_page
 def tag_list(page):
-    has_published_post = Tag.posts.any(Post.status == PostStatus.published)
-    tags = Tag.query.order_by(Tag.name).filter(has_published_post)
+    sort = request.args.get('sort', 'name')
+    if sort not in TAG_LIST_ORDERINGS:
+        abort(404)
+    # Only tags with published posts have stats
+    tags = Tag.query.join(TagStats).options(contains_eager(Tag.stats))
+    tags = tags.order_by(*TAG_LIST_ORDERINGS[sort])
     per_page = current_app.config['NUM_TAGS_PER_LIST_PAGE']
-    paginated_tags = tags.paginate(page, per_page)
-    return render_template('blog/tag_list.html', tags=paginated_tags)
+    paginated_tags = paginate(tags, page, per_page)
+    return render_template('blog/tag_list.html', tags=paginated_tags,
+                           sort=sort)
 
 
 @blueprint.route('/tags/<slug>', defaults={'page': 1})
 @blueprint.route('/tags/<slug>/page/<int:page>')
+@cached_page
 def tag_posts(slug, page):
-    has_published_post = Tag.posts.any(Post.status == PostStatus.published)
-    tag = Tag.query.filter(has_published_post, Tag.slug == slug).first_or_404()
-    posts = Post.query.filter(Post.status == PostStatus.published,
-                              Post.tags.any(Tag.id == tag.id))
+    tag = Tag.query.join(TagStats).options(contains_eager(Tag.stats)).filter(
+        Tag.slug == slug).cached_first_or_404()
+    posts = Post.get_tagged(tag)
     per_page = current_app.config['NUM_POSTS_PER_TAG_PAGE']
-    paginated_posts = posts.paginate(page, per_page)
+    # The tag's stats already hold the number of published posts
+    paginated_posts = paginate(
+        posts, page, per_page, total=tag.stats.num_published,
+        columns=(Post.pub_date, Post.id), **cursor_args())
     return render_template('blog/tag_posts.html', tag=tag,
-                           posts=paginated_posts)
+                           posts=paginated_posts,
+                           related_tags=related_tags.related([tag]))
+
+
+@blueprint.route('/search')
+def search():
+    query = request.args.get('q', u'').strip()
+    results = post_search.search(query) if query else []
+    return render_template('blog/search.html', query=query, results=results)
 
 
 ### Feeds
 
 
-@blueprint.route('/posts/feed')
-def posts_feed():
-    base_url = url_for('general.index', _external=True)
-    items = []
-    posts = Post.get_published(num=10).all()
-
-    for post in posts:
-        post_url = urljoin(base_url, post.url)
-
-        # TODO: Add a real description
-        item = RSSItem(
-            title=post.title,
-            link=post_url,
-            description=post.body.split('\r\n', 1)[0],
-            author='{} ({})'.format(post.author.email, post.author.full_name),
-            categories=[tag.name for tag in post.tags],
-            guid=Guid(post_url),
-            pubDate=post.pub_date
-        )
-        items.append(item)
-
-    feed_config = current_app.config['BLOG_POSTS_FEED']
-    rss2_feed = RSS2(
-        title=feed_config['title'],
-        link=base_url,
-        description=feed_config['description'],
-        language='en-us',
-        webMaster=feed_config['webmaster'],
-        lastBuildDate=posts[0].pub_date if posts else None,
-        ttl=1440,
-        items=items
-    )
-    return current_app.response_class(rss2_feed.to_xml(encoding='utf-8'),
-                                      mimetype='application/rss+xml')
+FEED_KIND = '<any(atom):kind>'
+
+
+@blueprint.route('/posts/feed', defaults={'kind': 'rss'})
+@blueprint.route('/posts/feed/' + FEED_KIND)
+def posts_feed(kind):
+    # Readers poll feeds constantly, so they are only built after posts
+    # change and polls are answered from the cache, often with a 304
+    def build():
+        posts = Post.get_published(num=NUM_FEED_POSTS).all()
+        return build_feed(kind, posts,
+                          current_app.config['BLOG_POSTS_FEED']['title'],
+                          url_for('general.index'))
+
+    feed = query_cache.get_or_create(('posts_feed', kind), build)
+    return make_page_response(feed)
+
+
+@blueprint.route('/tags/<slug>/feed', defaults={'kind': 'rss'})
+@blueprint.route('/tags/<slug>/feed/' + FEED_KIND)
+def tag_feed(slug, kind):
+    def build():
+        tag = Tag.query.filter_by(slug=slug).first_or_404()
+        posts = Post.get_tagged(tag, load='full').limit(NUM_FEED_POSTS).all()
+        title = u'{} - {}'.format(
+            current_app.config['BLOG_POSTS_FEED']['title'], tag.name)
+        return build_feed(kind, posts, title, tag.url)
+
+    feed = query_cache.get_or_create(('tag_feed', slug, kind), build)
+    return make_page_response(feed)
@@ -4,14 +4,17 @@ from flask import (Blueprint, current_app, request, flash, render_template,
 from esther import mail
 from esther.models import Post
 from esther.forms import ContactForm
+from esther.page_cache import cached_page
 
 blueprint = Blueprint('general', __name__)
 
 
 @blueprint.route('/', defaults={'page': 1})
 @blueprint.route('/page/<int:page>')
+@cached_page
 def index(page):
-    recent_posts = Post.get_recent(page)
+    recent_posts = Post.get_recent(page, before=request.args.get('before'),
+                                   after=request.args.get('after'))
     return render_template('general/index.html', posts=recent_posts)
 
 
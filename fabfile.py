@@ -23,6 +23,13 @@ def deploy(requirements='no', frontend='yes', restart='yes'):
             run('bower install')
             run('gulp build')
 
+        # Workers load compiled templates instead of compiling them on the
+        # first requests after the restart
+        with prefix(u'workon {}'.format(env.virtualenv_name)):
+            run('python run.py compile_templates')
+            # Posts saved while the code changed may still be queued
+            run('python run.py related_posts update')
+
     if restart == 'yes':
         run('~/webapps/esther/apache2/bin/restart')
 
@@ -1,14 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
+import subprocess
 import sys
 
 from flask.ext.script import Manager, prompt, prompt_bool, prompt_pass
 from flask.ext.sqlalchemy import get_debug_queries
 from sqlalchemy.exc import DatabaseError
 
-from esther import create_app, db, models
-from esther.export import export_posts
-from esther.tests import run_tests
+# Modules only used by one command, like the test runner or the export, are
+# imported by the command so the others start faster
+from esther import create_app, db, models, template_cache
+from esther.cache import query_cache
+from esther.related import apply_related_updates, rebuild_related_posts
+from esther.search import post_search
 
 app = create_app()
 manager = Manager(app)
@@ -31,6 +36,8 @@ def server(toolbar=False, db_stats=False):
         def print_db_stats(response):
             queries = get_debug_queries()
             print u'↱ number of queries: {}'.format(len(queries))
+            print u'↱ query cache: {hits} hits, {misses} misses'.format(
+                **query_cache.stats())
             return response
 
     app.run()
@@ -57,12 +64,35 @@ def tests(label=None):
             label = 'esther.tests.{}'.format(label)
         kwargs['labels'] = [label]
 
+    from esther.tests import run_tests
     result = run_tests(**kwargs)
 
     if not result:
         sys.exit(1)
 
 
+@manager.command
+def benchmark(name, iterations=200):
+    from esther.benchmarks import BENCHMARKS
+    try:
+        bench = BENCHMARKS[name]
+    except KeyError:
+        print(u'Invalid benchmark: "{}". Choose from: {}'.format(
+            name, u', '.join(sorted(BENCHMARKS))))
+        sys.exit(1)
+
+    bench(iterations=int(iterations))
+
+
+@manager.command
+def profile_startup(target='app', num_modules=25):
+    # A fresh interpreter, since this one has already imported everything
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'esther', 'startup.py')
+    sys.exit(subprocess.call([sys.executable, script, target,
+                              str(num_modules)]))
+
+
 @manager.command
 def database(action):
     if action == 'create':
@@ -98,8 +128,120 @@ def add_user():
 
 
 @manager.command
-def export():
-    export_posts()
+def rerender(processes=None, chunk_size=100):
+    if processes is not None:
+        processes = int(processes)
+    from esther.rerender import rerender_posts
+    rerender_posts(processes=processes, chunk_size=int(chunk_size))
+
+
+@manager.command
+def tag_stats(action):
+    if action == 'rebuild':
+        models.TagStats.refresh(db.session.connection())
+        db.session.commit()
+    else:
+        print(u'Invalid action: "{}"'.format(action))
+        sys.exit(1)
+
+
+@manager.command
+def search_index(action):
+    if action == 'rebuild':
+        index = post_search.rebuild()
+        print(u'Indexed {} posts.'.format(len(index)))
+    else:
+        print(u'Invalid action: "{}"'.format(action))
+        sys.exit(1)
+
+
+@manager.command
+def related_posts(action):
+    if action == 'rebuild':
+        num_posts = rebuild_related_posts(db.session.connection())
+        db.session.commit()
+        query_cache.invalidate(['related_posts'])
+        print(u'Found related posts for {} posts.'.format(num_posts))
+    elif action == 'update':
+        # Applies what saving posts queued. conf/crontab runs it and
+        # "freeze" does it first too.
+        num_posts = apply_related_updates(db.session.connection())
+        db.session.commit()
+        # Cached pages show related posts, so only drop them on a change
+        if num_posts:
+            query_cache.invalidate(['related_posts'])
+        print(u'Updated related posts for {} changed posts.'.format(
+            num_posts))
+    else:
+        print(u'Invalid action: "{}"'.format(action))
+        sys.exit(1)
+
+
+@manager.command
+def compile_templates():
+    if app.config['TEMPLATE_BYTECODE_CACHE_DIR'] is None:
+        print(u'TEMPLATE_BYTECODE_CACHE_DIR is not set.')
+        sys.exit(1)
+    num_templates = template_cache.compile_templates(app)
+    print(u'Compiled {} templates into {}.'.format(
+        num_templates, template_cache.bytecode_cache_dir(app)))
+
+
+@manager.command
+def freeze(output_dir=None, processes=None, full=False):
+    if output_dir is None:
+        output_dir = (app.config['FREEZE_OUTPUT_DIR'] or
+                      os.path.join(app.instance_path, 'frozen'))
+    if processes is not None:
+        processes = int(processes)
+    from esther.freeze import freeze_site
+    freeze_site(output_dir, processes=processes, full=full)
+
+
+@manager.command
+def export(output=None, format='json', gzip=False, chunk_size=1000,
+           since_checkpoint=None):
+    from esther.export import export_changes, export_posts, FORMATS
+    if format not in FORMATS:
+        print(u'Invalid format: "{}". Choose from: {}'.format(
+            format, u', '.join(FORMATS)))
+        sys.exit(1)
+    options = dict(output=output, format=format, compress=gzip,
+                   chunk_size=int(chunk_size))
+    if since_checkpoint:
+        export_changes(since_checkpoint, **options)
+    else:
+        export_posts(**options)
+
+
+def import_(path, format='json', batch_size=1000, commit_every=10000,
+            author=None):
+    from esther.importer import (FORMATS, import_posts, iter_posts,
+                                 open_input, refresh_derived_data)
+    if format not in FORMATS:
+        print(u'Invalid format: "{}". Choose from: {}'.format(
+            format, u', '.join(FORMATS)))
+        sys.exit(1)
+    try:
+        with open_input(path) as f:
+            importer = import_posts(
+                iter_posts(f, format), batch_size=int(batch_size),
+                commit_every=int(commit_every), default_author=author)
+    except ValueError as e:
+        # An unknown --author fails before anything is imported. Posts
+        # committed before a later error are kept and skipped when importing
+        # the file again.
+        print(e)
+        sys.exit(1)
+    print(u'Imported {} posts, skipped {} whose slug was taken.'.format(
+        importer.num_imported, importer.num_skipped))
+    refresh_derived_data()
+    print(u'Rebuilt tag stats, related posts and the search index. Run '
+          u'"rerender" to render posts without up to date HTML.')
+
+# ``import`` is a keyword
+import_.__name__ = 'import'
+manager.command(import_)
 
 
 if __name__ == '__main__':